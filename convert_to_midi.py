@@ -1,7 +1,9 @@
 import os
-import glob
 import sys
 import argparse # コマンドライン引数を扱うため
+import multiprocessing
+
+import numpy as np
 
 # sample_audio.py が依存する utils.data_utils をインポートするためにパスを追加
 # このパスは、お使いのプロジェクトのディレクトリ構造に合わせて調整してください。
@@ -30,67 +32,181 @@ except ImportError:
         print(f"       (sys.path: {sys.path})")
         sys.exit(1)
 
-def convert_pkl_to_midi(pkl_input_dir, midi_output_dir):
+def _midi_path(midi_output_dir, name):
+    return os.path.join(midi_output_dir, os.path.splitext(name)[0] + ".mid")
+
+
+def _is_up_to_date(midi_file_path, source_mtime):
+    """出力 MIDI が入力より新しければ True を返す。"""
+    try:
+        return os.path.getmtime(midi_file_path) >= source_mtime
+    except OSError:
+        return False
+
+
+def _convert_one(task):
+    """1 つの NoteSequence を MIDI に書き出す (ワーカープロセスで実行)。
+
+    Args:
+        task: (名前, .pkl のパスまたはシリアライズ済み NoteSequence, 出力パス)。
+
+    Returns:
+        (名前, 成功したか, エラーメッセージ)。
+    """
+    name, source, midi_file_path = task
+    try:
+        if isinstance(source, bytes):
+            note_sequence_obj = note_seq.NoteSequence.FromString(source)
+        else:
+            # sample_audio.py で data_utils.save を使って保存されているため、
+            # data_utils.load で読み込むのが適切です。
+            note_sequence_obj = data_utils.load(source)
+
+        # ロードされたオブジェクトが本当に NoteSequence か確認 (念のため)
+        if not isinstance(note_sequence_obj, note_seq.NoteSequence):
+            return name, False, "有効な NoteSequence オブジェクトではありません"
+
+        # 中断されても壊れた MIDI が残らないよう、一時ファイル経由で書き出す
+        tmp_path = midi_file_path + ".tmp"
+        note_seq.note_sequence_to_midi_file(note_sequence_obj, tmp_path)
+        os.replace(tmp_path, midi_file_path)
+        return name, True, None
+    except Exception as e:
+        return name, False, str(e)
+
+
+def _iter_pkl_dir_tasks(pkl_input_dir, midi_output_dir, force):
+    """ディレクトリ内の .pkl を 1 つずつ走査してタスクを生成する。
+
+    ファイルの読み込みはワーカー側で行うため、メインプロセスはパスだけを流す。
+    """
+    with os.scandir(pkl_input_dir) as it:
+        for entry in it:
+            if not entry.is_file() or not entry.name.endswith(".pkl"):
+                continue
+            midi_file_path = _midi_path(midi_output_dir, entry.name)
+            if not force and _is_up_to_date(midi_file_path,
+                                            entry.stat().st_mtime):
+                yield None
+                continue
+            yield entry.name, entry.path, midi_file_path
+
+
+def _load_batched_sequences(batch_path):
+    """まとめて保存された NoteSequence を (名前, シリアライズ済み) で返す。
+
+    対応形式:
+        .pkl: NoteSequence のリスト、または {名前: NoteSequence} の辞書。
+              リストの場合は sample_audio.py と同じく 1 始まりの番号を名前にする。
+        .npz: 各キーが名前、値がシリアライズ済み NoteSequence のバイト列
+              (uint8 配列またはバイト文字列)。
+    """
+    if batch_path.endswith(".npz"):
+        with np.load(batch_path, allow_pickle=False) as data:
+            for name in data.files:
+                yield name, data[name].tobytes()
+        return
+
+    sequences = data_utils.load(batch_path)
+    if isinstance(sequences, dict):
+        items = sequences.items()
+    else:
+        items = ((str(i + 1), ns) for i, ns in enumerate(sequences))
+    for name, ns in items:
+        if isinstance(ns, note_seq.NoteSequence):
+            ns = ns.SerializeToString()
+        yield str(name), ns
+
+
+def _iter_batched_tasks(batch_path, midi_output_dir, force):
+    source_mtime = os.path.getmtime(batch_path)
+    for name, serialized in _load_batched_sequences(batch_path):
+        midi_file_path = _midi_path(midi_output_dir, name)
+        if not force and _is_up_to_date(midi_file_path, source_mtime):
+            yield None
+            continue
+        yield name, serialized, midi_file_path
+
+
+def convert_pkl_to_midi(pkl_input, midi_output_dir, num_workers=None,
+                        force=False):
     """
-    指定されたディレクトリ内の .pkl (NoteSequence) ファイルを MIDI に変換する。
+    NoteSequence を MIDI に並列に変換する。
+
+    入力は .pkl (NoteSequence) ファイルが格納されたディレクトリか、
+    NoteSequence をまとめて保存した 1 つの .pkl / .npz ファイル。
+    既に入力より新しい MIDI がある場合は変換をスキップする。
 
     Args:
-        pkl_input_dir (str): NoteSequence の .pkl ファイルが格納されているディレクトリ。
-                             例: './audio/gen/ns'
+        pkl_input (str): .pkl ファイルのディレクトリ、またはまとめたファイル。
+                         例: './audio/gen/ns'
         midi_output_dir (str): 生成された MIDI ファイルを保存するディレクトリ。
+        num_workers (int): 並列に変換するプロセス数 (既定: CPU 数)。
+        force (bool): True の場合、最新の出力も上書きする。
     """
-    if not os.path.isdir(pkl_input_dir):
-        print(f"エラー: 入力ディレクトリ '{pkl_input_dir}' が存在しません。")
+    if os.path.isdir(pkl_input):
+        tasks = _iter_pkl_dir_tasks(pkl_input, midi_output_dir, force)
+    elif os.path.isfile(pkl_input) and pkl_input.endswith((".pkl", ".npz")):
+        tasks = _iter_batched_tasks(pkl_input, midi_output_dir, force)
+    else:
+        print(f"エラー: 入力 '{pkl_input}' はディレクトリでも .pkl/.npz ファイルでもありません。")
         return
 
     if not os.path.exists(midi_output_dir):
         os.makedirs(midi_output_dir)
         print(f"作成しました: '{midi_output_dir}'")
 
-    pkl_files = glob.glob(os.path.join(pkl_input_dir, "*.pkl"))
-    
-    if not pkl_files:
-        print(f"情報: '{pkl_input_dir}' に .pkl ファイルが見つかりません。")
-        return
-
-    print(f"'{pkl_input_dir}' から .pkl ファイルを処理中...")
+    print(f"'{pkl_input}' から NoteSequence を処理中...")
     converted_count = 0
-    for pkl_file_path in pkl_files:
-        try:
-            # utils.data_utils.load を使って NoteSequence オブジェクトをロード
-            # sample_audio.py で data_utils.save を使って保存されているため、
-            # data_utils.load で読み込むのが適切です。
-            note_sequence_obj = data_utils.load(pkl_file_path)
+    skipped_count = 0
+    failed_count = 0
 
-            # ロードされたオブジェクトが本当に NoteSequence か確認 (念のため)
-            if not isinstance(note_sequence_obj, note_seq.NoteSequence):
-                print(f"警告: {pkl_file_path} は有効な NoteSequence オブジェクトではありません。スキップします。")
-                continue
+    def pending_tasks():
+        nonlocal skipped_count
+        for task in tasks:
+            if task is None:
+                skipped_count += 1
+            else:
+                yield task
 
-            base_name = os.path.basename(pkl_file_path)
-            midi_file_name = os.path.splitext(base_name)[0] + ".mid"
-            midi_file_path = os.path.join(midi_output_dir, midi_file_name)
+    # TensorFlow 等を読み込んだ後でも安全なように spawn でプロセスを作る
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_workers or os.cpu_count()) as pool:
+        results = pool.imap_unordered(_convert_one, pending_tasks(),
+                                      chunksize=32)
+        for name, ok, error in results:
+            if ok:
+                converted_count += 1
+            else:
+                failed_count += 1
+                print(f"エラー: {name} の処理中にエラーが発生しました: {error}")
 
-            note_seq.note_sequence_to_midi_file(note_sequence_obj, midi_file_path)
-            # print(f"MIDI を保存しました: {midi_file_path}")
-            converted_count += 1
+    if converted_count + skipped_count + failed_count == 0:
+        print(f"情報: '{pkl_input}' に NoteSequence が見つかりません。")
+        return
 
-        except Exception as e:
-            print(f"エラー: {pkl_file_path} の処理中にエラーが発生しました: {e}")
-    
-    print(f"処理完了。{converted_count} 個のファイルを MIDI に変換しました。出力先: '{midi_output_dir}'")
+    print(f"処理完了。{converted_count} 個のファイルを MIDI に変換しました "
+          f"(最新のためスキップ: {skipped_count}, 失敗: {failed_count})。"
+          f"出力先: '{midi_output_dir}'")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="NoteSequence .pkl ファイルを MIDI に変換します。")
-    parser.add_argument("input_dir", type=str,
-                        help="NoteSequence の .pkl ファイルが格納されている入力ディレクトリ (例: ./audio/gen/ns)。")
+    parser.add_argument("input", type=str,
+                        help="NoteSequence の .pkl ファイルが格納されている入力ディレクトリ (例: ./audio/gen/ns)、"
+                             "または NoteSequence をまとめた .pkl/.npz ファイル。")
     parser.add_argument("output_dir", type=str,
                         help="生成された MIDI ファイルを保存する出力ディレクトリ (例: ./audio/gen/midi)。")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="並列に変換するプロセス数 (既定: CPU 数)。")
+    parser.add_argument("--force", action="store_true",
+                        help="入力より新しい MIDI が既にある場合も変換し直す。")
     
     args = parser.parse_args()
     
-    convert_pkl_to_midi(args.input_dir, args.output_dir)
+    convert_pkl_to_midi(args.input, args.output_dir, num_workers=args.num_workers,
+                        force=args.force)
 
     # 使用例 (コマンドラインから実行する場合):
     # python convert_script_name.py ./audio/gen/ns ./audio/gen/midi
-    # (convert_script_name.py はこのスクリプトを保存したファイル名)
\ No newline at end of file
+    # python convert_script_name.py ./audio/gen/ns.npz ./audio/gen/midi --num_workers 8
+    # (convert_script_name.py はこのスクリプトを保存したファイル名)
@@ -14,6 +14,7 @@
 
 # Lint as: python3
 """Input data pipeline."""
+import glob
 import os
 import time
 
@@ -75,6 +76,127 @@ def data_transform(batch, problem='vae', pca=None):
   return batch
 
 
+def affine_transform_params(transform):
+  """Extracts the affine map of a fitted transform.
+
+  Supports PCA (including whitening), StandardScaler and pipelines of them,
+  which covers the checkpoints of scripts/generate_compressed_transform.py.
+
+  Args:
+    transform: A fitted scikit-learn transform.
+
+  Returns:
+    A (weights, bias) tuple such that transform(x) = x @ weights + bias, or
+    None if the transform is not a supported affine transform.
+  """
+  if hasattr(transform, 'steps'):
+    weights, bias = None, None
+    for _, step in transform.steps:
+      if step is None or step == 'passthrough':
+        continue
+      params = affine_transform_params(step)
+      if params is None:
+        return None
+      if weights is None:
+        weights, bias = params
+      else:
+        weights, bias = weights @ params[0], bias @ params[0] + params[1]
+    return weights, bias
+
+  if hasattr(transform, 'components_'):
+    weights = transform.components_.T
+    if getattr(transform, 'whiten', False):
+      weights = weights / np.sqrt(transform.explained_variance_)
+    bias = -np.dot(transform.mean_, weights)
+    return weights, bias
+
+  if hasattr(transform, 'scale_') and hasattr(transform, 'with_std'):
+    dim = getattr(transform, 'n_features_in_', None)
+    if dim is None:
+      dim = len(transform.mean_ if transform.mean_ is not None else
+                transform.scale_)
+    mean = transform.mean_ if transform.with_mean else np.zeros(dim)
+    scale = transform.scale_ if transform.with_std else np.ones(dim)
+    return np.diag(1. / scale), -mean / scale
+
+  return None
+
+
+def graph_data_transform(batch,
+                         problem='vae',
+                         weights=None,
+                         bias=None,
+                         slice_idx=None,
+                         dim_weights=None):
+  """In-graph counterpart of data_transform followed by slice_transform.
+
+  The PCA, dimension weights and slice are folded into a single matrix
+  product along the last axis, so the transform runs inside the tf.data map
+  without calling back into Python.
+
+  Args:
+    batch: A batch of data samples.
+    weights: Weights of the affine PCA transform, see affine_transform_params.
+    bias: Bias of the affine PCA transform.
+    slice_idx: Indices of the dimensions to keep after the transform.
+    dim_weights: Per-dimension weights applied before slicing.
+
+  Returns:
+    Transformed batch tensor.
+  """
+  if problem == 'mnist':
+    batch = tf.reshape(batch, (tf.shape(batch)[0], -1))
+    batch = tf.cast(batch, tf.float32) / 255.
+    batch = 2. * batch - 1.
+
+  if weights is None:
+    return slice_transform(batch,
+                           problem=problem,
+                           slice_idx=slice_idx,
+                           dim_weights=dim_weights)
+
+  if dim_weights is not None:
+    weights = weights * dim_weights
+    bias = bias * dim_weights
+  if slice_idx is not None:
+    weights = weights[:, slice_idx]
+    bias = bias[slice_idx]
+
+  weights = tf.constant(weights, dtype=tf.float32)
+  bias = tf.constant(bias, dtype=tf.float32)
+  return tf.tensordot(tf.cast(batch, tf.float32), weights, axes=1) + bias
+
+
+def forward_data_transform(batch,
+                           normalize=True,
+                           pca=None,
+                           data_min=0.,
+                           data_max=1.,
+                           slice_idx=None,
+                           dim_weights=None):
+  """Forward data transform (NumPy counterpart of the input pipeline).
+
+  Args:
+    batch: Batch array in the original latent space.
+    pca: PCA transform object.
+
+  Returns:
+    Transformed batch array in the space the model is trained on.
+  """
+  batch = np.asarray(data_transform(np.asarray(batch), pca=pca))
+
+  if dim_weights is not None:
+    batch = batch * dim_weights
+
+  if slice_idx is not None:
+    batch = batch[..., slice_idx]
+
+  if normalize:
+    batch = normalize_dataset(batch, data_min, data_max)
+
+  return batch
+
+
 def inverse_data_transform(batch,
                            normalize=True,
                            pca=None,
@@ -110,6 +232,19 @@ def inverse_data_transform(batch,
   return batch
 
 
+def dataset_files(dataset, split, problem='vae'):
+  """Lists the files that make up a split of a dataset."""
+  if problem == 'mnist':
+    return []
+  dataset = os.path.expanduser(dataset)
+  if data_utils.LatentStore.exists(f'{dataset}/{split}'):
+    return [
+        f'{dataset}/{split}.{ext}'
+        for ext in ('latents', 'offsets.npy', 'meta.json')
+    ]
+  return glob.glob(f'{dataset}/{split}-*.tfrecord')
+
+
 def get_dataset(dataset='',
                 data_shape=(2,),
                 problem='vae',
@@ -119,9 +254,22 @@ def get_dataset(dataset='',
                 slice_ckpt='',
                 dim_weights_ckpt='',
                 include_cardinality=True):
+  batched = False
   if problem == 'mnist':
     train_ds = tfds.load('mnist', split='train', shuffle_files=True)
     eval_ds = tfds.load('mnist', split='test', shuffle_files=True)
+  elif problem in ['vae', 'toy'] and data_utils.LatentStore.exists(
+      f'{dataset}/train'):
+    shape = tuple(map(int, data_shape))
+    train_ds = data_utils.get_latent_dataset(f'{dataset}/train',
+                                             shape=shape,
+                                             batch_size=batch_size,
+                                             shuffle=True)
+    eval_ds = data_utils.get_latent_dataset(f'{dataset}/eval',
+                                            shape=shape,
+                                            batch_size=batch_size,
+                                            shuffle=True)
+    batched = True
   elif problem in ['vae', 'toy', 'tokens']:
     shape = tuple(map(int, data_shape))
     tokens = problem == 'tokens'
@@ -147,58 +295,83 @@ def get_dataset(dataset='',
   dim_weights = data_utils.load(
       os.path.expanduser(dim_weights_ckpt)) if dim_weights_ckpt else None
 
-  # Batch.
-  train_ds = train_ds.batch(batch_size, drop_remainder=True)
-  eval_ds = eval_ds.batch(batch_size, drop_remainder=True)
+  # Batch. Latent stores are batched when windows are gathered.
+  if not batched:
+    train_ds = train_ds.batch(batch_size, drop_remainder=True)
+    eval_ds = eval_ds.batch(batch_size, drop_remainder=True)
 
   train_ds = train_ds.map(partial(deconstruct_dict, problem=problem),
                           num_parallel_calls=AUTOTUNE)
   eval_ds = eval_ds.map(partial(deconstruct_dict, problem=problem),
                         num_parallel_calls=AUTOTUNE)
 
-  # PCA transform
+  # PCA, slice and weight transforms.
   if problem != 'tokens':
-    train_ds = train_ds.map(lambda example: tf.py_function(
-        partial(data_transform, problem=problem, pca=pca), [example], tf.float32
-    ),
+    pca_params = affine_transform_params(pca) if pca is not None else None
+    if pca is None or pca_params is not None:
+      weights, bias = pca_params if pca_params is not None else (None, None)
+      transform_fn = partial(graph_data_transform,
+                             problem=problem,
+                             weights=weights,
+                             bias=bias,
+                             slice_idx=slice_idx,
+                             dim_weights=dim_weights)
+      train_ds = train_ds.map(transform_fn, num_parallel_calls=AUTOTUNE)
+      eval_ds = eval_ds.map(transform_fn, num_parallel_calls=AUTOTUNE)
+    else:
+      logging.info('Applying unsupported transform %s with tf.py_function.',
+                   type(pca).__name__)
+      train_ds = train_ds.map(lambda example: tf.py_function(
+          partial(data_transform, problem=problem, pca=pca), [example],
+          tf.float32),
+                              num_parallel_calls=AUTOTUNE)
+      eval_ds = eval_ds.map(lambda example: tf.py_function(
+          partial(data_transform, problem=problem, pca=pca), [example],
+          tf.float32),
                             num_parallel_calls=AUTOTUNE)
-    eval_ds = eval_ds.map(lambda example: tf.py_function(
-        partial(data_transform, problem=problem, pca=pca), [example], tf.float32
-    ),
-                          num_parallel_calls=AUTOTUNE)
 
-    # Slice + weight transform
-    train_ds = train_ds.map(partial(slice_transform,
+      # Slice + weight transform
+      train_ds = train_ds.map(partial(slice_transform,
+                                      problem=problem,
+                                      slice_idx=slice_idx,
+                                      dim_weights=dim_weights),
+                              num_parallel_calls=AUTOTUNE)
+      eval_ds = eval_ds.map(partial(slice_transform,
                                     problem=problem,
                                     slice_idx=slice_idx,
                                     dim_weights=dim_weights),
                             num_parallel_calls=AUTOTUNE)
-    eval_ds = eval_ds.map(partial(slice_transform,
-                                  problem=problem,
-                                  slice_idx=slice_idx,
-                                  dim_weights=dim_weights),
-                          num_parallel_calls=AUTOTUNE)
 
   # Dataset normalization.
   train_min, train_max = 0., 1.
   eval_min, eval_max = 0., 1.
+  train_stats, eval_stats = None, None
   if normalize:
     logging.info('Normalizing dataset to have range [-1, 1].')
-    config_name = pca_ckpt.split('/')[-1].split('.')[0]
-    config_name += slice_ckpt.split('/')[-1].split('.')[0]
-    config_name += dim_weights_ckpt.split('/')[-1].split('.')[0]
-    train_min, train_max = data_utils.compute_dataset_min_max(
+    transform_ckpts = [
+        os.path.expanduser(ckpt)
+        for ckpt in (pca_ckpt, slice_ckpt, dim_weights_ckpt)
+        if ckpt
+    ]
+    stats_config = {'problem': problem, 'data_shape': list(data_shape)}
+    train_stats = data_utils.compute_dataset_moments(
         train_ds,
         ds_split='train',
         cache=True,
         cache_dir=os.path.expanduser(dataset),
-        config=config_name)
-    eval_min, eval_max = data_utils.compute_dataset_min_max(
+        config=data_utils.fingerprint_files(
+            dataset_files(dataset, 'train', problem) + transform_ckpts,
+            stats_config))
+    eval_stats = data_utils.compute_dataset_moments(
         eval_ds,
         ds_split='eval',
         cache=True,
         cache_dir=os.path.expanduser(dataset),
-        config=config_name)
+        config=data_utils.fingerprint_files(
+            dataset_files(dataset, 'eval', problem) + transform_ckpts,
+            stats_config))
+    train_min, train_max = train_stats['min'].min(), train_stats['max'].max()
+    eval_min, eval_max = eval_stats['min'].min(), eval_stats['max'].max()
     train_ds = train_ds.map(lambda example: normalize_dataset(
         example, train_min, train_max),
                             num_parallel_calls=AUTOTUNE)
@@ -214,22 +387,32 @@ def get_dataset(dataset='',
   setattr(train_ds, 'max', train_max)
   setattr(eval_ds, 'min', eval_min)
   setattr(eval_ds, 'max', eval_max)
+  setattr(train_ds, 'statistics', train_stats)
+  setattr(eval_ds, 'statistics', eval_stats)
 
   if include_cardinality:
     t0 = time.time()
     config_name = str(batch_size)
+    # TFRecord datasets with a manifest do not need to be scanned. Latent
+    # stores know their number of batches already.
+    train_card, eval_card = None, None
+    if not batched and problem != 'mnist':
+      train_card = data_utils.manifest_cardinality(dataset, 'train', batch_size)
+      eval_card = data_utils.manifest_cardinality(dataset, 'eval', batch_size)
     data_utils.compute_dataset_cardinality(
         train_ds,
         ds_split='train',
         cache=True,
         cache_dir=os.path.expanduser(dataset),
-        config=config_name)
+        config=config_name,
+        cardinality=train_card)
     data_utils.compute_dataset_cardinality(
         eval_ds,
         ds_split='eval',
         cache=True,
         cache_dir=os.path.expanduser(dataset),
-        config=config_name)
+        config=config_name,
+        cardinality=eval_card)
     logging.info('Computed dataset cardinality in %f seconds', time.time() - t0)
 
   return train_ds, eval_ds
@@ -0,0 +1,54 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for input_pipeline."""
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+import input_pipeline
+
+
+class AffineTransformParamsTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(200, 8) * rng.uniform(0.5, 4., size=8) + 3.
+
+  @parameterized.named_parameters(
+      ('pca', lambda: PCA(n_components=4)),
+      ('whitened_pca', lambda: PCA(n_components=4, whiten=True)),
+      ('scaler', StandardScaler),
+      ('pipeline', lambda: Pipeline([('scaling', StandardScaler()),
+                                     ('pca', PCA(n_components=4))])),
+  )
+  def test_matches_transform(self, make_transform):
+    transform = make_transform().fit(self.data)
+    weights, bias = input_pipeline.affine_transform_params(transform)
+    np.testing.assert_allclose(self.data @ weights + bias,
+                               transform.transform(self.data),
+                               rtol=1e-6,
+                               atol=1e-8)
+
+  def test_unsupported_transform(self):
+    self.assertIsNone(input_pipeline.affine_transform_params(object()))
+
+
+if __name__ == '__main__':
+  absltest.main()
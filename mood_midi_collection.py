@@ -1,6 +1,8 @@
+import heapq
 import json
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 # --- 設定項目 ---
@@ -24,81 +26,169 @@ TARGET_MOODS = [
 # 5. 各moodから抽出する曲数
 NUM_SAMPLES_PER_MOOD = 2000 # 必要に応じて変更してください
 
+# 6. ファイルをコピーする代わりにハードリンクを作るか（別ファイルシステムの場合は自動でコピー）
+USE_HARDLINK = True
+
+# 7. 並列にコピーするスレッド数
+NUM_WORKERS = 16
+
+# 8. ムードのインデックスを保存するファイル
+INDEX_FILE = os.path.join(OUTPUT_DIR, 'mood_index.json')
+
 # --- スクリプト本体 ---
 
+def dataset_fingerprint(path):
+    """データセットファイルが変わったかを判定するための情報。"""
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def build_mood_index(dataset_file, k):
+    """データセットを1回だけ走査し、全moodの上位k件を求める。
+
+    moodごとにサイズkのヒープを保持するので、メモリはデータセットの
+    大きさではなく mood数 × k に比例する。TARGET_MOODS に限らず全moodを
+    記録するため、後からmoodを追加しても再走査は不要。
+
+    Returns:
+        {'moods': {mood: [[prob, location], ...]}, 'counts': {mood: 件数}}
+        各リストは確率が高い順（同じ確率ならファイル内の順）。
+    """
+    heaps = {}
+    counts = {}
+    with open(dataset_file, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(tqdm(f, desc='Indexing')):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            moods = entry.get('mood') or []
+            probs = entry.get('mood_prob') or []
+            location = entry.get('location')
+            for idx, mood_name in enumerate(moods):
+                # 同じmoodが重複している場合は最初のものだけを使う
+                if moods.index(mood_name) != idx:
+                    continue
+                # moodとmood_probの対応が取れない場合はスキップ
+                if idx >= len(probs) or location is None:
+                    continue
+                counts[mood_name] = counts.get(mood_name, 0) + 1
+                # 同じ確率なら後の行から先に押し出す
+                item = (probs[idx], -line_no, location)
+                heap = heaps.setdefault(mood_name, [])
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+    moods = {
+        mood_name: [[prob, location]
+                    for prob, _, location in sorted(heap, reverse=True)]
+        for mood_name, heap in heaps.items()
+    }
+    return {'moods': moods, 'counts': counts}
+
+
+def load_or_build_mood_index(dataset_file, index_file, k):
+    """保存済みのインデックスが使えればそれを読み、なければ作って保存する。"""
+    fingerprint = dataset_fingerprint(dataset_file)
+    if os.path.exists(index_file):
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('dataset') == fingerprint and index.get('k', 0) >= k:
+            print(f"保存済みのインデックス '{index_file}' を使用します。")
+            return index
+        print("データセットまたは抽出数が変わったため、インデックスを作り直します。")
+
+    print(f"データセットファイル '{dataset_file}' からインデックスを作成中...")
+    index = build_mood_index(dataset_file, k)
+    index['dataset'] = fingerprint
+    index['k'] = k
+
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+    print(f"{len(index['moods'])} 種類のmoodのインデックスを '{index_file}' に保存しました。")
+    return index
+
+
+def materialize_file(source_path, dest_path):
+    """1ファイルをハードリンクまたはコピーで配置する。
+
+    Returns:
+        'linked', 'copied', 'exists', 'missing' のいずれか。
+    """
+    if not os.path.exists(source_path):
+        return 'missing'
+    if os.path.exists(dest_path) and \
+            os.path.getsize(dest_path) == os.path.getsize(source_path):
+        return 'exists'
+    tmp_path = dest_path + '.tmp'
+    if USE_HARDLINK:
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(source_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+            return 'linked'
+        except OSError:
+            pass  # 別ファイルシステムなどの場合はコピーする
+    shutil.copy2(source_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+    return 'copied'
+
+
 def process_midicaps_dataset():
     # 出力ディレクトリを作成
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     print(f"出力先ディレクトリ: {OUTPUT_DIR}")
 
-    # 1. まず全データをメモリに読み込む
-    print(f"データセットファイル '{DATASET_FILE}' を読み込み中...")
-    all_data = []
-    with open(DATASET_FILE, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                all_data.append(json.loads(line))
-            except json.JSONDecodeError:
+    # 1. データセットを1回だけ走査して mood -> (確率, location) のインデックスを作る
+    index = load_or_build_mood_index(DATASET_FILE, INDEX_FILE,
+                                     NUM_SAMPLES_PER_MOOD)
+
+    # 2. 各moodごとに処理
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        for mood_name in TARGET_MOODS:
+            print(f"\n--- ムード '{mood_name}' の処理を開始 ---")
+
+            mood_specific_data = index['moods'].get(mood_name)
+            if not mood_specific_data:
+                print(f"ムード '{mood_name}' が含まれるデータが見つかりませんでした。")
                 continue
-    print(f"合計 {len(all_data)} 件のデータを読み込みました。")
 
+            print(f"'{mood_name}' を含む曲が {index['counts'][mood_name]} 件見つかりました。")
 
-    # 2. 各moodごとに処理
-    for mood_name in TARGET_MOODS:
-        print(f"\n--- ムード '{mood_name}' の処理を開始 ---")
-        
-        # 3. 対象moodを含むデータをフィルタリングし、確率を紐付ける
-        mood_specific_data = []
-        for entry in all_data:
-            if 'mood' in entry and mood_name in entry['mood']:
-                try:
-                    # moodリスト内のインデックスを取得
-                    idx = entry['mood'].index(mood_name)
-                    # 対応するmood_probを取得
-                    prob = entry['mood_prob'][idx]
-                    # 元のデータに確率を一時的に追加してリストに保存
-                    entry_with_prob = entry.copy()
-                    entry_with_prob['target_mood_prob'] = prob
-                    mood_specific_data.append(entry_with_prob)
-                except (ValueError, IndexError):
-                    # moodとmood_probの対応が取れない場合はスキップ
-                    continue
-        
-        if not mood_specific_data:
-            print(f"ムード '{mood_name}' が含まれるデータが見つかりませんでした。")
-            continue
-            
-        print(f"'{mood_name}' を含む曲が {len(mood_specific_data)} 件見つかりました。")
-
-        # 4. 確率が高い順にソート
-        mood_specific_data.sort(key=lambda x: x['target_mood_prob'], reverse=True)
-        
-        # 5. 上位から指定した数を抽出
-        top_samples = mood_specific_data[:NUM_SAMPLES_PER_MOOD]
-        print(f"上位 {len(top_samples)} 件を抽出します。")
-        
-        # 6. MIDIファイルをコピー
-        mood_output_dir = os.path.join(OUTPUT_DIR, mood_name)
-        os.makedirs(mood_output_dir, exist_ok=True)
-        
-        print(f"MIDIファイルを '{mood_output_dir}' にコピーしています...")
-        copy_count = 0
-        for sample in tqdm(top_samples, desc=f"Copying for {mood_name}"):
-            # 元のMIDIファイルのフルパスを構築
-            # locationは 'lmd_full/...' の形式なので、MIDI_ROOT_DIRと結合
-            source_path = os.path.join(MIDI_ROOT_DIR, sample['location'])
-            
-            # コピー先のパス
-            file_name = os.path.basename(sample['location'])
-            dest_path = os.path.join(mood_output_dir, file_name)
-            
-            if os.path.exists(source_path):
-                shutil.copy2(source_path, dest_path)
-                copy_count += 1
-            else:
-                print(f"[警告] ファイルが見つかりません: {source_path}")
-                
-        print(f"'{mood_name}' のために {copy_count} 個のファイルをコピーしました。")
+            # 3. 上位から指定した数を抽出（インデックスは確率が高い順）
+            top_samples = mood_specific_data[:NUM_SAMPLES_PER_MOOD]
+            print(f"上位 {len(top_samples)} 件を抽出します。")
+
+            # 4. MIDIファイルを並列に配置
+            mood_output_dir = os.path.join(OUTPUT_DIR, mood_name)
+            os.makedirs(mood_output_dir, exist_ok=True)
+
+            print(f"MIDIファイルを '{mood_output_dir}' に配置しています...")
+            futures = {}
+            for _, location in top_samples:
+                # locationは 'lmd_full/...' の形式なので、MIDI_ROOT_DIRと結合
+                source_path = os.path.join(MIDI_ROOT_DIR, location)
+                dest_path = os.path.join(mood_output_dir,
+                                         os.path.basename(location))
+                futures[executor.submit(materialize_file, source_path,
+                                        dest_path)] = source_path
+
+            results = {'linked': 0, 'copied': 0, 'exists': 0, 'missing': 0}
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc=f"Copying for {mood_name}"):
+                result = future.result()
+                results[result] += 1
+                if result == 'missing':
+                    print(f"[警告] ファイルが見つかりません: {futures[future]}")
+
+            print(f"'{mood_name}': リンク {results['linked']} 件、コピー {results['copied']} 件、"
+                  f"既存のためスキップ {results['exists']} 件。")
 
     print("\nすべての処理が完了しました。")
 
@@ -1,57 +1,186 @@
 import numpy as np
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 設定 ---
-# 属性
-ATTR = "relaxing"
-# .npyファイルが格納されているディレクトリ
-INPUT_DIR = f'./mood_npys/{ATTR}' 
-# 計算結果の平均を保存するファイルパス
-OUTPUT_FILE = f'./attrib/{ATTR}.npy'
-# 期待される配列のshape
+# 属性ごとのサブディレクトリ ({INPUT_ROOT}/{属性}/*.npy) を持つディレクトリ
+INPUT_ROOT = './mood_npys'
+# 全属性の統計量をまとめて保存するファイルパス
+OUTPUT_FILE = './attrib/attributes.npz'
+# 属性ごとの平均を従来どおり ./attrib/{属性}.npy にも保存するか
+WRITE_NPY = True
+# 期待される配列のshape (Noneの場合は最初のファイルから決める)
 EXPECTED_SHAPE = (512,)
+# 主成分方向 (分散が最大の方向) も計算するか
+COMPUTE_PRINCIPAL = False
+# ファイルを並列に読み込むスレッド数
+NUM_WORKERS = 16
+# 1スレッドがまとめて処理するファイル数
+CHUNK_SIZE = 256
 # --- 設定終わり ---
 
 
-def calculate_average():
-    """設定に基づいて.npyファイルの平均を計算し保存する"""
-    search_path = os.path.join(INPUT_DIR, '*.npy')
-    npy_files = glob.glob(search_path)
+def chunk_statistics(file_paths, expected_shape):
+    """ファイルの塊について件数・平均・偏差平方和 (と共分散) を計算する。
 
-    if not npy_files:
-        print(f"エラー: ディレクトリ '{INPUT_DIR}' に.npyファイルが見つかりませんでした。")
-        return
+    np.load は mmap_mode='r' で開き、読み込みはOSのページキャッシュに任せる。
+    """
+    count = 0
+    mean = np.zeros(expected_shape, dtype=np.float64)
+    m2 = np.zeros(expected_shape, dtype=np.float64)
+    comoment = None
+    if COMPUTE_PRINCIPAL:
+        dim = int(np.prod(expected_shape))
+        comoment = np.zeros((dim, dim), dtype=np.float64)
+    warnings = []
+
+    for file_path in file_paths:
+        try:
+            array = np.load(file_path, mmap_mode='r')
+            if array.shape != expected_shape:
+                warnings.append(f"警告: '{file_path}'のshapeが期待値{expected_shape}と異なります。スキップします。 Shape: {array.shape}")
+                continue
+            array = np.asarray(array, dtype=np.float64)
+        except Exception as e:
+            warnings.append(f"警告: '{file_path}'の読み込み中にエラーが発生しました。スキップします。詳細: {e}")
+            continue
+
+        # Welford法で平均と偏差平方和を更新
+        count += 1
+        delta = array - mean
+        mean += delta / count
+        m2 += delta * (array - mean)
+        if comoment is not None:
+            comoment += np.outer(delta.ravel(), (array - mean).ravel())
 
-    print(f"{len(npy_files)} 個の.npyファイルが見つかりました。")
+    return count, mean, m2, comoment, warnings
 
-    total_sum = np.zeros(EXPECTED_SHAPE, dtype=np.float64)
-    valid_file_count = 0
 
+def merge_statistics(a, b):
+    """2つの塊の統計量を結合する (Chanらの方法)。"""
+    count_a, mean_a, m2_a, comoment_a = a
+    count_b, mean_b, m2_b, comoment_b = b
+    if count_a == 0:
+        return b
+    if count_b == 0:
+        return a
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+    comoment = None
+    if comoment_a is not None:
+        delta = delta.ravel()
+        comoment = comoment_a + comoment_b + \
+            np.outer(delta, delta) * count_a * count_b / count
+    return count, mean, m2, comoment
+
+
+def infer_shape(npy_files):
     for file_path in npy_files:
         try:
-            array = np.load(file_path)
-            if array.shape != EXPECTED_SHAPE:
-                print(f"警告: '{file_path}'のshapeが期待値{EXPECTED_SHAPE}と異なります。スキップします。 Shape: {array.shape}")
-                continue
-            
-            total_sum += array
-            valid_file_count += 1
-        except Exception as e:
-            print(f"警告: '{file_path}'の読み込み中にエラーが発生しました。スキップします。詳細: {e}")
+            return np.load(file_path, mmap_mode='r').shape
+        except Exception:
+            continue
+    return None
+
+
+def attribute_statistics(executor, attr, input_dir):
+    """1つの属性ディレクトリの統計量を並列に計算する。"""
+    npy_files = sorted(glob.glob(os.path.join(input_dir, '*.npy')))
+    if not npy_files:
+        print(f"エラー: ディレクトリ '{input_dir}' に.npyファイルが見つかりませんでした。")
+        return None
 
-    if valid_file_count == 0:
-        print("エラー: 平均を計算できる有効なファイルがありませんでした。")
+    print(f"[{attr}] {len(npy_files)} 個の.npyファイルが見つかりました。")
+
+    expected_shape = EXPECTED_SHAPE or infer_shape(npy_files)
+    chunks = [npy_files[i:i + CHUNK_SIZE]
+              for i in range(0, len(npy_files), CHUNK_SIZE)]
+    stats = (0, None, None, None)
+    for count, mean, m2, comoment, warnings in executor.map(
+            lambda chunk: chunk_statistics(chunk, expected_shape), chunks):
+        for warning in warnings:
+            print(warning)
+        stats = merge_statistics(stats, (count, mean, m2, comoment))
+
+    if stats[0] == 0:
+        print(f"エラー: [{attr}] 平均を計算できる有効なファイルがありませんでした。")
+        return None
+    return stats
+
+
+def principal_direction(comoment, count, shape):
+    """共分散行列の最大固有値に対応する方向と、その方向の分散を返す。"""
+    eigvals, eigvecs = np.linalg.eigh(comoment / count)
+    direction = eigvecs[:, -1]
+    # 符号を決定的にするため、絶対値最大の成分を正にそろえる
+    direction *= np.sign(direction[np.argmax(np.abs(direction))])
+    return direction.reshape(shape), eigvals[-1]
+
+
+def calculate_attribute_vectors():
+    """全属性ディレクトリの平均 (と分散・主成分方向) を計算して保存する"""
+    attrs = sorted(d for d in os.listdir(INPUT_ROOT)
+                   if os.path.isdir(os.path.join(INPUT_ROOT, d)))
+    if not attrs:
+        print(f"エラー: ディレクトリ '{INPUT_ROOT}' に属性のディレクトリが見つかりませんでした。")
         return
 
-    # 平均を計算
-    average_array = total_sum / valid_file_count
+    print(f"{len(attrs)} 個の属性が見つかりました: {', '.join(attrs)}")
+
+    names, counts, means, variances = [], [], [], []
+    principals, principal_variances = [], []
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        for attr in attrs:
+            stats = attribute_statistics(executor, attr,
+                                         os.path.join(INPUT_ROOT, attr))
+            if stats is None:
+                continue
+            count, mean, m2, comoment = stats
+            if means and mean.shape != means[0].shape:
+                print(f"警告: [{attr}] のshape {mean.shape} が他の属性と異なります。スキップします。")
+                continue
+
+            names.append(attr)
+            counts.append(count)
+            means.append(mean)
+            variances.append(m2 / count)
+            if COMPUTE_PRINCIPAL:
+                direction, variance = principal_direction(comoment, count,
+                                                          mean.shape)
+                principals.append(direction)
+                principal_variances.append(variance)
+            print(f"[{attr}] {count} 個のファイルから平均を計算しました。")
+
+    if not names:
+        print("エラー: 平均を計算できる有効な属性がありませんでした。")
+        return
 
     # 結果を保存
-    np.save(OUTPUT_FILE, average_array)
+    # names の順番が means などの行に対応する (guidance_utils.load_latents が参照)
+    os.makedirs(os.path.dirname(OUTPUT_FILE) or '.', exist_ok=True)
+    arrays = {
+        'names': np.array(names),
+        'counts': np.array(counts, dtype=np.int64),
+        'means': np.stack(means),
+        'variances': np.stack(variances),
+    }
+    if COMPUTE_PRINCIPAL:
+        arrays['principal_directions'] = np.stack(principals)
+        arrays['principal_variances'] = np.array(principal_variances)
+    np.savez(OUTPUT_FILE, **arrays)
+
+    if WRITE_NPY:
+        for name, mean in zip(names, means):
+            np.save(os.path.join(os.path.dirname(OUTPUT_FILE) or '.',
+                                 f'{name}.npy'), mean)
+
     print("\n処理が完了しました。")
-    print(f"平均化された配列が '{OUTPUT_FILE}' に保存されました。")
-    print(f"Shape: {average_array.shape}, Dtype: {average_array.dtype}")
+    print(f"{len(names)} 個の属性ベクトルが '{OUTPUT_FILE}' に保存されました。")
+    print(f"Shape: {arrays['means'].shape}, Dtype: {arrays['means'].dtype}")
+    print(f"誘導生成では \"{OUTPUT_FILE}:{names[0]}\" のように指定できます。")
 
 if __name__ == '__main__':
-    calculate_average()
\ No newline at end of file
+    calculate_attribute_vectors()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import npy_mean
+
+
+class MomentMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.data = np.random.RandomState(0).randn(10, 3) * 5. + 2.
+        self.paths = []
+        for i, array in enumerate(self.data):
+            path = os.path.join(self.tmp_dir.name, f'{i}.npy')
+            np.save(path, array)
+            self.paths.append(path)
+
+    def test_chunk_statistics(self):
+        count, mean, m2, comoment, warnings = npy_mean.chunk_statistics(
+            self.paths, (3,))
+        self.assertEqual(count, 10)
+        np.testing.assert_allclose(mean, self.data.mean(axis=0))
+        np.testing.assert_allclose(m2 / count, self.data.var(axis=0))
+        self.assertIsNone(comoment)
+        self.assertEqual(warnings, [])
+
+    def test_chunk_statistics_skips_wrong_shape(self):
+        path = os.path.join(self.tmp_dir.name, 'wrong.npy')
+        np.save(path, np.zeros(4))
+        count, mean, _, _, warnings = npy_mean.chunk_statistics(
+            self.paths[:2] + [path], (3,))
+        self.assertEqual(count, 2)
+        np.testing.assert_allclose(mean, self.data[:2].mean(axis=0))
+        self.assertEqual(len(warnings), 1)
+
+    def test_merge_statistics(self):
+        # 塊に分けて結合した結果が全体を一度に計算した結果と一致すること
+        with mock.patch.object(npy_mean, 'COMPUTE_PRINCIPAL', True):
+            a = npy_mean.chunk_statistics(self.paths[:3], (3,))[:4]
+            b = npy_mean.chunk_statistics(self.paths[3:], (3,))[:4]
+        count, mean, m2, comoment = npy_mean.merge_statistics(a, b)
+        centered = self.data - self.data.mean(axis=0)
+        self.assertEqual(count, 10)
+        np.testing.assert_allclose(mean, self.data.mean(axis=0))
+        np.testing.assert_allclose(m2 / count, self.data.var(axis=0))
+        np.testing.assert_allclose(comoment, centered.T @ centered)
+
+    def test_merge_with_empty_chunk(self):
+        a = npy_mean.chunk_statistics(self.paths, (3,))[:4]
+        empty = (0, None, None, None)
+        self.assertIs(npy_mean.merge_statistics(a, empty), a)
+        self.assertIs(npy_mean.merge_statistics(empty, a), a)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,55 +5,242 @@ import note_seq
 from magenta.models.music_vae import configs
 # from magenta.common import search_for_files
 import glob
+import json
+import multiprocessing
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import tensorflow as tf
+
+import utils.data_utils as data_utils
 
 # --- 設定項目 ---
 INPUT_MIDI_DIR = 'data/lakh/test'  # 元のMIDIファイルが入っているディレクトリ
 OUTPUT_MIDI_DIR = 'data/lakh/test_preprocessed' # 分割後のMIDIを保存するディレクトリ
 CONFIG_NAME = 'cat-mel_2bar_big' # 使用するモデルのConfig名
+NUM_WORKERS = os.cpu_count() # 並列に処理するプロセス数
+SHARD_SIZE = 1000 # TFRecordの1シャードあたりのNoteSequence数
+WRITE_SUBSEQUENCE_MIDI = True # 分割したサブシーケンスをMIDIとしても保存するか
+RETRY_ERRORS = True # 前回エラーになったファイルを再開時に再処理するか
 # ----------------
 
+LEDGER_FILENAME = 'ledger.jsonl' # 処理済みファイルの記録
+ERRORS_FILENAME = 'errors.jsonl' # エラーになったファイルの記録 (処理済みとはしない)
+SHARD_PREFIX = 'notesequences'
+
+_config = None
+
+
+def _init_worker(config_name):
+  global _config
+  _config = configs.CONFIG_MAP[config_name]
+
+
+def process_file(args):
+  """1つのMIDIファイルを処理する。例外はファイル単位で捕捉する。
+
+  Returns:
+    (midi_path, status, シリアライズしたNoteSequence, サブシーケンス数, エラー)
+  """
+  midi_path, output_dir = args
+  try:
+    ns = note_seq.midi_file_to_note_sequence(midi_path)
+    ns.filename = midi_path
+
+    # configのdata_converterを使ってサブシーケンスを抽出
+    # to_tensorsは内部で NoteSequence をモデルが扱える単位に分割する
+    tensors = _config.data_converter.to_tensors(ns).outputs
+
+    if not tensors:
+      return midi_path, 'skipped', None, 0, None
+
+    if WRITE_SUBSEQUENCE_MIDI:
+      # テンソルをNoteSequenceに戻す
+      subsequences = _config.data_converter.from_tensors(tensors)
+      base_filename = os.path.splitext(os.path.basename(midi_path))[0]
+      for i, sub_ns in enumerate(subsequences):
+        output_filename = os.path.join(output_dir, f"{base_filename}_{i}.mid")
+        note_seq.sequence_proto_to_midi_file(sub_ns, output_filename)
+
+    return midi_path, 'ok', ns.SerializeToString(), len(tensors), None
+
+  except Exception as e:
+    return midi_path, 'error', None, 0, str(e)
+
+
+def _shard_index(name):
+  return int(name[len(SHARD_PREFIX) + 1:].split('.')[0])
+
+
+def load_ledger(output_dir):
+  """台帳を読み込み、処理済みファイルの記録と次のシャード番号を返す。
+
+  台帳はシャードの名前変更より先に書かれるため、シャードのファイルが
+  存在しない記録 (名前変更の前に中断された) は未処理として扱う。
+  """
+  ledger_path = os.path.join(output_dir, LEDGER_FILENAME)
+  entries = {}
+  next_index = 0
+  if os.path.exists(ledger_path):
+    with open(ledger_path, 'r') as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          continue  # 中断時に途中まで書かれた行
+        shard = entry.get('shard')
+        if shard:
+          # 書かれなかったシャードの番号も再利用しない
+          next_index = max(next_index, _shard_index(shard) + 1)
+          if not os.path.exists(os.path.join(output_dir, shard)):
+            continue
+        entries[entry['path']] = entry
+  for path in glob.glob(os.path.join(output_dir, f'{SHARD_PREFIX}-*.tfrecord')):
+    next_index = max(next_index, _shard_index(os.path.basename(path)) + 1)
+  return entries, next_index
+
+
+def load_errors(output_dir):
+  """エラーになったファイルのパスの集合を返す。"""
+  errors_path = os.path.join(output_dir, ERRORS_FILENAME)
+  paths = set()
+  if os.path.exists(errors_path):
+    with open(errors_path, 'r') as f:
+      for line in f:
+        try:
+          paths.add(json.loads(line)['path'])
+        except json.JSONDecodeError:
+          continue
+  return paths
+
+
+def append_ledger(output_dir, entries, filename=LEDGER_FILENAME):
+  """台帳に追記し、ディスクに確実に書き込む。"""
+  with open(os.path.join(output_dir, filename), 'a') as f:
+    for entry in entries:
+      f.write(json.dumps(entry) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class ShardWriter(object):
+  """NoteSequenceをシャード単位でTFRecordに書き出す。
+
+  シャードは一時ファイルに書き、台帳に記録してから名前を変更する。
+  台帳にないNoteSequenceがシャードに入ることはなく、名前変更の前に中断された
+  場合は load_ledger がその記録を無視するため、再開しても重複しない。
+  """
+
+  def __init__(self, output_dir, start_index=0):
+    self.output_dir = output_dir
+    self.index = start_index
+    self.writer = None
+    self.pending = []
+
+  def add(self, entry, serialized):
+    if self.writer is None:
+      self.name = f'{SHARD_PREFIX}-{self.index:05d}.tfrecord'
+      self.tmp_path = os.path.join(self.output_dir, f'.{self.name}.tmp')
+      self.writer = tf.io.TFRecordWriter(self.tmp_path)
+    self.writer.write(serialized)
+    self.pending.append(dict(entry, shard=self.name))
+    if len(self.pending) >= SHARD_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self.writer is None:
+      return
+    self.writer.close()
+    append_ledger(self.output_dir, self.pending)
+    os.replace(self.tmp_path, os.path.join(self.output_dir, self.name))
+    print(f"  -> Wrote shard {self.name} ({len(self.pending)} NoteSequences)")
+    self.writer = None
+    self.pending = []
+    self.index += 1
+
+
+def write_manifest(output_dir, ledger):
+  """台帳からシャードごとのNoteSequence数を集計してマニフェストを書き出す。"""
+  counts = {}
+  for entry in ledger.values():
+    if entry.get('shard'):
+      counts[entry['shard']] = counts.get(entry['shard'], 0) + 1
+  shards = [{'path': name, 'num_records': count}
+            for name, count in counts.items()]
+  if shards:
+    data_utils.write_shard_manifest(output_dir, SHARD_PREFIX, shards,
+                                    data_format='notesequence')
+
+
 def preprocess_midi_files(input_dir, output_dir, config_name):
-  """MIDIファイルを指定されたconfigに基づいてサブシーケンスに分割する"""
-  
+  """MIDIファイルを並列に読み込み、NoteSequenceのTFRecordシャードに書き出す。
+
+  中断しても、台帳に記録済みのファイルを飛ばして再開できる。
+  エラーになったファイルは台帳ではなく errors.jsonl に記録し、
+  RETRY_ERRORS が True なら再開時に再処理する。
+  ワーカーが強制終了された場合は BrokenProcessPool で停止する
+  (それまでの結果は台帳に記録されるので、そのまま再開できる)。
+  """
+
   # 出力ディレクトリを作成
   if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
-  # モデルのconfigをロード
-  config = configs.CONFIG_MAP[config_name]
-  
   # MIDIファイルを取得
   # input_files = search_for_files(input_dir, ['mid', 'midi'])
-  input_files = glob.glob(f'{INPUT_MIDI_DIR}/*.mid')
+  input_files = sorted(glob.glob(f'{input_dir}/*.mid'))
 
   print(f"Found {len(input_files)} MIDI files in {input_dir}")
 
-  for midi_path in input_files:
-    print(f"Processing: {midi_path}")
+  # 台帳を読み込み、処理済みのファイルを除外する
+  ledger, next_index = load_ledger(output_dir)
+  done = set(ledger)
+  if not RETRY_ERRORS:
+    done |= load_errors(output_dir)
+  todo = [(path, output_dir) for path in input_files if path not in done]
+  print(f"Skipping {len(input_files) - len(todo)} files already processed.")
+
+  # 中断時に残った一時シャードを削除し、シャード番号の続きから書き始める
+  for tmp_path in glob.glob(os.path.join(output_dir, f'.{SHARD_PREFIX}-*.tmp')):
+    os.remove(tmp_path)
+  writer = ShardWriter(output_dir, start_index=next_index)
+
+  counts = {'ok': 0, 'skipped': 0, 'error': 0}
+  context = multiprocessing.get_context('spawn')
+  # Pool.imap_unordered は強制終了されたワーカーを待ち続けるため、
+  # BrokenProcessPool を送出する ProcessPoolExecutor を使う
+  with futures.ProcessPoolExecutor(NUM_WORKERS, mp_context=context,
+                                   initializer=_init_worker,
+                                   initargs=(config_name,)) as executor:
+    # as_completed は完了したFutureへの参照を手放すため、結果はメモリに溜まらない
+    results = futures.as_completed(
+        [executor.submit(process_file, task) for task in todo])
     try:
-      ns = note_seq.midi_file_to_note_sequence(midi_path)
-      
-      # configのdata_converterを使ってサブシーケンスを抽出
-      # to_tensorsは内部で NoteSequence をモデルが扱える単位に分割する
-      tensors = config.data_converter.to_tensors(ns).outputs
-      
-      if not tensors:
-        print(f"  -> No valid subsequences found. Skipping.")
-        continue
-      
-      # テンソルをNoteSequenceに戻す
-      subsequences = config.data_converter.from_tensors(tensors)
-      
-      base_filename = os.path.splitext(os.path.basename(midi_path))[0]
-      
-      for i, sub_ns in enumerate(subsequences):
-        output_filename = os.path.join(output_dir, f"{base_filename}_{i}.mid")
-        note_seq.sequence_proto_to_midi_file(sub_ns, output_filename)
-      
-      print(f"  -> Saved {len(subsequences)} subsequences.")
-      
-    except Exception as e:
-      print(f"  -> Error processing file: {e}")
+      for i, result in enumerate(results):
+        midi_path, status, serialized, num_subsequences, error = result.result()
+        counts[status] += 1
+        entry = {'path': midi_path, 'status': status,
+                 'subsequences': num_subsequences}
+        if status == 'ok':
+          writer.add(entry, serialized)
+        elif status == 'error':
+          print(f"  -> Error processing {midi_path}: {error}")
+          entry['error'] = error
+          append_ledger(output_dir, [entry], filename=ERRORS_FILENAME)
+        else:
+          append_ledger(output_dir, [entry])
+
+        if (i + 1) % 1000 == 0:
+          print(f"Processed {i + 1}/{len(todo)} files {counts}")
+    except BrokenProcessPool:
+      print("A worker process was killed. Finished files are kept in the "
+            "ledger; rerun to resume.")
+      raise
+    finally:
+      writer.flush()
+
+  write_manifest(output_dir, load_ledger(output_dir)[0])
+  print(f"Done: {counts}")
+  print(f"NoteSequences: {output_dir}/{SHARD_PREFIX}-*.tfrecord")
 
 if __name__ == '__main__':
-  preprocess_midi_files(INPUT_MIDI_DIR, OUTPUT_MIDI_DIR, CONFIG_NAME)
\ No newline at end of file
+  preprocess_midi_files(INPUT_MIDI_DIR, OUTPUT_MIDI_DIR, CONFIG_NAME)
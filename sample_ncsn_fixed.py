@@ -69,7 +69,8 @@ flags.DEFINE_boolean('interpolate', False, 'Interpolate.')
 flags.DEFINE_string('target_npy_path', None, 
                     '誘導の目標となる (32, 512) 形状のnpyファイルへのパス')
 flags.DEFINE_float('guidance_scale', 1.0, 
-                   '目標への誘導の強さを決める係数')
+                   '目標への誘導の強さを決める係数。サンプルごとの平均二乗誤差の'
+                   '勾配に掛かるため、バッチサイズには依存しない')
 
 
 def evaluate(writer, real, collection, baseline, valid_real):
@@ -192,7 +193,7 @@ def evaluate(writer, real, collection, baseline, valid_real):
   return stats
 
 
-def infill_samples(samples, masks, rng_seed=1):
+def infill_samples(samples, masks, rng_seed=1, snapshot_fn=None):
   rng = jax.random.PRNGKey(rng_seed)
   rng, model_rng = jax.random.split(rng)
 
@@ -222,14 +223,8 @@ def infill_samples(samples, masks, rng_seed=1):
                                            FLAGS.num_sigmas,
                                            schedule=FLAGS.schedule_type)
 
-  if FLAGS.sampling == 'ald':
-    sampling_algorithm = ebm_utils.annealed_langevin_dynamics
-  elif FLAGS.sampling == 'cas':
-    sampling_algorithm = ebm_utils.consistent_langevin_dynamics
-  elif FLAGS.sampling == 'ddpm':
-    sampling_algorithm = ebm_utils.diffusion_dynamics
-  else:
-    raise ValueError(f'Unknown sampling algorithm: {FLAGS.sampling}')
+  sampling_algorithm = train_ncsn.get_sampling_algorithm(FLAGS.sampling)
+  epsilon, steps = train_ncsn.sampling_params(FLAGS.sampling, len(sigmas))
 
   init_rng, ld_rng = jax.random.split(rng)
   init = jax.random.uniform(key=init_rng, shape=samples.shape)
@@ -237,10 +232,12 @@ def infill_samples(samples, masks, rng_seed=1):
                                                          optimizer.target,
                                                          sigmas,
                                                          init,
-                                                         FLAGS.ld_epsilon,
-                                                         FLAGS.ld_steps,
+                                                         epsilon,
+                                                         steps,
                                                          FLAGS.denoise,
                                                          True,
+                                                         FLAGS.collection_stride,
+                                                         snapshot_fn,
                                                          infill_samples=samples,
                                                          infill_masks=masks)
   ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
@@ -253,7 +250,7 @@ def diffusion_stochastic_encoder(samples, rng_seed=1):
   
   Estimates q(x_T | x_0) given real samples (x_0) and a noise schedule.
   """
-  assert FLAGS.sampling == 'ddpm'
+  assert FLAGS.sampling in ('ddpm', 'ddim')
   rng = jax.random.PRNGKey(rng_seed)
   betas = ebm_utils.create_noise_schedule(FLAGS.sigma_begin,
                                           FLAGS.sigma_end,
@@ -273,7 +270,7 @@ def diffusion_stochastic_encoder(samples, rng_seed=1):
 
 def diffusion_decoder(z_list, rng_seed=1):
   """Generate samples given a list of latent z as an initialization."""
-  assert FLAGS.sampling == 'ddpm'
+  assert FLAGS.sampling in ('ddpm', 'ddim')
 
   rng = jax.random.PRNGKey(rng_seed)
   rng, ld_rng, model_rng = jax.random.split(rng, num=3)
@@ -302,18 +299,7 @@ def diffusion_decoder(z_list, rng_seed=1):
   optimizer, ema, early_stop = checkpoints.restore_checkpoint(
       FLAGS.model_dir, (optimizer, ema, early_stop))
 
-  gen, collects, sampling_metrics = [], [], []
-  for i, z in enumerate(z_list):
-    generated, collection, ld_metrics = ebm_utils.diffusion_dynamics(
-        ld_rng, optimizer.target, betas, z, FLAGS.ld_epsilon, FLAGS.ld_steps,
-        FLAGS.denoise, False)
-    ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
-    gen.append(generated)
-    collects.append(collection)
-    sampling_metrics.append(ld_metrics)
-    logging.info('Generated samples %i out of %i', i, len(z_list))
-
-  return gen, collects, sampling_metrics
+  return train_ncsn.decode_from_flags(optimizer.target, betas, ld_rng, z_list)
 
 
 # def generate_samples(sample_shape, num_samples, rng_seed=1):
@@ -321,13 +307,18 @@ def generate_samples(sample_shape,
                      num_samples, 
                      rng_seed=1, 
                      target_latents=None, 
-                     guidance_scale=1.0):  
+                     guidance_scale=1.0,
+                     snapshot_fn=None,
+                     output_fn=None):  
   """Generate samples using pre-trained score network.
 
   Args:
     sample_shape: Shape of each sample.
     num_samples: Number of samples to generate.
     rng_seed: Random number generator for sampling.
+    snapshot_fn: Optional callback that receives the collected samples.
+    output_fn: Optional callback that receives each chunk of generated
+        samples instead of returning them.
   """
   rng = jax.random.PRNGKey(rng_seed)
   rng, model_rng = jax.random.split(rng)
@@ -359,23 +350,16 @@ def generate_samples(sample_shape,
                                            schedule=FLAGS.schedule_type)
 
   rng, sample_rng = jax.random.split(rng)
-
-  t0 = time.time()
-  generated, collection, ld_metrics = train_ncsn.sample(
+  generated, collection, ld_metrics = train_ncsn.sample_from_flags(
       optimizer.target,
       sigmas,
       sample_rng,
       sample_shape,
-      num_samples=num_samples,
-      sampling=FLAGS.sampling,
-      epsilon=FLAGS.ld_epsilon,
-      steps=FLAGS.ld_steps,
-      # denoise=FLAGS.denoise)
-      denoise=FLAGS.denoise,
-      # ↓↓↓ ここから2行を追加 ↓↓↓
+      num_samples,
       target_latents=target_latents,
-      guidance_scale=guidance_scale)
-  logging.info('Generated samples in %f seconds', time.time() - t0)
+      guidance_scale=guidance_scale,
+      snapshot_fn=snapshot_fn,
+      output_fn=output_fn)
 
   return generated, collection, ld_metrics
 
@@ -415,6 +399,7 @@ def main(argv):
     eval_ds = eval_ds.take(FLAGS.sample_size)
   real = np.stack([ex for ex in tfds.as_numpy(eval_ds)])
   shape = real[0].shape
+  train_ncsn.enable_compilation_cache(shape)
 
   # Generation.
   # 追加：目標となる.npyファイルを読み込む
@@ -448,6 +433,17 @@ def main(argv):
       target_latents = target_latents[:, slice_idx]
       logging.info(f'変換後の目標npyの形状: {target_latents.shape}')
     
+  # Stream collected and generated samples to disk instead of buffering them.
+  transform_fn = partial(input_pipeline.inverse_data_transform,
+                         normalize=FLAGS.normalize,
+                         pca=pca,
+                         data_min=train_ds.min,
+                         data_max=train_ds.max,
+                         slice_idx=slice_idx,
+                         dim_weights=dim_weights)
+  snapshot_fn, output_fn = train_ncsn.streaming_outputs(log_dir, transform_fn)
+  num_samples = FLAGS.sample_size if FLAGS.stream_samples else len(real)
+
   if FLAGS.infill:  # Infilling.
     if FLAGS.problem == 'toy' and real.shape[-1] == 2:
       samples = np.copy(real)
@@ -467,7 +463,7 @@ def main(argv):
       masks[:, fixed_idx, :] = 1  # hold fixed
 
     generated, collection, ld_metrics = infill_samples(
-        samples, masks, rng_seed=FLAGS.sample_seed)
+        samples, masks, rng_seed=FLAGS.sample_seed, snapshot_fn=snapshot_fn)
 
   elif FLAGS.interpolate:  # Interpolation.
     starts = real
@@ -485,11 +481,19 @@ def main(argv):
     #     shape, len(real), rng_seed=FLAGS.sample_seed)
     # 追加：読み込んだ目標と誘導係数を渡す
     generated, collection, ld_metrics = generate_samples(
-    shape, len(real), rng_seed=FLAGS.sample_seed,
+    shape, num_samples, rng_seed=FLAGS.sample_seed,
     target_latents=target_latents,
-    guidance_scale=FLAGS.guidance_scale
+    guidance_scale=FLAGS.guidance_scale,
+    snapshot_fn=snapshot_fn,
+    output_fn=output_fn
     )
 
+  # Generated samples were already written to disk chunk by chunk.
+  if generated is None:
+    logging.info('Wrote %i generated samples to %s', num_samples,
+                 os.path.join(log_dir, 'ncsn/generated'))
+    return
+
   # Animation (for 2D samples).
   if FLAGS.animate and shape[-1] == 2:
     im_buf = plot_utils.animate_scatter_2d(collection[::2], fps=240)
@@ -509,7 +513,7 @@ def main(argv):
                                                         train_ds.min,
                                                         train_ds.max, slice_idx,
                                                         dim_weights)
-    if not FLAGS.interpolate:
+    if not FLAGS.interpolate and not FLAGS.stream_collection:
       collection_t = input_pipeline.inverse_data_transform(
           collection, FLAGS.normalize, pca, train_ds.min, train_ds.max,
           slice_idx, dim_weights)
@@ -37,6 +37,7 @@ from sklearn.mixture import GaussianMixture
 
 import utils.data_utils as data_utils
 import utils.ebm_utils as ebm_utils
+import utils.guidance_utils as guidance_utils
 import utils.train_utils as train_utils
 import utils.plot_utils as plot_utils
 import utils.losses as losses
@@ -45,8 +46,6 @@ import models.ncsn as ncsn
 import train_ncsn
 import input_pipeline
 
-from typing import List
-
 FLAGS = flags.FLAGS
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
@@ -74,26 +73,24 @@ flags.DEFINE_multi_string(
     'guidance_spec', None,
     '誘導生成のための仕様を定義します。このフラグは複数回指定できます。\n'
     '書式: "<indices>:<spec>"\n'
-    '<indices>: 適用するバッチ内のインデックス。カンマ区切り(例: "0,2,4")や'
+    '<indices>: 適用するサンプルのインデックス。カンマ区切り(例: "0,2,4")や'
     'ハイフンでの範囲指定(例: "0-15")が可能です。\n'
     '<spec>: 適用する潜在表現の仕様。単一のnpyファイルパス(例: "path/to/a.npy")や、'
     '複数のnpyファイルの加重和(例: "a.npy*0.8+b.npy*0.2")で指定します。\n'
+    'npy_mean.py が出力するnpzの属性ベクトルは"attrib/attributes.npz:happy"のように'
+    '指定できます。\n'
     '重みを省略した場合、1.0として扱われます。潜在表現の次元は(512,)である必要があります。\n'
     '例: --guidance_spec="0-15:cat.npy" --guidance_spec="16-31:dog.npy*0.5+wolf.npy*0.5"'
 )
+flags.DEFINE_string(
+    'guidance_manifest', None,
+    'Guidance specs read from a file: a JSON list of {"indices", "spec"} '
+    'objects or one "<indices>:<spec>" entry per line.')
+flags.DEFINE_string('guidance_cache_dir', None,
+                    'Directory where blended guidance targets are cached.')
 flags.DEFINE_float('guidance_scale', 1.0, 
-                   '目標への誘導の強さを決める係数')
-
-def _parse_indices(s: str) -> List[int]:
-  """Parses a string of indices, e.g., "0-3,7,10-12" into a list of ints."""
-  indices = set()
-  for part in s.split(','):
-    if '-' in part:
-      start, end = map(int, part.split('-'))
-      indices.update(range(start, end + 1))
-    else:
-      indices.add(int(part))
-  return sorted(list(indices))
+                   '目標への誘導の強さを決める係数。サンプルごとの平均二乗誤差の'
+                   '勾配に掛かるため、バッチサイズには依存しない')
 
 def evaluate(writer, real, collection, baseline, valid_real):
   """Evaluation metrics.
@@ -215,7 +212,7 @@ def evaluate(writer, real, collection, baseline, valid_real):
   return stats
 
 
-def infill_samples(samples, masks, rng_seed=1):
+def infill_samples(samples, masks, rng_seed=1, snapshot_fn=None):
   rng = jax.random.PRNGKey(rng_seed)
   rng, model_rng = jax.random.split(rng)
 
@@ -245,14 +242,8 @@ def infill_samples(samples, masks, rng_seed=1):
                                            FLAGS.num_sigmas,
                                            schedule=FLAGS.schedule_type)
 
-  if FLAGS.sampling == 'ald':
-    sampling_algorithm = ebm_utils.annealed_langevin_dynamics
-  elif FLAGS.sampling == 'cas':
-    sampling_algorithm = ebm_utils.consistent_langevin_dynamics
-  elif FLAGS.sampling == 'ddpm':
-    sampling_algorithm = ebm_utils.diffusion_dynamics
-  else:
-    raise ValueError(f'Unknown sampling algorithm: {FLAGS.sampling}')
+  sampling_algorithm = train_ncsn.get_sampling_algorithm(FLAGS.sampling)
+  epsilon, steps = train_ncsn.sampling_params(FLAGS.sampling, len(sigmas))
 
   init_rng, ld_rng = jax.random.split(rng)
   init = jax.random.uniform(key=init_rng, shape=samples.shape)
@@ -260,10 +251,12 @@ def infill_samples(samples, masks, rng_seed=1):
                                                          optimizer.target,
                                                          sigmas,
                                                          init,
-                                                         FLAGS.ld_epsilon,
-                                                         FLAGS.ld_steps,
+                                                         epsilon,
+                                                         steps,
                                                          FLAGS.denoise,
                                                          True,
+                                                         FLAGS.collection_stride,
+                                                         snapshot_fn,
                                                          infill_samples=samples,
                                                          infill_masks=masks)
   ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
@@ -276,7 +269,7 @@ def diffusion_stochastic_encoder(samples, rng_seed=1):
   
   Estimates q(x_T | x_0) given real samples (x_0) and a noise schedule.
   """
-  assert FLAGS.sampling == 'ddpm'
+  assert FLAGS.sampling in ('ddpm', 'ddim')
   rng = jax.random.PRNGKey(rng_seed)
   betas = ebm_utils.create_noise_schedule(FLAGS.sigma_begin,
                                           FLAGS.sigma_end,
@@ -296,7 +289,7 @@ def diffusion_stochastic_encoder(samples, rng_seed=1):
 
 def diffusion_decoder(z_list, rng_seed=1):
   """Generate samples given a list of latent z as an initialization."""
-  assert FLAGS.sampling == 'ddpm'
+  assert FLAGS.sampling in ('ddpm', 'ddim')
 
   rng = jax.random.PRNGKey(rng_seed)
   rng, ld_rng, model_rng = jax.random.split(rng, num=3)
@@ -325,18 +318,7 @@ def diffusion_decoder(z_list, rng_seed=1):
   optimizer, ema, early_stop = checkpoints.restore_checkpoint(
       FLAGS.model_dir, (optimizer, ema, early_stop))
 
-  gen, collects, sampling_metrics = [], [], []
-  for i, z in enumerate(z_list):
-    generated, collection, ld_metrics = ebm_utils.diffusion_dynamics(
-        ld_rng, optimizer.target, betas, z, FLAGS.ld_epsilon, FLAGS.ld_steps,
-        FLAGS.denoise, False)
-    ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
-    gen.append(generated)
-    collects.append(collection)
-    sampling_metrics.append(ld_metrics)
-    logging.info('Generated samples %i out of %i', i, len(z_list))
-
-  return gen, collects, sampling_metrics
+  return train_ncsn.decode_from_flags(optimizer.target, betas, ld_rng, z_list)
 
 
 # def generate_samples(sample_shape, num_samples, rng_seed=1):
@@ -344,13 +326,19 @@ def generate_samples(sample_shape,
                      num_samples, 
                      rng_seed=1, 
                      target_latents=None, 
-                     guidance_scale=1.0):  
+                     guidance_scale=1.0,
+                     target_masks=None,
+                     snapshot_fn=None,
+                     output_fn=None):  
   """Generate samples using pre-trained score network.
 
   Args:
     sample_shape: Shape of each sample.
     num_samples: Number of samples to generate.
     rng_seed: Random number generator for sampling.
+    snapshot_fn: Optional callback that receives the collected samples.
+    output_fn: Optional callback that receives each chunk of generated
+        samples instead of returning them.
   """
   rng = jax.random.PRNGKey(rng_seed)
   rng, model_rng = jax.random.split(rng)
@@ -382,23 +370,17 @@ def generate_samples(sample_shape,
                                            schedule=FLAGS.schedule_type)
 
   rng, sample_rng = jax.random.split(rng)
-
-  t0 = time.time()
-  generated, collection, ld_metrics = train_ncsn.sample(
+  generated, collection, ld_metrics = train_ncsn.sample_from_flags(
       optimizer.target,
       sigmas,
       sample_rng,
       sample_shape,
-      num_samples=num_samples,
-      sampling=FLAGS.sampling,
-      epsilon=FLAGS.ld_epsilon,
-      steps=FLAGS.ld_steps,
-      # denoise=FLAGS.denoise)
-      denoise=FLAGS.denoise,
-      # ↓↓↓ ここから2行を追加 ↓↓↓
+      num_samples,
       target_latents=target_latents,
-      guidance_scale=guidance_scale)
-  logging.info('Generated samples in %f seconds', time.time() - t0)
+      guidance_scale=guidance_scale,
+      target_masks=target_masks,
+      snapshot_fn=snapshot_fn,
+      output_fn=output_fn)
 
   return generated, collection, ld_metrics
 
@@ -438,74 +420,47 @@ def main(argv):
     eval_ds = eval_ds.take(FLAGS.sample_size)
   real = np.stack([ex for ex in tfds.as_numpy(eval_ds)])
   shape = real[0].shape
+  train_ncsn.enable_compilation_cache(shape)
+
+  # Stream collected and generated samples to disk instead of buffering them.
+  transform_fn = partial(input_pipeline.inverse_data_transform,
+                         normalize=FLAGS.normalize,
+                         pca=pca,
+                         data_min=train_ds.min,
+                         data_max=train_ds.max,
+                         slice_idx=slice_idx,
+                         dim_weights=dim_weights)
+  snapshot_fn, output_fn = train_ncsn.streaming_outputs(log_dir, transform_fn)
+  num_samples = FLAGS.sample_size if FLAGS.stream_samples else len(real)
+
+  # Build per-sample guidance targets from --guidance_spec and
+  # --guidance_manifest.
+  target_latents, target_masks = None, None
+  guidance_specs = [
+      guidance_utils.parse_guidance_spec(spec)
+      for spec in FLAGS.guidance_spec or []
+  ]
+  if FLAGS.guidance_manifest:
+    guidance_specs += guidance_utils.load_guidance_manifest(
+        FLAGS.guidance_manifest)
+  if guidance_specs:
+    blends, assignment = guidance_utils.blend_guidance_targets(
+        guidance_specs, num_samples, cache_dir=FLAGS.guidance_cache_dir)
+    if blends.ndim - 1 < len(shape):
+      # A single latent vector guides every position of the sequence. 1-D
+      # samples (e.g. --data_shape=512) already match the latent shape.
+      blends = np.broadcast_to(blends[:, np.newaxis],
+                               (len(blends), *shape[:-1], blends.shape[-1]))
+    blends = input_pipeline.forward_data_transform(blends, FLAGS.normalize,
+                                                   pca, train_ds.min,
+                                                   train_ds.max, slice_idx,
+                                                   dim_weights)
+    target_latents, target_masks = guidance_utils.assign_guidance_targets(
+        blends, assignment)
+    logging.info('Guiding %i of %i samples towards %i targets',
+                 int(target_masks.sum()), num_samples, len(blends))
 
   # Generation.
-  # --guidance_spec に基づいて目標となる潜在表現を構築
-  target_latents = None
-  if FLAGS.guidance_spec:
-    # スライス前の次元数 (512) とバッチサイズ (32) を仮定
-    latent_dim = 512
-    batch_size = 32  # このスクリプトは通常固定バッチサイズで実行される
-    target_latents = np.zeros((batch_size, latent_dim), dtype=np.float32)
-    
-    loaded_latents_cache = {} # .npyファイルの再読み込みを防ぐキャッシュ
-
-    logging.info('ガイダンス仕様を解析しています...')
-    for spec_str in FLAGS.guidance_spec:
-      try:
-        indices_str, latent_spec_str = spec_str.split(':', 1)
-      except ValueError:
-        raise ValueError(
-            f'不正なguidance_specフォーマット: "{spec_str}". '
-            '"<indices>:<spec>" の形式で指定してください。')
-
-      indices = _parse_indices(indices_str)
-      
-      # 潜在表現の仕様をパースし、加重和を計算
-      final_latent = np.zeros(latent_dim, dtype=np.float32)
-      blend_parts = latent_spec_str.split('+')
-      
-      for part in blend_parts:
-        part = part.strip()
-        if '*' in part:
-          path, weight_str = part.rsplit('*', 1)
-          weight = float(weight_str)
-        else:
-          path = part
-          weight = 1.0
-
-        # キャッシュから読み込むか、ファイルからロードする
-        expanded_path = os.path.expanduser(path)
-        if expanded_path in loaded_latents_cache:
-          latent_vec = loaded_latents_cache[expanded_path]
-        else:
-          logging.info(f'目標ファイル {expanded_path} を読み込みます。')
-          latent_vec = np.load(expanded_path)
-          # 形状チェック
-          if latent_vec.shape != (latent_dim,):
-            raise ValueError(
-                f'目標npyファイル {expanded_path} の形状が不正です。'
-                f'期待する形状: ({latent_dim},), 実際の形状: {latent_vec.shape}')
-          loaded_latents_cache[expanded_path] = latent_vec
-
-        final_latent += latent_vec * weight
-
-      # 計算した潜在表現を対応するインデックスに割り当てる
-      for idx in indices:
-        if 0 <= idx < batch_size:
-          target_latents[idx] = final_latent
-        else:
-          warnings.warn(f'インデックス {idx} は範囲外のため無視されます (0-{batch_size-1})。')
-
-    logging.info('目標となる潜在表現の構築が完了しました。')
-
-    # スライス変換を目標の潜在表現にも適用する
-    if FLAGS.slice_ckpt:
-      logging.info(f'スライス変換 {FLAGS.slice_ckpt} を目標npyに適用します。')
-      slice_idx = data_utils.load(os.path.expanduser(FLAGS.slice_ckpt))
-      target_latents = target_latents[:, slice_idx]
-      logging.info(f'変換後の目標npyの形状: {target_latents.shape}')
-    
   if FLAGS.infill:  # Infilling.
     if FLAGS.problem == 'toy' and real.shape[-1] == 2:
       samples = np.copy(real)
@@ -525,7 +480,7 @@ def main(argv):
       masks[:, fixed_idx, :] = 1  # hold fixed
 
     generated, collection, ld_metrics = infill_samples(
-        samples, masks, rng_seed=FLAGS.sample_seed)
+        samples, masks, rng_seed=FLAGS.sample_seed, snapshot_fn=snapshot_fn)
 
   elif FLAGS.interpolate:  # Interpolation.
     starts = real
@@ -543,11 +498,20 @@ def main(argv):
     #     shape, len(real), rng_seed=FLAGS.sample_seed)
     # 追加：読み込んだ目標と誘導係数を渡す
     generated, collection, ld_metrics = generate_samples(
-    shape, len(real), rng_seed=FLAGS.sample_seed,
+    shape, num_samples, rng_seed=FLAGS.sample_seed,
     target_latents=target_latents,
-    guidance_scale=FLAGS.guidance_scale
+    guidance_scale=FLAGS.guidance_scale,
+    target_masks=target_masks,
+    snapshot_fn=snapshot_fn,
+    output_fn=output_fn
     )
 
+  # Generated samples were already written to disk chunk by chunk.
+  if generated is None:
+    logging.info('Wrote %i generated samples to %s', num_samples,
+                 os.path.join(log_dir, 'ncsn/generated'))
+    return
+
   # Animation (for 2D samples).
   if FLAGS.animate and shape[-1] == 2:
     im_buf = plot_utils.animate_scatter_2d(collection[::2], fps=240)
@@ -567,7 +531,7 @@ def main(argv):
                                                         train_ds.min,
                                                         train_ds.max, slice_idx,
                                                         dim_weights)
-    if not FLAGS.interpolate:
+    if not FLAGS.interpolate and not FLAGS.stream_collection:
       collection_t = input_pipeline.inverse_data_transform(
           collection, FLAGS.normalize, pca, train_ds.min, train_ds.max,
           slice_idx, dim_weights)
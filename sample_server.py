@@ -0,0 +1,479 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Long-lived sampling service for a trained diffusion model.
+
+The checkpoint, normalization statistics and data transforms are loaded once
+and the sampler is compiled at startup. Concurrent requests are coalesced into
+fixed-size batches so that every call reuses the same compiled sampler.
+
+Endpoints (JSON over HTTP, either on --port or on the Unix socket
+--socket_path):
+  POST /generate  {"num_samples": 4}
+  POST /infill    {"samples": [...], "masks": [...]}
+  GET  /health
+
+Both POST endpoints optionally accept guidance targets in the original latent
+space ("target": (512,) or (seq_len, 512), "guidance_scale": 1.0). Samples are
+returned in the original latent space as {"samples": [...]}.
+
+Every request is sampled with infilling (/generate uses all-zero masks, which
+leave the samples unchanged) so that all requests share one compiled sampler;
+--sampling=cas does not support infilling. Guidance targets require
+--sampling=ddpm or ddim, and guidance_scale has the same effect regardless of
+--server_batch_size or of the requests batched together.
+"""
+import http.server
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+from concurrent import futures
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import tensorflow as tf
+
+from flax.training import checkpoints
+
+import utils.data_utils as data_utils
+import utils.ebm_utils as ebm_utils
+import utils.train_utils as train_utils
+import train_ncsn
+import input_pipeline
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('host', '127.0.0.1', 'Address to serve HTTP requests on.')
+flags.DEFINE_integer('port', 8000, 'Port to serve HTTP requests on.')
+flags.DEFINE_string('socket_path', None,
+                    'Serve on this Unix socket instead of a TCP port.')
+flags.DEFINE_integer('server_batch_size', 32,
+                     'Number of samples in each batch passed to the sampler.')
+flags.DEFINE_integer(
+    'max_batch_delay_ms', 20,
+    'Maximum time to wait for concurrent requests to fill a batch.')
+flags.DEFINE_integer('server_seed', 0,
+                     'Random number generator seed for the sampling service.')
+
+# Samplers that accept guidance targets.
+GUIDED_SAMPLERS = ('ddpm', 'ddim')
+
+
+def _load_model(sample_shape):
+  """Restores the trained model from --model_dir."""
+  rng = jax.random.PRNGKey(FLAGS.seed)
+  model_kwargs = {
+      'num_layers': FLAGS.num_layers,
+      'num_heads': FLAGS.num_heads,
+      'num_mlp_layers': FLAGS.num_mlp_layers,
+      'mlp_dims': FLAGS.mlp_dims
+  }
+  model = train_ncsn.create_model(rng,
+                                  sample_shape,
+                                  model_kwargs,
+                                  batch_size=1,
+                                  verbose=True)
+  optimizer = train_ncsn.create_optimizer(model, 0)
+  ema = train_utils.EMAHelper(mu=0, params=model.params)
+  early_stop = train_utils.EarlyStopping()
+  optimizer, ema, early_stop = checkpoints.restore_checkpoint(
+      FLAGS.model_dir, (optimizer, ema, early_stop))
+  return optimizer.target
+
+
+class SamplingService(object):
+  """Coalesces sampling requests into fixed-size batches.
+
+  Every request is treated as infilling, which is intended: unconditional
+  generation uses an all-zero mask, for which the infilling update leaves the
+  samples unchanged, so generate and infill requests can share batches and a
+  single compiled sampler. Guided and unguided requests are batched
+  separately since guidance changes the compiled sampler. All sampling
+  happens on a single worker thread.
+
+  Guidance is normalized per sample and padding rows are masked out of it, so
+  the effect of guidance_scale on a request does not depend on the batch
+  size or on the other requests in its batch.
+  """
+
+  def __init__(self,
+               scorenet,
+               sigmas,
+               sample_shape,
+               batch_size,
+               max_delay=0.02,
+               seed=0):
+    self.scorenet = scorenet
+    self.sigmas = sigmas
+    self.sample_shape = tuple(sample_shape)
+    self.batch_size = batch_size
+    self.max_delay = max_delay
+    self.sampling_algorithm = train_ncsn.get_sampling_algorithm(FLAGS.sampling)
+    self.epsilon, self.steps = train_ncsn.sampling_params(
+        FLAGS.sampling, len(sigmas))
+    self.supports_guidance = FLAGS.sampling in GUIDED_SAMPLERS
+    self.rng = jax.random.PRNGKey(seed)
+    self.num_batches = 0
+    self.requests = queue.Queue()
+    self.pending = []
+    self.worker = threading.Thread(target=self._run, daemon=True)
+
+  def start(self):
+    self.worker.start()
+
+  def warmup(self):
+    """Compiles the unguided and (if supported) guided samplers."""
+    guidance_scales = (None, 1.) if self.supports_guidance else (None,)
+    for guidance_scale in guidance_scales:
+      t0 = time.time()
+      zeros = np.zeros(self.sample_shape)
+      self._sample_batch([self._row(zeros, zeros, zeros, None)],
+                         guidance_scale)
+      logging.info('Compiled sampler (guidance=%s) in %f seconds',
+                   guidance_scale is not None, time.time() - t0)
+
+  def submit(self, samples, masks, target=None, guidance_scale=1.):
+    """Queues a request.
+
+    Args:
+      samples: Partially complete samples in the model space.
+      masks: Infilling masks (one marks an element that is held fixed).
+      target: Optional guidance target in the model space, either shared by
+          all samples or one per sample.
+      guidance_scale: Strength of the guidance towards target.
+
+    Returns:
+      A future with the generated samples in the model space.
+    """
+    if target is not None and not self.supports_guidance:
+      raise ValueError(f'Guidance targets are not supported by '
+                       f'--sampling={FLAGS.sampling}.')
+    if (target is not None and target.ndim > len(self.sample_shape) and
+        len(target) != len(samples)):
+      raise ValueError(
+          f'Expected {len(samples)} targets but got {len(target)}.')
+
+    future = futures.Future()
+    self.requests.put((samples, masks, target, guidance_scale, future))
+    return future
+
+  def _row(self, sample, mask, target, result):
+    return {'sample': sample, 'mask': mask, 'target': target, 'result': result}
+
+  def _expand(self, request):
+    """Splits a request into rows that can be batched independently."""
+    samples, masks, target, guidance_scale, future = request
+    result = {'future': future, 'samples': [None] * len(samples)}
+    rows = []
+    for i in range(len(samples)):
+      row_target = target
+      if target is not None and target.ndim > len(self.sample_shape):
+        row_target = target[i]
+      row = self._row(samples[i], masks[i], row_target, result)
+      row['idx'] = i
+      row['guidance_scale'] = guidance_scale if target is not None else None
+      rows.append(row)
+    return rows
+
+  def _run(self):
+    while True:
+      # Block until there is work, then wait briefly for more requests.
+      if not self.pending:
+        self.pending.extend(self._expand(self.requests.get()))
+      deadline = time.time() + self.max_delay
+      while len(self.pending) < self.batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          self.pending.extend(self._expand(self.requests.get(timeout=timeout)))
+        except queue.Empty:
+          break
+
+      # Batch rows that share the guidance scale of the oldest row.
+      guidance_scale = self.pending[0]['guidance_scale']
+      rows = [r for r in self.pending if r['guidance_scale'] == guidance_scale]
+      rows = rows[:self.batch_size]
+      batched = set(map(id, rows))
+      self.pending = [r for r in self.pending if id(r) not in batched]
+
+      try:
+        generated = self._sample_batch(rows, guidance_scale)
+      except Exception as e:  # pylint: disable=broad-except
+        for row in rows:
+          if not row['result']['future'].done():
+            row['result']['future'].set_exception(e)
+        continue
+
+      for row, sample in zip(rows, generated):
+        result = row['result']
+        result['samples'][row['idx']] = sample
+        if all(s is not None for s in result['samples']):
+          result['future'].set_result(np.stack(result['samples']))
+
+  def _sample_batch(self, rows, guidance_scale):
+    """Runs the sampler on a padded batch of rows."""
+    shape = (self.batch_size, *self.sample_shape)
+    samples, masks = np.zeros(shape), np.zeros(shape)
+    targets = np.zeros(shape) if guidance_scale is not None else None
+    for i, row in enumerate(rows):
+      samples[i], masks[i] = row['sample'], row['mask']
+      if targets is not None:
+        targets[i] = row['target']
+
+    rng = jax.random.fold_in(self.rng, self.num_batches)
+    self.num_batches += 1
+    init_rng, ld_rng = jax.random.split(rng)
+    if FLAGS.sampling in ('ddpm', 'ddim'):
+      init = jax.random.normal(key=init_rng, shape=shape)
+    else:
+      rho = jnp.sqrt(12) / 2
+      init = jax.random.uniform(key=init_rng,
+                                shape=shape,
+                                minval=-rho,
+                                maxval=rho)
+
+    guidance_kwargs = {}
+    if targets is not None:
+      # Padding rows are not guided.
+      target_masks = np.arange(self.batch_size) < len(rows)
+      guidance_kwargs = {
+          'target_latents': jnp.asarray(targets, dtype=jnp.float32),
+          'guidance_scale': guidance_scale,
+          'target_masks': jnp.asarray(target_masks, dtype=jnp.float32)
+      }
+
+    generated, _, _ = self.sampling_algorithm(
+        ld_rng,
+        self.scorenet,
+        self.sigmas,
+        init,
+        self.epsilon,
+        self.steps,
+        FLAGS.denoise,
+        True,
+        0,
+        None,
+        infill_samples=jnp.asarray(samples, dtype=jnp.float32),
+        infill_masks=jnp.asarray(masks, dtype=jnp.float32),
+        **guidance_kwargs)
+    return np.asarray(generated)[:len(rows)]
+
+
+def _make_handler(service, transforms):
+  """Creates a request handler bound to a sampling service."""
+  sample_shape = service.sample_shape
+
+  def to_model_space(batch):
+    return input_pipeline.forward_data_transform(batch, **transforms)
+
+  def to_latent_space(batch):
+    return input_pipeline.inverse_data_transform(batch, **transforms)
+
+  def check_shape(name, array, num_samples=None):
+    """Rejects arrays that do not hold samples of the model's shape.
+
+    Malformed requests must fail here, since a bad row would otherwise fail
+    every request batched with it.
+    """
+    expected = sample_shape if num_samples is None else (num_samples,
+                                                         *sample_shape)
+    if array.shape != expected:
+      raise ValueError(f'Expected {name} with shape {expected} in the model '
+                       f'space but got {array.shape}.')
+
+  def parse_target(request, num_samples):
+    if request.get('target') is None:
+      return None, 1.
+    target = np.asarray(request['target'], dtype=np.float32)
+    if target.ndim == 0 or target.ndim > len(sample_shape) + 1:
+      raise ValueError(f'Invalid target shape: {target.shape}')
+    if target.ndim == 1:
+      # A single latent vector is shared by every position in the sequence.
+      target = np.broadcast_to(target, (*sample_shape[:-1], target.shape[-1]))
+    if target.ndim == len(sample_shape):
+      # A single target is shared by every sample.
+      target = to_model_space(target[np.newaxis])[0]
+      check_shape('target', target)
+    else:
+      target = to_model_space(target)
+      check_shape('targets', target, num_samples)
+    return target, float(request.get('guidance_scale', 1.))
+
+  def generate(request):
+    num_samples = int(request.get('num_samples', 1))
+    if num_samples < 1:
+      raise ValueError(f'Invalid number of samples: {num_samples}')
+    shape = (num_samples, *sample_shape)
+    target, guidance_scale = parse_target(request, num_samples)
+    return service.submit(np.zeros(shape), np.zeros(shape), target,
+                          guidance_scale)
+
+  def infill(request):
+    samples = np.asarray(request['samples'], dtype=np.float32)
+    masks = np.asarray(request['masks'], dtype=np.float32)
+    if samples.shape != masks.shape:
+      raise ValueError(f'Shape mismatch: {samples.shape} vs {masks.shape}')
+    if samples.ndim != len(sample_shape) + 1:
+      raise ValueError(f'Expected a batch of samples with {len(sample_shape)} '
+                       f'dimensions each but got shape {samples.shape}.')
+    if not len(samples):
+      raise ValueError('No samples to infill.')
+    samples = to_model_space(samples)
+    if transforms['slice_idx'] is not None:
+      masks = masks[..., transforms['slice_idx']]
+    check_shape('samples', samples, len(samples))
+    check_shape('masks', masks, len(samples))
+    target, guidance_scale = parse_target(request, len(samples))
+    return service.submit(samples, masks, target, guidance_scale)
+
+  routes = {'/generate': generate, '/infill': infill}
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    """Handles JSON sampling requests."""
+
+    def address_string(self):
+      # Unix socket clients have no address.
+      return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def _respond(self, code, payload):
+      body = json.dumps(payload).encode('utf-8')
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      if self.path == '/health':
+        self._respond(200, {'status': 'ok'})
+      else:
+        self._respond(404, {'error': f'Unknown endpoint: {self.path}'})
+
+    def do_POST(self):
+      if self.path not in routes:
+        self._respond(404, {'error': f'Unknown endpoint: {self.path}'})
+        return
+      try:
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        t0 = time.time()
+        generated = routes[self.path](request).result()
+        generated = to_latent_space(generated)
+        logging.info('Served %i samples in %f seconds', len(generated),
+                     time.time() - t0)
+        self._respond(200, {'samples': generated.tolist()})
+      except (KeyError, TypeError, ValueError) as e:
+        self._respond(400, {'error': str(e)})
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Sampling request failed.')
+        self._respond(500, {'error': str(e)})
+
+  return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def main(argv):
+  del argv  # unused
+
+  logging.info(FLAGS.flags_into_string())
+  logging.info('Platform: %s', jax.lib.xla_bridge.get_backend().platform)
+
+  # Make sure TensorFlow does not allocate GPU memory.
+  tf.config.experimental.set_visible_devices([], 'GPU')
+
+  if FLAGS.sampling == 'cas':
+    raise app.UsageError(
+        '--sampling=cas does not support infilling, which the sampling '
+        'service uses for every request. Use ald, ddpm or ddim.')
+
+  sample_shape = tuple(map(int, FLAGS.data_shape))
+  train_ncsn.enable_compilation_cache(sample_shape)
+
+  pca = data_utils.load(os.path.expanduser(
+      FLAGS.pca_ckpt)) if FLAGS.pca_ckpt else None
+  slice_idx = data_utils.load(os.path.expanduser(
+      FLAGS.slice_ckpt)) if FLAGS.slice_ckpt else None
+  dim_weights = data_utils.load(os.path.expanduser(
+      FLAGS.dim_weights_ckpt)) if FLAGS.dim_weights_ckpt else None
+
+  # Normalization statistics (cached next to the dataset after the first run).
+  data_min, data_max = 0., 1.
+  if FLAGS.normalize:
+    train_ds, _ = input_pipeline.get_dataset(
+        dataset=FLAGS.dataset,
+        data_shape=FLAGS.data_shape,
+        problem=FLAGS.problem,
+        batch_size=FLAGS.batch_size,
+        normalize=FLAGS.normalize,
+        pca_ckpt=FLAGS.pca_ckpt,
+        slice_ckpt=FLAGS.slice_ckpt,
+        dim_weights_ckpt=FLAGS.dim_weights_ckpt,
+        include_cardinality=False)
+    data_min, data_max = train_ds.min, train_ds.max
+
+  transforms = {
+      'normalize': FLAGS.normalize,
+      'pca': pca,
+      'data_min': data_min,
+      'data_max': data_max,
+      'slice_idx': slice_idx,
+      'dim_weights': dim_weights
+  }
+
+  sigmas = ebm_utils.create_noise_schedule(FLAGS.sigma_begin,
+                                           FLAGS.sigma_end,
+                                           FLAGS.num_sigmas,
+                                           schedule=FLAGS.schedule_type)
+  scorenet = _load_model(sample_shape)
+  service = SamplingService(scorenet,
+                            sigmas,
+                            sample_shape,
+                            FLAGS.server_batch_size,
+                            max_delay=FLAGS.max_batch_delay_ms / 1000.,
+                            seed=FLAGS.server_seed)
+  service.warmup()
+  service.start()
+
+  handler = _make_handler(service, transforms)
+  if FLAGS.socket_path:
+    if os.path.exists(FLAGS.socket_path):
+      os.remove(FLAGS.socket_path)
+    server = ThreadingUnixHTTPServer(FLAGS.socket_path, handler)
+    logging.info('Serving on unix://%s', FLAGS.socket_path)
+  else:
+    server = http.server.ThreadingHTTPServer((FLAGS.host, FLAGS.port), handler)
+    logging.info('Serving on http://%s:%i', FLAGS.host, FLAGS.port)
+
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -16,7 +16,7 @@
 r"""Dataset generation."""
 
 import functools
-import pickle
+import os
 
 from absl import app
 from absl import flags
@@ -31,6 +31,7 @@ import tensorflow as tf
 from .. import config
 from ..utils import song_utils
 from ..utils import data_utils
+from ..utils import pipeline_utils
 
 FLAGS = flags.FLAGS
 
@@ -49,6 +50,23 @@ flags.DEFINE_list('data_shape', [32, 512], 'Data shape.')
 flags.DEFINE_string('input', './output/mel-32step-512',
                     'Path to TFRecord dataset.')
 flags.DEFINE_string('output', './decoded', 'Output directory.')
+flags.DEFINE_string(
+    'split', None,
+    'Split name of the output in the manifest (default: train or eval if the '
+    'output name contains it).')
+
+# Local runner
+flags.DEFINE_enum(
+    'runner', 'beam', ['beam', 'local'],
+    'Run with a Beam pipeline or with a local pool of worker processes, each '
+    'holding its own model.')
+flags.DEFINE_integer('num_workers', None,
+                     'Number of local worker processes (default: CPU count).')
+flags.DEFINE_integer(
+    'num_shards', None,
+    'Number of output shards (default: num_workers locally, 64 with Beam).')
+flags.DEFINE_integer('queue_size', 256,
+                     'Maximum number of pending examples in the local queues.')
 
 
 class DecodeSong(beam.DoFn):
@@ -79,12 +97,28 @@ class DecodeSong(beam.DoFn):
     tensor = np.array(
         self.model_config.data_converter.to_tensors(ns).inputs[::chunk_length])
     tensor = tensor.reshape(-1, tensor.shape[-1])
-    yield pickle.dumps(tensor)
+    yield data_utils.serialize_array(tensor)
 
 
 def main(argv):
   del argv  # unused
 
+  # Resolved here, since flags are not parsed on remote workers.
+  output = os.path.expanduser(FLAGS.output)
+  split = pipeline_utils.manifest_split(output, FLAGS.split)
+  write_manifest = lambda shards: pipeline_utils.write_manifest(
+      shards, output, split)
+
+  if FLAGS.runner == 'local':
+    pipeline_utils.run_local(DecodeSong,
+                             pipeline_utils.read_tfrecords(FLAGS.input),
+                             output,
+                             num_workers=FLAGS.num_workers,
+                             num_shards=FLAGS.num_shards,
+                             queue_size=FLAGS.queue_size,
+                             manifest_fn=write_manifest)
+    return
+
   pipeline_options = beam.options.pipeline_options.PipelineOptions(
       FLAGS.pipeline_options.split(','))
 
@@ -93,8 +127,7 @@ def main(argv):
     p |= 'read_tfrecord' >> beam.io.tfrecordio.ReadAllFromTFRecord()
     p |= 'shuffle_input' >> beam.Reshuffle()
     p |= 'decode_song' >> beam.ParDo(DecodeSong())
-    p |= 'shuffle_output' >> beam.Reshuffle()
-    p |= 'write' >> beam.io.WriteToTFRecord(FLAGS.output)
+    pipeline_utils.write_tfrecords(p, output, split, FLAGS.num_shards or 64)
 
 
 if __name__ == '__main__':
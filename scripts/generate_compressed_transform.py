@@ -47,13 +47,28 @@ flags.DEFINE_enum('mode', 'pca', ['slice', 'pca'], 'Data generation mode.')
 flags.DEFINE_boolean('normalize', True,
                      'Add normalization to transform pipeline.')
 flags.DEFINE_string('ckpt', './output/pca.pkl',
-                    'Path to file containing transform checkpoint.')
+                    'Path to file containing transform checkpoint. With '
+                    'several --dims_list values, "{dims}" in the path is '
+                    'replaced by the rank, or the rank is appended.')
+
+# Streaming fit.
+flags.DEFINE_boolean('streaming', False,
+                     'Fit the transform from streamed batches without '
+                     'materializing the training data.')
+flags.DEFINE_integer('stream_batch_size', 8192,
+                     'Number of examples per streamed batch.')
+flags.DEFINE_list('dims_list', None,
+                  'Ranks to write checkpoints for from a single streaming '
+                  'fit. Defaults to --dims.')
 
 # Visualization.
 flags.DEFINE_boolean('compute_dims', False,
-                     'Compute the expected number of dimensions required.')
+                     'Compute the expected number of dimensions required, '
+                     'from the cumulative explained variance ratio of the '
+                     'PCA (after normalization, if --normalize).')
 flags.DEFINE_float('var_threshold', .85,
-                   'Explained variance threshold for computing dimensions.')
+                   'Explained variance ratio threshold for computing '
+                   'dimensions.')
 
 
 class SliceTransform(object):
@@ -82,6 +97,184 @@ class SliceTransform(object):
     return recon
 
 
+def stream_moments(dataset, batch_size, comoments=True):
+  """Accumulates the mean and centered co-moments of a dataset in one pass.
+
+  Batches are merged with the pairwise update of Chan et al., so memory does
+  not grow with the number of examples.
+
+  Args:
+    dataset: A tf.data.Dataset of unbatched {'inputs'} examples.
+    batch_size: Number of examples per streamed batch.
+    comoments: Whether to accumulate the co-moment matrix.
+
+  Returns:
+    count: Number of examples.
+    mean: Mean of the flattened examples.
+    comoment: Sum of outer products of centered examples, or None.
+  """
+  dataset = dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+  count, mean, comoment = 0, None, None
+  for i, batch in enumerate(tfds.as_numpy(dataset)):
+    x = batch['inputs'].reshape(len(batch['inputs']), -1).astype(np.float64)
+    n = len(x)
+    batch_mean = x.mean(0)
+    batch_comoment = None
+    if comoments:
+      centered = x - batch_mean
+      batch_comoment = centered.T @ centered
+
+    if count == 0:
+      count, mean, comoment = n, batch_mean, batch_comoment
+    else:
+      delta = batch_mean - mean
+      total = count + n
+      mean = mean + delta * n / total
+      if comoments:
+        comoment += batch_comoment + np.outer(delta, delta) * count * n / total
+      count = total
+
+    if i % 100 == 0:
+      logging.info('Streamed %i examples.', count)
+  logging.info('Streamed %i examples in total.', count)
+  return count, mean, comoment
+
+
+def fit_streaming_pipelines(count, mean, comoment, dims_list, normalize):
+  """Builds fitted transform pipelines for several ranks from one fit.
+
+  The principal components are the eigenvectors of the covariance matrix,
+  so a single eigendecomposition serves every rank. The returned objects are
+  regular scikit-learn pipelines, like those fitted in memory.
+
+  Returns:
+    pipelines: Dictionary mapping each rank to its fitted Pipeline.
+    variance_gain: Cumulative explained variance ratio of all components.
+  """
+  covariance = comoment / (count - 1)
+  operations = []
+  pca_mean = mean
+  if normalize:
+    var = np.diag(comoment) / count
+    scale = np.sqrt(var)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.
+
+    scaler = StandardScaler()
+    scaler.mean_ = mean
+    scaler.var_ = var
+    scaler.scale_ = scale
+    scaler.n_samples_seen_ = count
+    scaler.n_features_in_ = len(mean)
+    operations.append(('scaling', scaler))
+
+    covariance = covariance / np.outer(scale, scale)
+    pca_mean = np.zeros_like(mean)
+
+  eigvals, eigvecs = np.linalg.eigh(covariance)
+  eigvals = np.maximum(eigvals[::-1], 0.)
+  components = eigvecs[:, ::-1].T
+  # Make the largest loading of each component positive, for determinism.
+  max_idx = np.argmax(np.abs(components), axis=1)
+  signs = np.sign(components[np.arange(len(components)), max_idx])
+  components *= signs[:, None]
+  ratio = eigvals / eigvals.sum()
+
+  pipelines = {}
+  for dims in dims_list:
+    pca = PCA(n_components=dims)
+    pca.mean_ = pca_mean
+    pca.components_ = components[:dims]
+    pca.explained_variance_ = eigvals[:dims]
+    pca.explained_variance_ratio_ = ratio[:dims]
+    pca.singular_values_ = np.sqrt(eigvals[:dims] * (count - 1))
+    pca.noise_variance_ = eigvals[dims:].mean() if dims < len(eigvals) else 0.
+    pca.n_components_ = dims
+    pca.n_samples_ = count
+    pca.n_features_in_ = len(mean)
+    pipelines[dims] = Pipeline(operations + [('pca', pca)])
+  return pipelines, ratio.cumsum()
+
+
+def explained_variance_ratio(data, normalize):
+  """Explained variance ratio of each principal component of `data`.
+
+  Matches `fit_streaming_pipelines`: the data is centered (and standardized
+  if `normalize`) before the decomposition.
+  """
+  data = data - data.mean(0)
+  if normalize:
+    scale = data.std(0)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.
+    data = data / scale
+  singular_values = np.linalg.svd(data, full_matrices=False, compute_uv=False)
+  eigvals = singular_values**2
+  return eigvals / eigvals.sum()
+
+
+def checkpoint_path(ckpt, dims, num_checkpoints):
+  """Path of the checkpoint with the given rank."""
+  ckpt = os.path.expanduser(ckpt)
+  if '{dims}' in ckpt:
+    return ckpt.format(dims=dims)
+  if num_checkpoints == 1:
+    return ckpt
+  root, ext = os.path.splitext(ckpt)
+  return f'{root}_{dims}{ext}'
+
+
+def plot_variance_gain(variance_gain, var_threshold):
+  """Plots the explained variance curve and returns the required rank."""
+  dims = np.where(variance_gain >= var_threshold)[0][0]
+  variance = variance_gain[dims]
+  plt.text(0, variance + 0.05, '{:.3f}'.format(variance), rotation=0)
+  plt.text(dims + 0.1, 0.2, dims, rotation=0)
+  plt.axhline(y=variance, color='r', linestyle='--')
+  plt.axvline(x=dims, color='r', linestyle='--')
+  plt.plot(variance_gain)
+  plt.show()
+  return dims, variance
+
+
+def streaming_main(train_ds, shape):
+  """Fits the transform out of core and writes a checkpoint per rank."""
+  if len(shape) == 2:
+    assert shape[0] == 3
+    _, mean, _ = stream_moments(train_ds, FLAGS.stream_batch_size,
+                                comoments=False)
+    avg_sigma = mean.reshape(shape)[2]
+    weights = 1 / avg_sigma**2
+    logging.info('Creating slice transform weights.')
+    data_utils.save(weights, os.path.expanduser(FLAGS.ckpt))
+    return
+
+  if FLAGS.mode != 'pca':
+    raise ValueError(f'Unsupported mode: {FLAGS.mode}')
+
+  dims_list = sorted(set(map(int, FLAGS.dims_list or [FLAGS.dims])))
+  count, mean, comoment = stream_moments(train_ds, FLAGS.stream_batch_size)
+
+  logging.info('Fitting transform with ranks %s.', dims_list)
+  pipelines, variance_gain = fit_streaming_pipelines(count, mean, comoment,
+                                                     dims_list,
+                                                     FLAGS.normalize)
+
+  curve_path = os.path.join(os.path.dirname(os.path.expanduser(FLAGS.ckpt)),
+                            'explained_variance.npy')
+  os.makedirs(os.path.dirname(curve_path) or '.', exist_ok=True)
+  np.save(curve_path, variance_gain)
+  logging.info('Saved explained variance curve to %s.', curve_path)
+
+  if FLAGS.compute_dims:
+    dims, variance = plot_variance_gain(variance_gain, FLAGS.var_threshold)
+    logging.info('Explained variance ratio: %f, Rank: %i.', variance, dims)
+
+  for dims, pipeline in pipelines.items():
+    path = checkpoint_path(FLAGS.ckpt, dims, len(pipelines))
+    data_utils.save(pipeline, path)
+    logging.info('Saved rank %i transform (explained variance %f) to %s.',
+                 dims, variance_gain[dims - 1], path)
+
+
 def main(argv):
   del argv  # unused
 
@@ -94,6 +287,10 @@ def main(argv):
       batch_size=2048,
       shuffle=True)
   train_ds = train_ds.take(FLAGS.samples)
+  if FLAGS.streaming:
+    streaming_main(train_ds, shape)
+    return
+
   train_ds = np.stack([ex['inputs'] for ex in tfds.as_numpy(train_ds)])
 
   if len(shape) == 2:
@@ -108,21 +305,10 @@ def main(argv):
     data_utils.save(weights, os.path.expanduser(FLAGS.ckpt))
     return -1
 
-  singular_values = np.linalg.svd(train_ds,
-                                  full_matrices=False,
-                                  compute_uv=False)
-  variance_gain = singular_values.cumsum() / singular_values.sum()
+  variance_gain = explained_variance_ratio(train_ds, FLAGS.normalize).cumsum()
 
   if FLAGS.compute_dims:
-    dims = np.where(variance_gain >= FLAGS.var_threshold)[0][0]
-    variance = variance_gain[dims]
-    plt.text(0, variance + 0.05, '{:.3f}'.format(variance), rotation=0)
-    plt.text(dims + 0.1, 0.2, dims, rotation=0)
-    plt.axhline(y=variance, color='r', linestyle='--')
-    plt.axvline(x=dims, color='r', linestyle='--')
-    plt.plot(variance_gain)
-    plt.show()
-
+    dims, variance = plot_variance_gain(variance_gain, FLAGS.var_threshold)
     logging.info('Explained variance ratio: %f, Rank: %i.', variance, dims)
 
   else:
@@ -15,7 +15,7 @@
 # Lint as: python3
 r"""Dataset generation."""
 
-import pickle
+import os
 
 from absl import app
 from absl import flags
@@ -28,6 +28,8 @@ import note_seq
 # from .. import config
 # from ..utils import song_utils
 import config
+from utils import data_utils
+from utils import pipeline_utils
 from utils import song_utils
 
 FLAGS = flags.FLAGS
@@ -46,24 +48,61 @@ flags.DEFINE_enum('mode', 'melody', ['melody', 'multitrack'],
                   'Data generation mode.')
 flags.DEFINE_string('input', None, 'Path to tfrecord files.')
 flags.DEFINE_string('output', None, 'Output path.')
+flags.DEFINE_string(
+    'split', None,
+    'Split name of the output in the manifest (default: train or eval if the '
+    'output name contains it).')
+flags.DEFINE_integer('num_shards', 64, 'Number of output shards.')
+
+# Batching
+flags.DEFINE_integer('encode_batch_size', 8,
+                     'Number of chunks per MusicVAE encoder batch.')
+flags.DEFINE_integer('max_songs_per_batch', 64,
+                     'Maximum number of NoteSequences encoded together.')
+
+# Embedding cache
+flags.DEFINE_string(
+    'embedding_cache', None,
+    'Path to a sqlite file caching song embeddings across runs. Songs that '
+    'were encoded before with the same model are not encoded again.')
+flags.DEFINE_float('embedding_cache_size_gb', 16.,
+                   'Maximum size of the embedding cache.')
 
 
 class EncodeSong(beam.DoFn):
-  """Encode song into MusicVAE embeddings."""
+  """Encode batches of songs into MusicVAE embeddings.
+
+  The chunks of all songs in a batch are encoded with a single call to the
+  model and split back into one embedding matrix per song.
+  """
 
   def setup(self):
     logging.info('Loading pre-trained model %s', FLAGS.model)
     self.model_config = config.MUSIC_VAE_CONFIG[FLAGS.model]
     self.model = TrainedModel(self.model_config,
-                              batch_size=8,
+                              batch_size=FLAGS.encode_batch_size,
                               checkpoint_dir_or_path=FLAGS.checkpoint)
 
-  def process(self, ns):
+    self.cache = None
+    if FLAGS.embedding_cache:
+      namespace = '{}:{}'.format(
+          FLAGS.model, song_utils.checkpoint_fingerprint(FLAGS.checkpoint))
+      self.cache = song_utils.EmbeddingCache(
+          FLAGS.embedding_cache,
+          namespace=namespace,
+          max_bytes=int(FLAGS.embedding_cache_size_gb * 2**30))
+
+  def teardown(self):
+    if self.cache is not None:
+      self.cache.close()
+
+  def songs(self, ns):
+    """Converts a NoteSequence into the Song objects to encode."""
     logging.info('Processing %s::%s (%f)', ns.id, ns.filename, ns.total_time)
     if ns.total_time > 60 * 60:
       logging.info('Skipping notesequence with >1 hour duration')
       Metrics.counter('EncodeSong', 'skipped_long_song').inc()
-      return
+      return []
 
     Metrics.counter('EncodeSong', 'encoding_song').inc()
 
@@ -72,35 +111,48 @@ class EncodeSong(beam.DoFn):
       melodies = song_utils.extract_melodies(ns)
       if not melodies:
         Metrics.counter('EncodeSong', 'extracted_no_melodies').inc()
-        return
+        return []
       Metrics.counter('EncodeSong', 'extracted_melody').inc(len(melodies))
-      songs = [
+      return [
           song_utils.Song(melody, self.model_config.data_converter,
                           chunk_length) for melody in melodies
       ]
-      encoding_matrices = song_utils.encode_songs(self.model, songs)
     elif FLAGS.mode == 'multitrack':
       chunk_length = 1
       song = song_utils.Song(ns,
                              self.model_config.data_converter,
                              chunk_length,
                              multitrack=True)
-      encoding_matrices = song_utils.encode_songs(self.model, [song])
+      return [song]
     else:
       raise ValueError(f'Unsupported mode: {FLAGS.mode}')
 
+  def process(self, note_sequences):
+    songs = [song for ns in note_sequences for song in self.songs(ns)]
+    if not songs:
+      return
+
+    Metrics.counter('EncodeSong', 'encoding_batch').inc()
+    encoding_matrices = song_utils.encode_songs(self.model,
+                                                songs,
+                                                cache=self.cache)
+
     for matrix in encoding_matrices:
       assert matrix.shape[0] == 3 and matrix.shape[-1] == 512
       if matrix.shape[1] == 0:
         Metrics.counter('EncodeSong', 'skipped_matrix').inc()
         continue
       Metrics.counter('EncodeSong', 'encoded_matrix').inc()
-      yield pickle.dumps(matrix)
+      yield data_utils.serialize_array(matrix)
 
 
 def main(argv):
   del argv  # unused
 
+  # Resolved here, since flags are not parsed on remote workers.
+  output = os.path.expanduser(FLAGS.output)
+  split = pipeline_utils.manifest_split(output, FLAGS.split)
+
   pipeline_options = beam.options.pipeline_options.PipelineOptions(
       FLAGS.pipeline_options.split(','))
 
@@ -110,9 +162,10 @@ def main(argv):
     p |= 'read_tfrecord' >> beam.io.tfrecordio.ReadAllFromTFRecord(
         coder=beam.coders.ProtoCoder(note_seq.NoteSequence))
     p |= 'shuffle_input' >> beam.Reshuffle()
+    p |= 'batch_songs' >> beam.BatchElements(
+        min_batch_size=1, max_batch_size=FLAGS.max_songs_per_batch)
     p |= 'encode_song' >> beam.ParDo(EncodeSong())
-    p |= 'shuffle_output' >> beam.Reshuffle()
-    p |= 'write' >> beam.io.WriteToTFRecord(FLAGS.output)
+    pipeline_utils.write_tfrecords(p, output, split, FLAGS.num_shards)
 
 
 if __name__ == '__main__':
@@ -15,7 +15,7 @@
 # Lint as: python3
 r"""Dataset generation."""
 
-import pickle
+import os
 
 from absl import app
 from absl import flags
@@ -39,12 +39,16 @@ except ImportError:
 # Use absolute import if running with -m, or adjust path if necessary
 try:
   import config
+  from utils import data_utils
+  from utils import pipeline_utils
   from utils import song_utils
 except ImportError:
     # Fallback for direct script execution (might cause issues with relative imports)
     logging.warning("Could not perform relative import. "
                     "Trying direct import (may fail if not run with -m).")
     import config
+    from utils import data_utils
+    from utils import pipeline_utils
     from utils import song_utils
 
 
@@ -63,7 +67,38 @@ flags.DEFINE_string('checkpoint', None, 'Path to the MusicVAE model checkpoint.'
 flags.DEFINE_enum('mode', 'melody', ['melody', 'multitrack'],
                   'Data generation mode.')
 flags.DEFINE_string('input', None, 'Path or pattern to input TFRecord files (containing NoteSequences).')
-flags.DEFINE_string('output', None, 'Output path for TFRecord files (containing pickled encoding matrices).')
+flags.DEFINE_string('output', None, 'Output path for TFRecord files (containing encoding matrices in .npy format).')
+flags.DEFINE_string(
+    'split', None,
+    'Split name of the output in the manifest (default: train or eval if the '
+    'output name contains it).')
+
+# Batching
+flags.DEFINE_integer('encode_batch_size', 64,
+                     'Number of chunks per MusicVAE encoder batch.')
+flags.DEFINE_integer('max_songs_per_batch', 64,
+                     'Maximum number of NoteSequences encoded together.')
+
+# Embedding cache
+flags.DEFINE_string(
+    'embedding_cache', None,
+    'Path to a sqlite file caching song embeddings across runs. Songs that '
+    'were encoded before with the same model are not encoded again.')
+flags.DEFINE_float('embedding_cache_size_gb', 16.,
+                   'Maximum size of the embedding cache.')
+
+# Local runner
+flags.DEFINE_enum(
+    'runner', 'beam', ['beam', 'local'],
+    'Run with a Beam pipeline or with a local pool of worker processes, each '
+    'holding its own model.')
+flags.DEFINE_integer('num_workers', None,
+                     'Number of local worker processes (default: CPU count).')
+flags.DEFINE_integer(
+    'num_shards', None,
+    'Number of output shards (default: num_workers locally, 64 with Beam).')
+flags.DEFINE_integer('queue_size', 256,
+                     'Maximum number of pending batches in the local queues.')
 
 # Add required flags check
 flags.mark_flag_as_required('input')
@@ -72,7 +107,13 @@ flags.mark_flag_as_required('checkpoint')
 
 
 class EncodeSong(beam.DoFn):
-  """Encode song (NoteSequence protos) into MusicVAE embeddings (pickled numpy arrays)."""
+  """Encode batches of songs (NoteSequence protos) into MusicVAE embeddings (serialized numpy arrays).
+
+  The chunks of all songs in a batch are encoded with a single model call and
+  split back into one embedding matrix per song. If the batched call fails,
+  the songs are encoded one NoteSequence at a time so a single bad song only
+  loses itself.
+  """
 
   def setup(self):
     logging.info('Loading pre-trained model config: %s', FLAGS.model)
@@ -83,81 +124,122 @@ class EncodeSong(beam.DoFn):
 
     logging.info('Loading model checkpoint from: %s', FLAGS.checkpoint)
     self.model = TrainedModel(self.model_config,
-                              batch_size=1, # Process one NoteSequence at a time
+                              batch_size=FLAGS.encode_batch_size,
                               checkpoint_dir_or_path=FLAGS.checkpoint)
-    # Initialize counters here if needed, or rely on process method
-    # self.skipped_long_counter = Metrics.counter('EncodeSong', 'skipped_long_song')
-    # self.no_melodies_counter = Metrics.counter('EncodeSong', 'extracted_no_melodies')
-    # ... etc
 
-  def process(self, ns_proto):
+    self.cache = None
+    if FLAGS.embedding_cache:
+      namespace = '{}:{}'.format(
+          FLAGS.model, song_utils.checkpoint_fingerprint(FLAGS.checkpoint))
+      self.cache = song_utils.EmbeddingCache(
+          FLAGS.embedding_cache,
+          namespace=namespace,
+          max_bytes=int(FLAGS.embedding_cache_size_gb * 2**30))
+
+  def teardown(self):
+    if self.cache is not None:
+      self.cache.close()
+
+  def songs(self, ns_proto):
+    """Decodes a NoteSequence proto into the Song objects to encode."""
     # Decode the NoteSequence proto
     try:
       ns = note_seq.NoteSequence.FromString(ns_proto)
     except Exception as e: # Catch potential decoding errors
       logging.error("Failed to decode NoteSequence proto: %s", e)
       Metrics.counter('EncodeSong', 'failed_decode').inc()
-      return
+      return []
 
     logging.debug('Processing %s::%s (%f)', ns.id, ns.filename, ns.total_time)
     if ns.total_time > 60 * 60:
       logging.info('Skipping notesequence with >1 hour duration: %s', ns.filename)
       Metrics.counter('EncodeSong', 'skipped_long_song').inc()
-      return
+      return []
 
     Metrics.counter('EncodeSong', 'attempted_encoding').inc()
 
     try:
+      # Default chunk length might be defined in config or constants
+      chunk_length = self.model_config.hparams.max_seq_len // 16 # Example: typically 16 steps per bar
       if FLAGS.mode == 'melody':
-        # Default chunk length might be defined in config or constants
-        chunk_length = self.model_config.hparams.max_seq_len // 16 # Example: typically 16 steps per bar
         melodies = song_utils.extract_melodies(ns)
         if not melodies:
           Metrics.counter('EncodeSong', 'extracted_no_melodies').inc()
-          return
+          return []
         Metrics.counter('EncodeSong', 'extracted_melody').inc(len(melodies))
         # Ensure data_converter is correctly accessed
-        songs = [
+        return [
             song_utils.Song(melody, self.model_config.data_converter,
                             chunk_length) for melody in melodies
         ]
-        encoding_matrices = song_utils.encode_songs(self.model, songs)
       elif FLAGS.mode == 'multitrack':
-        # Default chunk length might be defined in config or constants
-        chunk_length = self.model_config.hparams.max_seq_len // 16 # Example
-        song = song_utils.Song(ns,
-                               self.model_config.data_converter,
-                               chunk_length,
-                               multitrack=True)
-        encoding_matrices = song_utils.encode_songs(self.model, [song])
+        return [
+            song_utils.Song(ns,
+                            self.model_config.data_converter,
+                            chunk_length,
+                            multitrack=True)
+        ]
       else:
         # This case should ideally not be reached due to flags.DEFINE_enum
         raise ValueError(f'Unsupported mode: {FLAGS.mode}')
-
-      # Check encoding results and yield pickled data
-      for matrix in encoding_matrices:
-        # Add more robust shape check if needed, based on model output
-        if matrix is None or matrix.size == 0: # Check if encoding failed or result is empty
-             Metrics.counter('EncodeSong', 'skipped_empty_matrix').inc()
-             continue
-
-        # Example shape check (adapt based on your model's expected output dimensions)
-        expected_embedding_dim = self.model_config.hparams.z_size
-        if len(matrix.shape) < 2 or matrix.shape[-1] != expected_embedding_dim:
-            logging.warning(f"Unexpected matrix shape: {matrix.shape}, expected embedding dim: {expected_embedding_dim}")
-            Metrics.counter('EncodeSong', 'skipped_invalid_shape').inc()
-            continue
-
-        if matrix.shape[1] == 0: # Check if sequence length is zero
-          Metrics.counter('EncodeSong', 'skipped_zero_length_matrix').inc()
+    except Exception as e:
+      logging.error(f"Error preparing song {ns.filename}: {e}", exc_info=True)
+      Metrics.counter('EncodeSong', 'encoding_error').inc()
+      return []
+
+  def encode(self, songs):
+    """Encodes songs and yields their serialized embedding matrices."""
+    encoding_matrices = song_utils.encode_songs(self.model,
+                                                songs,
+                                                cache=self.cache)
+
+    # Check encoding results and yield serialized data
+    for matrix in encoding_matrices:
+      # Add more robust shape check if needed, based on model output
+      if matrix is None or matrix.size == 0: # Check if encoding failed or result is empty
+           Metrics.counter('EncodeSong', 'skipped_empty_matrix').inc()
+           continue
+
+      # Example shape check (adapt based on your model's expected output dimensions)
+      expected_embedding_dim = self.model_config.hparams.z_size
+      if len(matrix.shape) < 2 or matrix.shape[-1] != expected_embedding_dim:
+          logging.warning(f"Unexpected matrix shape: {matrix.shape}, expected embedding dim: {expected_embedding_dim}")
+          Metrics.counter('EncodeSong', 'skipped_invalid_shape').inc()
           continue
 
-        Metrics.counter('EncodeSong', 'encoded_matrix_success').inc()
-        yield pickle.dumps(matrix)
+      if matrix.shape[1] == 0: # Check if sequence length is zero
+        Metrics.counter('EncodeSong', 'skipped_zero_length_matrix').inc()
+        continue
+
+      Metrics.counter('EncodeSong', 'encoded_matrix_success').inc()
+      yield data_utils.serialize_array(matrix)
+
+  def process(self, ns_protos):
+    song_groups = [self.songs(ns_proto) for ns_proto in ns_protos]
+    songs = [song for group in song_groups for song in group]
+    if not songs:
+      return
 
+    try:
+      Metrics.counter('EncodeSong', 'encoding_batch').inc()
+      # Materialize so that failures are caught before anything is yielded
+      encoded = list(self.encode(songs))
     except Exception as e:
-        logging.error(f"Error encoding song {ns.filename}: {e}", exc_info=True)
-        Metrics.counter('EncodeSong', 'encoding_error').inc()
+      logging.error(f"Error encoding batch of {len(songs)} songs, retrying "
+                    f"one NoteSequence at a time: {e}")
+      Metrics.counter('EncodeSong', 'batch_encoding_error').inc()
+      encoded = []
+      for group in song_groups:
+        if not group:
+          continue
+        try:
+          encoded.extend(list(self.encode(group)))
+        except Exception as e:
+          logging.error(f"Error encoding song: {e}", exc_info=True)
+          Metrics.counter('EncodeSong', 'encoding_error').inc()
+
+    for serialized in encoded:
+      yield serialized
 
 
 def main(argv):
@@ -172,6 +254,23 @@ def main(argv):
   logging.info("Input: %s", FLAGS.input)
   logging.info("Output: %s", FLAGS.output)
 
+  # Resolved here, since flags are not parsed on remote workers.
+  output = os.path.expanduser(FLAGS.output)
+  split = pipeline_utils.manifest_split(output, FLAGS.split)
+  write_manifest = lambda shards: pipeline_utils.write_manifest(
+      shards, output, split)
+
+  if FLAGS.runner == 'local':
+    pipeline_utils.run_local(EncodeSong,
+                             pipeline_utils.read_tfrecords(FLAGS.input),
+                             output,
+                             num_workers=FLAGS.num_workers,
+                             num_shards=FLAGS.num_shards,
+                             queue_size=FLAGS.queue_size,
+                             batch_size=FLAGS.max_songs_per_batch,
+                             manifest_fn=write_manifest)
+    logging.info("Local run finished.")
+    return
 
   pipeline_options = beam.options.pipeline_options.PipelineOptions(
       FLAGS.pipeline_options.split(','))
@@ -190,14 +289,15 @@ def main(argv):
         # but EncodeSong currently decodes internally. Keep as raw bytes.)
         # | 'DecodeProto' >> beam.Map(note_seq.NoteSequence.FromString) # Keep commented if EncodeSong handles bytes
         | 'shuffle_input' >> beam.Reshuffle()
-        | 'encode_song' >> beam.ParDo(EncodeSong()) # Input is raw proto bytes, output is pickled bytes
-        | 'shuffle_output' >> beam.Reshuffle()
+        | 'batch_songs' >> beam.BatchElements(
+            min_batch_size=1, max_batch_size=FLAGS.max_songs_per_batch)
+        | 'encode_song' >> beam.ParDo(EncodeSong()) # Input is lists of raw proto bytes, output is .npy bytes
     )
 
-    # Write the pickled numpy arrays (bytes) to the output TFRecord
-    _ = encoded_data | 'WriteOutputTFRecord' >> beam.io.WriteToTFRecord(
-                                                    FLAGS.output)
-                                                    # No coder needed, writing raw bytes
+    # Write the serialized numpy arrays (bytes) to the output TFRecord shards
+    # and record their paths, record counts and checksums in the manifest
+    pipeline_utils.write_tfrecords(encoded_data, output, split,
+                                   FLAGS.num_shards or 64)
 
   logging.info("Pipeline finished.")
 
@@ -17,8 +17,8 @@
 for a model.
 """
 import glob
+import multiprocessing
 import os
-import pickle
 import sys
 
 from absl import app
@@ -39,8 +39,15 @@ flags.DEFINE_string('encoded_data', '~/data/encoded_lmd',
                     'Path to encoded data TFRecord directory.')
 flags.DEFINE_string('output_path', './output/transform/', 'Output directory.')
 flags.DEFINE_integer('shard_size', 2**17, 'Number of vectors per shard.')
-flags.DEFINE_enum('output_format', 'tfrecord', ['tfrecord', 'pkl'],
-                  'Shard file type.')
+flags.DEFINE_enum('output_format', 'tfrecord', ['tfrecord', 'pkl', 'latents'],
+                  'Shard file type. `latents` writes one memory-mapped latent '
+                  'store per split instead of shards.')
+flags.DEFINE_enum('latent_dtype', 'float32', ['float16', 'float32'],
+                  'Data type of vectors in a latent store.')
+flags.DEFINE_boolean(
+    'allow_pickle', False,
+    'Read legacy encoded datasets that contain pickled arrays. Only enable '
+    'this for data from a trusted source.')
 
 flags.DEFINE_enum('mode', 'flatten', ['flatten', 'sequences', 'decoded'],
                   'Transformation mode.')
@@ -50,8 +57,20 @@ flags.DEFINE_integer('context_length', 4,
 flags.DEFINE_integer('stride', 1, 'The stride used for generating sequences.')
 flags.DEFINE_integer('max_songs', None,
                      'The maximum number of songs to process.')
+flags.DEFINE_integer(
+    'num_workers', None,
+    'Number of processes serializing shards (default: CPU count). Use 1 to '
+    'write shards in the main process.')
+flags.DEFINE_integer('max_pending_shards', None,
+                     'Maximum number of shards buffered for writing '
+                     '(default: as many as fit in --max_pending_mb, at most '
+                     'twice the number of workers).')
+flags.DEFINE_integer('max_pending_mb', 2048,
+                     'Memory budget for shards buffered for writing, used '
+                     'when --max_pending_shards is not set.')
 flags.DEFINE_integer('max_examples', None,
-                     'The maximum number of examples to process.')
+                     'The maximum number of examples to process. For latent '
+                     'stores this is the maximum number of vectors.')
 
 
 def _bytes_feature(value):
@@ -103,12 +122,11 @@ def _serialize_tf_shard(shard, output_path):
   logging.info('Saved to %s', output_path)
 
 
-def save_shard(contexts, targets, output_path):
+def save_shard(contexts, targets, output_path, manifest_shards=None):
   if FLAGS.mode == 'flatten' or FLAGS.mode == 'decoded':
     shard = targets[:FLAGS.shard_size]
 
-    shard_type = np.bool if FLAGS.mode == 'decoded' else np.float32
-    shard = np.stack(shard).astype(shard_type)
+    shard = np.stack(shard).astype(_shard_dtype())
 
     targets = targets[FLAGS.shard_size:]
   elif FLAGS.mode == 'sequences':
@@ -129,9 +147,169 @@ def save_shard(contexts, targets, output_path):
   elif FLAGS.output_format == 'tfrecord':
     _serialize_tf_shard(shard, output_path)
 
+  if manifest_shards is not None:
+    inputs = shard[0] if FLAGS.mode == 'sequences' else shard
+    manifest_shards.append({
+        'path': os.path.basename(output_path),
+        'num_records': len(inputs),
+        'element_shape': inputs.shape[1:],
+        'dtype': inputs.dtype.name
+    })
+
+  return contexts, targets
+
+
+def write_manifest(split, manifest_shards):
+  """Records the shards written for a split in the output manifest."""
+  if not manifest_shards:
+    return
+  data_utils.write_shard_manifest(
+      FLAGS.output_path,
+      split, [{
+          'path': shard['path'],
+          'num_records': shard['num_records']
+      } for shard in manifest_shards],
+      element_shape=manifest_shards[0]['element_shape'],
+      dtype=manifest_shards[0]['dtype'],
+      data_format=FLAGS.output_format)
+
+
+def _shard_dtype():
+  return np.bool if FLAGS.mode == 'decoded' else np.float32
+
+
+def _init_worker(argv):
+  flags.FLAGS(argv, known_only=True)
+
+
+def _write_shard(args):
+  contexts, targets, output_path = args
+  manifest_shards = []
+  save_shard(contexts, targets, output_path, manifest_shards=manifest_shards)
+  return manifest_shards
+
+
+class ShardWriter(object):
+  """Buffers examples and writes them in shards of --shard_size examples.
+
+  Shards are serialized by an optional pool of processes. At most
+  max_pending shards are in flight at a time, which bounds memory use. If
+  max_pending is None, it is derived from the size of the first shard so
+  that the pending shards fit in max_pending_bytes.
+  """
+
+  def __init__(self,
+               output_fp,
+               pool=None,
+               max_pending=None,
+               max_pending_bytes=2**31,
+               max_pending_limit=None):
+    self.output_fp = output_fp
+    self.pool = pool
+    self.max_pending = max_pending
+    self.max_pending_bytes = max_pending_bytes
+    self.max_pending_limit = max_pending_limit
+    self.contexts, self.targets = [], []
+    self.size = 0
+    self.count = 0
+    self.pending = []
+    self.manifest_shards = []
+
+  def add(self, contexts, targets):
+    """Adds a batch of examples with a leading example axis."""
+    if len(targets) == 0:
+      return
+    # Buffer in the shard dtype, which is also what is sent to the workers.
+    if contexts is not None:
+      self.contexts.append(np.asarray(contexts, _shard_dtype()))
+    self.targets.append(np.asarray(targets, _shard_dtype()))
+    self.size += len(targets)
+    while self.size >= FLAGS.shard_size:
+      self._write(FLAGS.shard_size)
+
+  def _write(self, size):
+    contexts = np.concatenate(self.contexts) if self.contexts else None
+    targets = np.concatenate(self.targets)
+    self.contexts = [] if contexts is None else [contexts[size:].copy()]
+    self.targets = [targets[size:].copy()]
+    self.size = len(self.targets[0])
+
+    args = (None if contexts is None else contexts[:size], targets[:size],
+            self.output_fp.format(self.count))
+    self.count += 1
+    if self.pool is None:
+      self.manifest_shards.extend(_write_shard(args))
+      return
+    if self.max_pending is None:
+      shard_bytes = sum(x.nbytes for x in args[:2] if x is not None)
+      self.max_pending = max(1, self.max_pending_bytes // max(shard_bytes, 1))
+      if self.max_pending_limit is not None:
+        self.max_pending = min(self.max_pending, self.max_pending_limit)
+      logging.info('Buffering at most %i shards of %i bytes.',
+                   self.max_pending, shard_bytes)
+    self.pending.append(self.pool.apply_async(_write_shard, (args,)))
+    while len(self.pending) >= self.max_pending:
+      self.manifest_shards.extend(self.pending.pop(0).get())
+
+  def close(self):
+    """Writes the remaining examples and waits for all shards."""
+    if self.size > 0:
+      self._write(self.size)
+    for result in self.pending:
+      self.manifest_shards.extend(result.get())
+    self.pending = []
+    return self.manifest_shards
+
+
+def extract_vectors(song, remove_zeros=True, eps=1e-6):
+  """Returns the vectors of a song, optionally without zero vectors."""
+  if remove_zeros:
+    song = song[np.linalg.norm(song, axis=-1) >= eps]
+  return song
+
+
+def extract_windows(song, ctx_window, stride=1, remove_zeros=True, eps=1e-6):
+  """Extracts (context, next vector) pairs from strided views of a song.
+
+  Args:
+    song: Matrix of shape (length, dims).
+    ctx_window: Length of each context window.
+    stride: Distance between the starts of consecutive windows.
+    remove_zeros: Whether to drop windows whose context contains a zero
+        vector.
+
+  Returns:
+    contexts: Array of shape (num_windows, ctx_window, dims).
+    targets: Array of shape (num_windows, dims) with the vector following
+        each context.
+  """
+  num_windows = len(song) - ctx_window
+  if num_windows <= 0:
+    return (np.zeros((0, ctx_window, song.shape[-1]), song.dtype),
+            np.zeros((0, song.shape[-1]), song.dtype))
+
+  starts = np.arange(0, num_windows, stride)
+  if remove_zeros:
+    # Number of zero vectors before each position.
+    zeros = np.concatenate(
+        ([0], np.cumsum(np.linalg.norm(song, axis=-1) < eps)))
+    starts = starts[zeros[starts + ctx_window] == zeros[starts]]
+
+  windows = np.lib.stride_tricks.sliding_window_view(song, ctx_window, axis=0)
+  contexts = np.swapaxes(windows[starts], 1, 2)
+  targets = song[starts + ctx_window]
   return contexts, targets
 
 
+def split_at_zeros(song, eps=1e-6):
+  """Splits a sequence into the maximal segments without zero vectors."""
+  nonzero = np.linalg.norm(song, axis=-1) >= eps
+  if nonzero.all():
+    return [song]
+  edges = np.flatnonzero(np.diff(np.concatenate(([0], nonzero, [0]))))
+  return [song[start:end] for start, end in zip(edges[::2], edges[1::2])]
+
+
 def toy_distribution_fn(batch_size=512):
   """Samples from a 0.2 * N(-5, 1) + 0.8 * N(5, 1)."""
 
@@ -157,6 +335,58 @@ def toy_sequence_distribution_fn(trajectory_length=10, batch_size=512):
   return center + deltas
 
 
+def write_latent_store(ds, output_path):
+  """Writes the full VAE embedding of every song to a latent store.
+
+  Windows of any length are sampled at training time, so songs are stored as
+  whole sequences. With --remove_zeros, songs are split at zero vectors so
+  that no window contains one.
+  """
+  if FLAGS.max_songs is not None:
+    ds = ds.take(FLAGS.max_songs)
+
+  writer = None
+  num_vectors = 0
+  for song_data in ds.as_numpy_iterator():
+    song_embeddings = song_data[0]
+    assert song_embeddings.ndim == 3 and song_embeddings.shape[0] == 3
+    song = song_embeddings[0]
+
+    if FLAGS.toy_data:
+      song = toy_distribution_fn(batch_size=len(song))
+
+    if writer is None:
+      writer = data_utils.LatentStoreWriter(output_path,
+                                            dim=song.shape[-1],
+                                            dtype=FLAGS.latent_dtype)
+
+    segments = split_at_zeros(song) if FLAGS.remove_zeros else [song]
+    for segment in segments:
+      if FLAGS.max_examples is not None:
+        segment = segment[:FLAGS.max_examples - num_vectors]
+      writer.append(segment)
+      num_vectors += len(segment)
+
+    if FLAGS.max_examples is not None and num_vectors >= FLAGS.max_examples:
+      break
+
+  if writer is None:
+    logging.warning('No songs found for %s', output_path)
+    return
+  writer.close()
+
+  data_utils.write_shard_manifest(os.path.dirname(output_path),
+                                  os.path.basename(output_path),
+                                  [{
+                                      'path': os.path.basename(
+                                          f'{output_path}.latents'),
+                                      'num_records': writer.offsets[-1]
+                                  }],
+                                  element_shape=(writer.dim,),
+                                  dtype=writer.dtype.name,
+                                  data_format='latents')
+
+
 def main(argv):
   del argv  # unused
 
@@ -171,27 +401,44 @@ def main(argv):
   eval_files = glob.glob(os.path.expanduser(eval_glob))
 
   tensor_shape = [tf.float64]
-  train_dataset = tf.data.TFRecordDataset(
-      train_files).map(lambda x: tf.py_function(
-          lambda binary: pickle.loads(binary.numpy()), [x], tensor_shape),
-                       num_parallel_calls=tf.data.experimental.AUTOTUNE)
-  eval_dataset = tf.data.TFRecordDataset(
-      eval_files).map(lambda x: tf.py_function(
-          lambda binary: pickle.loads(binary.numpy()), [x], tensor_shape),
-                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  deserialize = lambda binary: data_utils.deserialize_array(
+      binary.numpy(), allow_pickle=FLAGS.allow_pickle).astype(np.float64)
+  train_dataset = tf.data.TFRecordDataset(train_files).map(
+      lambda x: tf.py_function(deserialize, [x], tensor_shape),
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  eval_dataset = tf.data.TFRecordDataset(eval_files).map(
+      lambda x: tf.py_function(deserialize, [x], tensor_shape),
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+  if FLAGS.output_format == 'latents':
+    assert FLAGS.mode != 'decoded', 'Latent stores hold encoded vectors only.'
+    for ds, split in [(train_dataset, 'train'), (eval_dataset, 'eval')]:
+      write_latent_store(ds, f'{FLAGS.output_path}/{split}')
+    return
 
   ctx_window = FLAGS.context_length
   stride = FLAGS.stride
 
+  num_workers = FLAGS.num_workers or os.cpu_count()
+  pool = None
+  if num_workers > 1:
+    # Spawn fresh interpreters, since TensorFlow is not fork-safe.
+    pool = multiprocessing.get_context('spawn').Pool(num_workers,
+                                                     initializer=_init_worker,
+                                                     initargs=(sys.argv,))
+
   for ds, split in [(train_dataset, 'train'), (eval_dataset, 'eval')]:
     if FLAGS.max_songs is not None:
       ds = ds.take(FLAGS.max_songs)
 
-    output_fp = '{}/{}-{:04d}'
-    contexts, targets = [], []
-    count = 0
+    output_fp = f'{FLAGS.output_path}/{split}-' + '{:04d}'
+    writer = ShardWriter(output_fp,
+                         pool=pool,
+                         max_pending=FLAGS.max_pending_shards,
+                         max_pending_bytes=FLAGS.max_pending_mb * 2**20,
+                         max_pending_limit=2 * num_workers)
     discard = 0
-    example_count, should_terminate = 0, False
+    example_count = 0
     for song_data in ds.as_numpy_iterator():
       song_embeddings = song_data[0]
 
@@ -213,48 +460,37 @@ def main(argv):
         song = np.concatenate((song, padding))
         assert song.shape[0] == 1024 and song.ndim == 2
 
-      if FLAGS.mode == 'decoded':
-        example_count += 1
-        targets.append(song)
-
-      if FLAGS.toy_data:
+      if FLAGS.toy_data and FLAGS.mode != 'decoded':
         song = toy_distribution_fn(batch_size=len(song))
 
-      if FLAGS.mode == 'flatten':
-        for vec in song:
-          if FLAGS.remove_zeros and np.linalg.norm(vec) < 1e-6:
-            continue
-          if FLAGS.max_examples is not None and example_count >= FLAGS.max_examples:
-            should_terminate = True
-            break
-          example_count += 1
-          targets.append(vec)
+      contexts = None
+      if FLAGS.mode == 'decoded':
+        targets = song[np.newaxis]
+      elif FLAGS.mode == 'flatten':
+        targets = extract_vectors(song, remove_zeros=FLAGS.remove_zeros)
       elif FLAGS.mode == 'sequences':
-        for i in range(0, len(song) - ctx_window, stride):
-          context = song[i:i + ctx_window]
-          if FLAGS.remove_zeros and np.where(
-              np.linalg.norm(context, axis=1) < 1e-6)[0].any():
-            continue
-          if FLAGS.max_examples is not None and example_count >= FLAGS.max_examples:
-            should_terminate = True
-            break
-          example_count += 1
-          contexts.append(context)
-          targets.append(song[i + ctx_window])
-
-      if len(targets) >= FLAGS.shard_size:
-        contexts, targets = save_shard(
-            contexts, targets, output_fp.format(FLAGS.output_path, split,
-                                                count))
-        count += 1
-
-      if should_terminate:
+        contexts, targets = extract_windows(song,
+                                            ctx_window,
+                                            stride=stride,
+                                            remove_zeros=FLAGS.remove_zeros)
+
+      if FLAGS.max_examples is not None:
+        remaining = FLAGS.max_examples - example_count
+        targets = targets[:remaining]
+        contexts = None if contexts is None else contexts[:remaining]
+
+      example_count += len(targets)
+      writer.add(contexts, targets)
+
+      if FLAGS.max_examples is not None and example_count >= FLAGS.max_examples:
         break
 
     logging.info(f'Discarded {discard} invalid sequences.')
-    if len(targets) > 0:
-      save_shard(contexts, targets,
-                 output_fp.format(FLAGS.output_path, split, count))
+    write_manifest(split, writer.close())
+
+  if pool is not None:
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
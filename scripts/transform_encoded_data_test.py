@@ -0,0 +1,59 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for transform_encoded_data."""
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+
+from scripts import transform_encoded_data
+
+
+def _naive_windows(song, ctx_window, stride, remove_zeros, eps=1e-6):
+  contexts, targets = [], []
+  for start in range(0, len(song) - ctx_window, stride):
+    context = song[start:start + ctx_window]
+    if remove_zeros and np.any(np.linalg.norm(context, axis=-1) < eps):
+      continue
+    contexts.append(context)
+    targets.append(song[start + ctx_window])
+  return np.array(contexts), np.array(targets)
+
+
+class ExtractWindowsTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.song = np.random.RandomState(0).randn(20, 3)
+    self.song[[5, 6, 13]] = 0.
+
+  @parameterized.product(stride=[1, 2, 3], remove_zeros=[True, False])
+  def test_matches_naive_loop(self, stride, remove_zeros):
+    contexts, targets = transform_encoded_data.extract_windows(
+        self.song, 4, stride=stride, remove_zeros=remove_zeros)
+    expected_contexts, expected_targets = _naive_windows(
+        self.song, 4, stride, remove_zeros)
+    np.testing.assert_array_equal(contexts, expected_contexts)
+    np.testing.assert_array_equal(targets, expected_targets)
+
+  def test_short_song(self):
+    contexts, targets = transform_encoded_data.extract_windows(
+        self.song[:4], 4)
+    self.assertEqual(contexts.shape, (0, 4, 3))
+    self.assertEqual(targets.shape, (0, 3))
+
+
+if __name__ == '__main__':
+  absltest.main()
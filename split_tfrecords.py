@@ -1,11 +1,14 @@
 import tensorflow as tf
 import os
 import glob
-import random
+import hashlib
+import multiprocessing
 from absl import app
 from absl import flags
 from absl import logging
 
+import utils.data_utils as data_utils
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string('input_dir', None,
@@ -19,9 +22,126 @@ flags.DEFINE_float('train_split_ratio', 0.8,
 # flags.DEFINE_string('eval_filename_prefix', 'eval',   # 削除
 #                     'Prefix for evaluation TFRecord files.')
 flags.DEFINE_integer('shard_size', 10000,
-                     'Approximate number of records per output shard file.')
+                     'Number of records per output shard file (the last '
+                     'shard of each split may be smaller).')
 flags.DEFINE_integer('random_seed', 42,
-                     'Random seed for shuffling the file list (optional).')
+                     'Seed of the hash that assigns records to splits.')
+flags.DEFINE_integer('num_workers', None,
+                     'Number of parallel worker processes (default: CPU count).')
+
+SPLIT_PREFIXES = {'train': 'training_seqs', 'eval': 'eval_seqs'}
+
+
+def assign_split(record, train_split_ratio, seed):
+    """レコードの内容のハッシュから train / eval を決定的に割り当てる。"""
+    salt = str(seed).encode('utf-8')[:hashlib.blake2b.SALT_SIZE]
+    digest = hashlib.blake2b(record, digest_size=8, salt=salt).digest()
+    return 'train' if int.from_bytes(digest, 'little') < train_split_ratio * 2**64 else 'eval'
+
+
+class SplitWriter(object):
+    """split ごとに shard_size 件ずつの一時シャードを書き出す。
+
+    複数の入力ファイルにまたがって使うため、ファイル数が多くても
+    小さなシャードが大量にできることはない。
+    """
+
+    def __init__(self, output_dir, name, shard_size):
+        self.output_dir = output_dir
+        self.name = name
+        self.shard_size = shard_size
+        self.writers, self.paths, self.counts, self.parts = {}, {}, {}, {}
+        self.shards = []  # 書き終えたシャード
+        self.tmp_paths = []  # 作成したすべての一時ファイル
+
+    def write(self, split, record):
+        if split in self.writers and self.counts[split] >= self.shard_size:
+            self.close(split)
+        if split not in self.writers:
+            part = self.parts.get(split, 0)
+            self.parts[split] = part + 1
+            self.paths[split] = os.path.join(
+                self.output_dir,
+                f'.{SPLIT_PREFIXES[split]}-{self.name}-{part:04d}.tmp')
+            self.tmp_paths.append(self.paths[split])
+            self.writers[split] = tf.io.TFRecordWriter(self.paths[split])
+            self.counts[split] = 0
+        self.writers[split].write(record)
+        self.counts[split] += 1
+
+    def close(self, split):
+        self.writers.pop(split).close()
+        self.shards.append((split, self.paths[split], self.counts[split],
+                            data_utils.file_checksum(self.paths[split])))
+
+    def close_all(self):
+        for split in list(self.writers):
+            self.close(split)
+        return self.shards
+
+    def discard(self):
+        """書きかけ・書き終えたすべての一時ファイルを削除する。"""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        for tmp_path in self.tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def split_files(args):
+    """入力ファイルのグループを一時シャードに分割して書き出す。
+
+    Returns:
+        (split, 一時ファイルパス, レコード数, チェックサム) のリスト。
+        split ごとに最後の1つ以外は shard_size 件ちょうどになる。
+    """
+    group_idx, input_files, output_dir, train_split_ratio, shard_size, seed = args
+    writer = SplitWriter(output_dir, f'{group_idx:05d}', shard_size)
+    try:
+        for input_file in input_files:
+            for record in tf.data.TFRecordDataset(input_file).as_numpy_iterator():
+                writer.write(assign_split(record, train_split_ratio, seed), record)
+        shards = writer.close_all()
+    except BaseException:
+        # 失敗したワーカーの一時ファイルを残さない
+        writer.discard()
+        raise
+    logging.info(f"Split {len(input_files)} files into {len(shards)} shards.")
+    return shards
+
+
+def group_files(input_files, num_groups):
+    """ファイルサイズがなるべく均等になるよう入力ファイルをグループに分ける。"""
+    groups = [[] for _ in range(num_groups)]
+    sizes = [0] * num_groups
+    for input_file in sorted(input_files, key=os.path.getsize, reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append(input_file)
+        sizes[i] += os.path.getsize(input_file)
+    return [sorted(group) for group in groups if group]
+
+
+def merge_partial_shards(shards, output_dir, shard_size):
+    """shard_size 未満の一時シャード (各グループの端数) をまとめ直す。"""
+    full = [s for s in shards if s[2] >= shard_size]
+    partial = [s for s in shards if s[2] < shard_size]
+    if len(partial) <= 1:
+        return shards
+
+    writer = SplitWriter(output_dir, 'merged', shard_size)
+    try:
+        for split, tmp_path, _, _ in partial:
+            for record in tf.data.TFRecordDataset(tmp_path).as_numpy_iterator():
+                writer.write(split, record)
+        merged = writer.close_all()
+    except BaseException:
+        writer.discard()
+        raise
+    for _, tmp_path, _, _ in partial:
+        os.remove(tmp_path)
+    return full + merged
+
 
 def main(argv):
     del argv  # Unused.
@@ -43,111 +163,42 @@ def main(argv):
         return
     logging.info(f"Found {len(input_files)} input TFRecord files.")
 
-    if FLAGS.random_seed is not None:
-        random.seed(FLAGS.random_seed)
-        random.shuffle(input_files)
-        logging.info(f"Shuffled input file list with seed {FLAGS.random_seed}.")
-
-    # 2. 全レコードをイテレートするためのデータセットを作成
-    raw_dataset = tf.data.TFRecordDataset(input_files)
-
-    logging.info("Counting total records... This may take a while for large datasets.")
-    total_records = 0
-    for _ in raw_dataset:
-        total_records += 1
-    logging.info(f"Total records found: {total_records}")
-
-    if total_records == 0:
-        logging.error("No records found in the input TFRecord files.")
-        return
-
-    # 3. 分割ポイントを計算
-    num_train_records = int(total_records * FLAGS.train_split_ratio)
-    num_eval_records = total_records - num_train_records
-
-    logging.info(f"Splitting into {num_train_records} training records and {num_eval_records} evaluation records.")
-
-    # 4. データを分割して新しいTFRecordファイルに書き出す
-    train_writer = None
-    eval_writer = None
-    train_record_count = 0
-    eval_record_count = 0
-    train_shard_index = 0 # 0-indexed shard number
-    eval_shard_index = 0  # 0-indexed shard number
-
-    # 総シャード数を計算 (ファイル名で使用)
-    # num_train_shards = ((num_train_records - 1) // FLAGS.shard_size) + 1 if num_train_records > 0 else 0
-    # num_eval_shards = ((num_eval_records - 1) // FLAGS.shard_size) + 1 if num_eval_records > 0 else 0
-    # より安全な計算 (レコード数が0の場合を考慮)
-    num_train_shards = (num_train_records + FLAGS.shard_size - 1) // FLAGS.shard_size if num_train_records > 0 else 0
-    num_eval_shards = (num_eval_records + FLAGS.shard_size - 1) // FLAGS.shard_size if num_eval_records > 0 else 0
-
-
-    raw_dataset_for_writing = tf.data.TFRecordDataset(input_files)
-    dataset_iterator = iter(raw_dataset_for_writing)
-
-    # Training データの書き込み
-    if num_train_records > 0: # trainデータがある場合のみ処理
-        logging.info("Writing training data...")
-        for i in range(num_train_records):
-            if train_record_count % FLAGS.shard_size == 0:
-                if train_writer:
-                    train_writer.close()
-                # 出力ファイル名を指定の形式に
-                output_path = os.path.join(FLAGS.output_dir, f"training_seqs.tfrecord-{train_shard_index:05d}-of-{num_train_shards:05d}")
-                train_writer = tf.io.TFRecordWriter(output_path)
-                train_shard_index += 1
-                logging.info(f"Writing to training shard: {output_path}")
-
-            try:
-                record = next(dataset_iterator)
-                train_writer.write(record.numpy())
-                train_record_count += 1
-            except StopIteration:
-                logging.warning("Ran out of records before writing all expected training records.")
-                break
-            if (i + 1) % (FLAGS.shard_size // 10 or 1) == 0 :
-                 logging.info(f"  Wrote {i+1}/{num_train_records} training records...")
-
-        if train_writer:
-            train_writer.close()
-        logging.info(f"Finished writing {train_record_count} training records.")
-    else:
-        logging.info("No training records to write based on the split ratio.")
-
-
-    # Evaluation データの書き込み
-    if num_eval_records > 0: # evalデータがある場合のみ処理
-        logging.info("Writing evaluation data...")
-        for i in range(num_eval_records):
-            if eval_record_count % FLAGS.shard_size == 0:
-                if eval_writer:
-                    eval_writer.close()
-                # 出力ファイル名を指定の形式に
-                output_path = os.path.join(FLAGS.output_dir, f"eval_seqs.tfrecord-{eval_shard_index:05d}-of-{num_eval_shards:05d}")
-                eval_writer = tf.io.TFRecordWriter(output_path)
-                eval_shard_index += 1
-                logging.info(f"Writing to evaluation shard: {output_path}")
-
-            try:
-                record = next(dataset_iterator)
-                eval_writer.write(record.numpy())
-                eval_record_count += 1
-            except StopIteration:
-                logging.info("Reached end of dataset while writing evaluation records.")
-                break
-            if (i + 1) % (FLAGS.shard_size // 10 or 1) == 0 :
-                 logging.info(f"  Wrote {i+1}/{num_eval_records} evaluation records...")
-
-        if eval_writer:
-            eval_writer.close()
-        logging.info(f"Finished writing {eval_record_count} evaluation records.")
-    else:
-        logging.info("No evaluation records to write based on the split ratio.")
+    # 2. ファイルをワーカー数のグループに分け、各グループを並列に1パスで分割する。
+    #    レコードはハッシュで割り当てるため、事前に総数を数える必要はない。
+    num_workers = min(FLAGS.num_workers or os.cpu_count(), len(input_files))
+    groups = group_files(input_files, num_workers)
+    tasks = [(i, group, FLAGS.output_dir, FLAGS.train_split_ratio,
+              FLAGS.shard_size, FLAGS.random_seed)
+             for i, group in enumerate(groups)]
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(num_workers) as pool:
+            results = pool.map(split_files, tasks, chunksize=1)
+    except BaseException:
+        # 成功したワーカーの一時ファイルも削除する
+        for prefix in SPLIT_PREFIXES.values():
+            for tmp_path in glob.glob(os.path.join(FLAGS.output_dir, f'.{prefix}-*.tmp')):
+                os.remove(tmp_path)
+        raise
+
+    # 3. 各グループの端数のシャードをまとめ、最終的なファイル名に変更して
+    #    マニフェストを書き出す
+    for split, prefix in SPLIT_PREFIXES.items():
+        shards = [s for file_shards in results for s in file_shards if s[0] == split]
+        shards = merge_partial_shards(shards, FLAGS.output_dir, FLAGS.shard_size)
+        entries = []
+        for shard_index, (_, tmp_path, count, checksum) in enumerate(shards):
+            output_path = os.path.join(
+                FLAGS.output_dir, f"{prefix}.tfrecord-{shard_index:05d}-of-{len(shards):05d}")
+            os.replace(tmp_path, output_path)
+            entries.append({'path': os.path.basename(output_path),
+                            'num_records': count,
+                            'checksum': checksum})
+        data_utils.write_shard_manifest(FLAGS.output_dir, split, entries)
 
     logging.info(f"Splitting complete. Output files are in {FLAGS.output_dir}")
 
 if __name__ == '__main__':
     flags.mark_flag_as_required('input_dir')
     flags.mark_flag_as_required('output_dir')
-    app.run(main)
\ No newline at end of file
+    app.run(main)
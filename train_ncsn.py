@@ -24,11 +24,14 @@ from functools import partial
 
 import jax
 import jax.numpy as jnp
+from jax import lax
 import jax.experimental.optimizers
+from jax.experimental import host_callback
 import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
+from flax import jax_utils
 from flax import nn
 from flax import optim
 from flax.metrics import tensorboard
@@ -54,6 +57,16 @@ flags.DEFINE_float('learning_rate', 3e-4, 'Learning rate for optimizer.')
 flags.DEFINE_integer('batch_size', 128, 'Batch size for training.')
 flags.DEFINE_integer('epochs', 10, 'Number of training epochs.')
 flags.DEFINE_integer('max_steps', None, 'Maximum number of training steps.')
+flags.DEFINE_boolean('data_parallel', False,
+                     'Shard each batch across all local devices with pmap.')
+flags.DEFINE_integer(
+    'host_device_count', None,
+    'Split the host CPU into this many XLA devices (e.g. for --data_parallel '
+    'on CPU).')
+flags.DEFINE_integer(
+    'steps_per_dispatch', 1,
+    'Number of training steps run by each call of the compiled train step. '
+    'Logging, snapshots and --max_steps are checked once per call.')
 
 # Training stability
 flags.DEFINE_boolean('early_stopping', False,
@@ -89,7 +102,7 @@ flags.DEFINE_float('ld_epsilon', 2e-6,
                    'Step size for annealed Langevin dynamics.')  # Technique 4
 
 # Sampling
-flags.DEFINE_enum('sampling', 'ald', ['ald', 'cas', 'ddpm'],
+flags.DEFINE_enum('sampling', 'ald', ['ald', 'cas', 'ddpm', 'ddim'],
                   'Sampling algorithm to use.')
 flags.DEFINE_boolean('ema', True,
                      'Exponential moving average smoothing.')  # Technique 5
@@ -98,6 +111,44 @@ flags.DEFINE_boolean(
     'denoise', True,
     'Add additional denoising step during sampling (Song et al., 2020).')
 
+# Strided sampling (DDIM only)
+flags.DEFINE_integer('ddim_steps', 50,
+                     'Number of timesteps visited by DDIM sampling.')
+flags.DEFINE_float('ddim_eta', 0.,
+                   'Stochasticity of DDIM sampling (0 is deterministic).')
+flags.DEFINE_enum('ddim_spacing', 'uniform', ['uniform', 'quadratic'],
+                  'Spacing of the timesteps visited by DDIM sampling.')
+flags.DEFINE_string(
+    'compilation_cache_dir', None,
+    'Persist compiled samplers in this directory across runs (optional).')
+
+# Sampling scripts (sample_ncsn*.py)
+flags.DEFINE_boolean(
+    'batch_decode', True,
+    'Decode all interpolation latents in a single vectorized reverse process.')
+flags.DEFINE_integer(
+    'collection_stride', None,
+    'Collect samples every N sampling steps (0 keeps only the initial and '
+    'final samples). Defaults to evenly spaced snapshots.')
+flags.DEFINE_boolean(
+    'stream_collection', False,
+    'Write collected samples to ncsn/collection/ as they are produced instead '
+    'of buffering them on the device.')
+flags.DEFINE_integer(
+    'sample_batch_size', None,
+    'Generate samples in fixed-size chunks of this many samples to bound '
+    'peak memory.')
+flags.DEFINE_boolean(
+    'stream_samples', False,
+    'Generate --sample_size samples and write each chunk to ncsn/generated/ '
+    'as soon as it is sampled (unconditional generation only).')
+flags.DEFINE_boolean(
+    'warmup', False,
+    'Compile the sampler for the generation batch size (and '
+    '--warmup_batch_sizes) before sampling.')
+flags.DEFINE_list('warmup_batch_sizes', [],
+                  'Additional batch sizes to compile during warm-up.')
+
 # Data
 flags.DEFINE_list('data_shape', [
     2,
@@ -257,8 +308,13 @@ def evaluate(dataset, model, sigmas, rng):
   return metrics
 
 
-@partial(jax.jit, static_argnums=(0,))
-def train_step(objective, batch, optimizer, sigmas, rng, learning_rate):
+def _train_step(objective,
+                batch,
+                optimizer,
+                sigmas,
+                rng,
+                learning_rate,
+                axis_name=None):
   """Single optimized training step.
 
   Args:
@@ -268,6 +324,8 @@ def train_step(objective, batch, optimizer, sigmas, rng, learning_rate):
     sigmas: The noise schedule used to train the model.
     rng: Random number generator for noise selection.
     learning_rate: Current learning rate.
+    axis_name: Name of the pmap axis to average gradients and metrics over,
+        or None on a single device.
 
   Returns:
     optimizer: The optimizer in its new state.
@@ -281,6 +339,11 @@ def train_step(objective, batch, optimizer, sigmas, rng, learning_rate):
 
   grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
   (loss, train_metrics), grad = grad_fn(optimizer.target)
+  if axis_name is not None:
+    # Every device holds an equal share of the batch, so the mean over
+    # devices equals the gradient of the full batch.
+    grad = lax.pmean(grad, axis_name)
+    train_metrics = lax.pmean(train_metrics, axis_name)
   grad = jax.experimental.optimizers.clip_grads(grad, FLAGS.grad_clip)
   train_metrics['grad'] = jax.experimental.optimizers.l2_norm(grad)
   train_metrics['lr'] = learning_rate
@@ -288,6 +351,78 @@ def train_step(objective, batch, optimizer, sigmas, rng, learning_rate):
   return optimizer, train_metrics
 
 
+def _train_block(objective,
+                 use_ema,
+                 batches,
+                 optimizer,
+                 ema,
+                 sigmas,
+                 rngs,
+                 learning_rates,
+                 axis_name=None):
+  """Runs consecutive training steps and EMA updates in one executable.
+
+  Args:
+    objective: Objective used for training.
+    use_ema: Whether to update the EMA of the parameters after each step.
+    batches: Batches of inputs stacked along a leading step axis.
+    optimizer: The optimizer to use to update the weights.
+    ema: EMAHelper with the moving average of the parameters.
+    sigmas: The noise schedule used to train the model.
+    rngs: Random number generators for each step.
+    learning_rates: Learning rates for each step.
+    axis_name: Name of the pmap axis to average gradients and metrics over,
+        or None on a single device.
+
+  Returns:
+    optimizer: The optimizer in its new state.
+    ema: The updated EMAHelper.
+    train_metrics: A dict with training statistics for the last step.
+  """
+
+  def step_fn(carry, step_inputs):
+    optimizer, ema = carry
+    batch, rng, learning_rate = step_inputs
+    optimizer, train_metrics = _train_step(objective, batch, optimizer, sigmas,
+                                           rng, learning_rate, axis_name)
+    if use_ema:
+      ema = ema.update(optimizer.target)
+    return (optimizer, ema), train_metrics
+
+  (optimizer, ema), train_metrics = lax.scan(step_fn, (optimizer, ema),
+                                             (batches, rngs, learning_rates))
+  train_metrics = jax.tree_map(lambda x: x[-1], train_metrics)
+  return optimizer, ema, train_metrics
+
+
+train_block = jax.jit(_train_block, static_argnums=(0, 1))
+
+# Data-parallel training steps. All arguments except the objective and
+# use_ema carry a leading device axis: the optimizer, EMA and sigmas are
+# replicated, while the batches and random keys are split across devices.
+p_train_block = jax.pmap(partial(_train_block, axis_name='batch'),
+                         axis_name='batch',
+                         static_broadcasted_argnums=(0, 1))
+
+
+def _batch_blocks(batches, size):
+  """Groups batches into lists of up to size consecutive batches.
+
+  Yields:
+    The step of the first batch and the list of batches.
+  """
+  block, first_step = [], 0
+  for step, batch in enumerate(batches):
+    if not block:
+      first_step = step
+    block.append(batch)
+    if len(block) == size:
+      yield first_step, block
+      block = []
+  if block:
+    yield first_step, block
+
+
 def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
   """Training loop.
 
@@ -336,6 +471,26 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
   ema = train_utils.EMAHelper(mu=FLAGS.mu, params=model.params)
   scorenet = create_model(sample_rng, input_shape, model_kwargs, batch_size)
 
+  if FLAGS.steps_per_dispatch < 1:
+    raise ValueError('--steps_per_dispatch must be positive.')
+
+  # Data parallelism
+  num_devices = 1
+  if FLAGS.data_parallel:
+    num_devices = jax.local_device_count()
+    if FLAGS.batch_size % num_devices:
+      raise ValueError(f'Batch size {FLAGS.batch_size} is not divisible by '
+                       f'the number of devices ({num_devices}).')
+    logging.info('Data-parallel training on %i devices (%i examples each).',
+                 num_devices, FLAGS.batch_size // num_devices)
+    optimizer = jax_utils.replicate(optimizer)
+    ema = jax_utils.replicate(ema)
+    replicated_sigmas = jax_utils.replicate(sigmas)
+
+  def host_state(state):
+    """Returns a single copy of (possibly replicated) training state."""
+    return jax_utils.unreplicate(state) if FLAGS.data_parallel else state
+
   # Learning rate schedule
   lr_step_schedule = [(i, FLAGS.lr_gamma**i) for i in range(1000)]
   lr_scheduler = lr_schedule.create_stepped_learning_rate_schedule(
@@ -354,17 +509,38 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
   sampling_step = -1
   for epoch in range(FLAGS.epochs):
     start_time = time.time()
-    for step, batch in enumerate(tfds.as_numpy(train_batches)):
-      rng, train_rng = jax.random.split(rng)
+    for first_step, block in _batch_blocks(tfds.as_numpy(train_batches),
+                                           FLAGS.steps_per_dispatch):
+      # Each call runs the optimizer and EMA updates of len(block) steps.
+      steps = range(first_step, first_step + len(block))
+      step = steps[-1]
       global_step = step + epoch * train_batches.examples
-      optimizer, train_metrics = train_step(objective, batch, optimizer,
-                                            sigmas, train_rng,
-                                            lr_scheduler(global_step))
-
-      if FLAGS.ema:
-        ema = ema.update(optimizer.target)
 
-      if step % FLAGS.logging_freq == 0:
+      train_rngs = []
+      for _ in block:
+        rng, train_rng = jax.random.split(rng)
+        train_rngs.append(train_rng)
+      learning_rates = np.array([
+          lr_scheduler(s + epoch * train_batches.examples) for s in steps
+      ], dtype=np.float32)
+
+      if FLAGS.data_parallel:
+        optimizer, ema, train_metrics = p_train_block(
+            objective, FLAGS.ema,
+            np.stack([train_utils.shard_batch(b, num_devices) for b in block],
+                     axis=1), optimizer, ema, replicated_sigmas,
+            jnp.stack([jax.random.split(r, num_devices) for r in train_rngs],
+                      axis=1),
+            np.broadcast_to(learning_rates, (num_devices, len(block))))
+      else:
+        optimizer, ema, train_metrics = train_block(objective, FLAGS.ema,
+                                                    np.stack(block), optimizer,
+                                                    ema, sigmas,
+                                                    jnp.stack(train_rngs),
+                                                    learning_rates)
+
+      if any(s % FLAGS.logging_freq == 0 for s in steps):
+        train_metrics = host_state(train_metrics)
         elapsed = time.time() - start_time
         batch_per_sec = (step + 1) / elapsed
         ms_per_batch = elapsed * 1000 / (step + 1)
@@ -377,13 +553,17 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
                                 summary_writer=train_writer,
                                 verbose=verbose)
 
-      if (step % FLAGS.snapshot_freq == 0 and
-          step > 0) or step == train_batches.examples - 1:
+      if any(s % FLAGS.snapshot_freq == 0 and s > 0
+             for s in steps) or step == train_batches.examples - 1:
 
         sampling_step += 1
 
+        # Evaluation, checkpoints and sampling use a single copy of the
+        # state, so checkpoints are the same with or without --data_parallel.
+        host_optimizer, host_ema = host_state((optimizer, ema))
+
         rng, eval_rng = jax.random.split(rng)
-        eval_metrics = evaluate(valid_batches, optimizer.target, sigmas,
+        eval_metrics = evaluate(valid_batches, host_optimizer.target, sigmas,
                                 eval_rng)
         train_utils.log_metrics(eval_metrics,
                                 global_step,
@@ -394,7 +574,8 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
 
         if (not FLAGS.early_stopping and FLAGS.save_ckpt) or \
           (FLAGS.early_stopping and improved and FLAGS.save_ckpt):
-          checkpoints.save_checkpoint(output_dir, (optimizer, ema, early_stop),
+          checkpoints.save_checkpoint(output_dir,
+                                      (host_optimizer, host_ema, early_stop),
                                       sampling_step,
                                       keep=FLAGS.checkpoints_to_keep)
 
@@ -404,8 +585,10 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
 
         if FLAGS.snapshot_sampling:
           scorenet = scorenet.replace(
-              params=ema.params if FLAGS.ema else optimizer.target.params)
+              params=host_ema.params
+              if FLAGS.ema else host_optimizer.target.params)
           rng, sample_rng = jax.random.split(rng)
+          epsilon, steps = sampling_params(FLAGS.sampling, len(sigmas))
           generated, collection, ld_metrics = sample(
               scorenet,
               sigmas,
@@ -413,9 +596,10 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
               input_shape,
               num_samples=FLAGS.eval_samples,
               sampling=FLAGS.sampling,
-              epsilon=FLAGS.ld_epsilon,
-              steps=FLAGS.ld_steps,
-              denoise=FLAGS.denoise)
+              epsilon=epsilon,
+              steps=steps,
+              denoise=FLAGS.denoise,
+              collection_stride=0)
           log_langevin_dynamics(ld_metrics, sampling_step, output_dir)
 
           init = collection[0]
@@ -451,9 +635,10 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
                         output_dir=output_dir)
 
             # Draw gradient field
-            if len(input_shape) == 1 and FLAGS.sampling != 'ddpm':
+            if len(input_shape) == 1 and FLAGS.sampling not in ('ddpm',
+                                                                'ddim'):
               for sigma in sigmas:
-                score_buf = plot_utils.score_field_2d(optimizer.target,
+                score_buf = plot_utils.score_field_2d(host_optimizer.target,
                                                       sigma=sigma,
                                                       scale=8)
                 score_im = tf.image.decode_png(score_buf.getvalue(), channels=4)
@@ -491,9 +676,175 @@ def train(train_batches, valid_batches, sigmas, output_dir=None, verbose=True):
       # Early termination of training loop.
       if FLAGS.max_steps is not None and \
         global_step >= FLAGS.max_steps:
-        return optimizer
+        return host_state(optimizer)
+
+  return host_state(optimizer)
+
+
+def get_sampling_algorithm(sampling):
+  """Returns the sampling function for a --sampling option."""
+  if sampling == 'ald':
+    return ebm_utils.annealed_langevin_dynamics
+  elif sampling == 'cas':
+    return ebm_utils.consistent_langevin_dynamics
+  elif sampling == 'ddpm':
+    return ebm_utils.diffusion_dynamics
+  elif sampling == 'ddim':
+    return ebm_utils.ddim_dynamics
+  else:
+    raise ValueError(f'Unknown sampling algorithm: {sampling}')
+
+
+def sampling_params(sampling, num_timesteps):
+  """Returns the (epsilon, steps) arguments for a sampling algorithm.
+
+  DDIM reuses these arguments for its stochasticity (eta) and the strided
+  subset of timesteps it visits.
+
+  Args:
+    sampling: Sampling algorithm to use.
+    num_timesteps: Number of values in the noise schedule.
+  """
+  if sampling == 'ddim':
+    timesteps = ebm_utils.create_ddim_timesteps(num_timesteps,
+                                                FLAGS.ddim_steps,
+                                                spacing=FLAGS.ddim_spacing)
+    return FLAGS.ddim_eta, timesteps
+  return FLAGS.ld_epsilon, FLAGS.ld_steps
+
+
+def enable_compilation_cache(sample_shape):
+  """Enables the persistent compilation cache for the configured sampler.
+
+  Args:
+    sample_shape: Shape of each individual sample.
+
+  Returns:
+    The cache directory or None if the cache is disabled or unsupported.
+  """
+  if not FLAGS.compilation_cache_dir:
+    return None
+
+  config = {
+      'architecture': FLAGS.architecture,
+      'num_layers': FLAGS.num_layers,
+      'num_heads': FLAGS.num_heads,
+      'num_mlp_layers': FLAGS.num_mlp_layers,
+      'mlp_dims': FLAGS.mlp_dims,
+      'sample_shape': list(sample_shape),
+      'sampling': FLAGS.sampling,
+      'num_sigmas': FLAGS.num_sigmas,
+      'ld_steps': FLAGS.ld_steps,
+      'ddim_steps': FLAGS.ddim_steps,
+      'denoise': FLAGS.denoise,
+  }
+  return train_utils.enable_compilation_cache(FLAGS.compilation_cache_dir,
+                                              config)
 
-  return optimizer
+
+# Samplers compiled ahead of time by `warmup_sampler`, keyed by their static
+# arguments and the shapes of their array arguments.
+_compiled_samplers = {}
+
+
+def _static_key(x):
+  """Hashable form of a sampler argument that is baked into the program."""
+  if isinstance(x, (np.ndarray, jnp.ndarray)):
+    return tuple(np.asarray(x).ravel().tolist())
+  return x
+
+
+def _sampler_call(sampling_algorithm, rng, scorenet, sigmas, init, epsilon,
+                  steps, denoise, collection_stride, snapshot_fn, kwargs):
+  """Binds the static arguments of a sampler.
+
+  Returns:
+    fn: Function of the array arguments only.
+    args: The array arguments.
+    key: Key of the compiled sampler in `_compiled_samplers`.
+  """
+
+  def fn(rng, scorenet, sigmas, init, kwargs):
+    return sampling_algorithm(rng, scorenet, sigmas, init, epsilon, steps,
+                              denoise, False, collection_stride, snapshot_fn,
+                              **kwargs)
+
+  args = (rng, scorenet, sigmas, init, kwargs)
+  leaves, treedef = jax.tree_flatten(args)
+  key = (sampling_algorithm, _static_key(epsilon), _static_key(steps), denoise,
+         collection_stride, snapshot_fn, treedef,
+         tuple((np.shape(x), np.result_type(x).name) for x in leaves))
+  return fn, args, key
+
+
+def warmup_sampler(scorenet,
+                   sigmas,
+                   sample_shape,
+                   batch_sizes,
+                   num_samples=None,
+                   **kwargs):
+  """Compiles the sampler ahead of time for a set of batch sizes.
+
+  The sampler is lowered and compiled without running it. Later calls to
+  `sample` with the same arguments reuse the compiled sampler (and, with
+  --compilation_cache_dir, so do later runs).
+
+  Args:
+    scorenet: Score model to use for sampling.
+    sigmas: Noise schedule.
+    sample_shape: Shape of each individual sample.
+    batch_sizes: Numbers of samples per sampling call to compile for.
+    num_samples: Total number of samples of the later `sample` call, which
+        determines how the samples are split into chunks. Defaults to each
+        batch size.
+    **kwargs: The other arguments of the later `sample` call (including
+        `snapshot_fn` and `output_fn`, which are not called here).
+  """
+  rng = jax.random.PRNGKey(0)
+  for batch_size in sorted(set(batch_sizes)):
+    t0 = time.time()
+    sample(scorenet,
+           sigmas,
+           rng,
+           sample_shape,
+           num_samples=max(num_samples or batch_size, batch_size),
+           batch_size=batch_size,
+           compile_only=True,
+           **kwargs)
+    logging.info('Compiled sampler for batch size %i in %f seconds',
+                 batch_size, time.time() - t0)
+
+
+class _ValidRowsSnapshot(object):
+  """Passes only the valid (unpadded) rows of each chunk to a snapshot_fn.
+
+  Every chunk reports each collected step once and chunks run in order, so
+  the k-th state reported for a step belongs to the k-th chunk.
+  """
+
+  def __init__(self, snapshot_fn):
+    self.snapshot_fn = snapshot_fn
+    self.reset()
+
+  def reset(self):
+    self.chunk_sizes = []
+    self.calls = {}
+
+  def __call__(self, idx, state):
+    k = self.calls.get(int(idx), 0)
+    self.calls[int(idx)] = k + 1
+    self.snapshot_fn(idx, np.asarray(state)[:self.chunk_sizes[k]])
+
+
+# One wrapper per snapshot_fn, so that compiled samplers (which hold on to
+# the wrapper) are reused across calls.
+_valid_rows_snapshots = {}
+
+
+def _pad_batch(x, batch_size):
+  """Pads the leading axis of an array with zeros up to batch_size."""
+  padding = [(0, batch_size - len(x))] + [(0, 0)] * (np.ndim(x) - 1)
+  return jnp.pad(x, padding)
 
 
 def sample(scorenet,
@@ -508,7 +859,13 @@ def sample(scorenet,
            denoise=True,
            # 追加：新しい引数を受け取る
            target_latents=None,
-           guidance_scale=1.0):
+           guidance_scale=1.0,
+           target_masks=None,
+           collection_stride=None,
+           snapshot_fn=None,
+           batch_size=None,
+           output_fn=None,
+           compile_only=False):
   """Generate samples via Langevin dynamics.
   
   Args:
@@ -518,54 +875,276 @@ def sample(scorenet,
     sample_shape: Shape of each individual sample.
     num_samples: The number of samples to generate.
     sampling: Sampling algorithm to use.
-    epsilon: Step size for Langevin dynamics.
-    steps: Number of sampling steps.
+    epsilon: Step size for Langevin dynamics (eta for DDIM).
+    steps: Number of sampling steps (timesteps to visit for DDIM).
     denoise: Apply an additional denoising step to yield
         the expected denoised sampled (EDS).
+    target_latents: Optional targets to guide diffusion sampling towards.
+    guidance_scale: Strength of the guidance towards target_latents.
+    target_masks: Optional per-sample guidance weights with shape
+        (num_samples,). A zero disables guidance for a sample.
+    collection_stride: Collect the samples every `collection_stride` steps.
+        Zero only keeps the initial and final samples, which avoids
+        buffering intermediate states on the device. When the samples are
+        split into several chunks and neither `snapshot_fn` nor `output_fn`
+        is given, it is forced to zero so that memory stays bounded.
+    snapshot_fn: Optional callback `snapshot_fn(idx, samples)` that receives
+        the collected samples as they are produced (see
+        ebm_utils.SnapshotWriter).
+    batch_size: Generate the samples in chunks of at most this many samples.
+        Every chunk has the same shape (the last one is padded), so they all
+        reuse one compiled sampler and peak memory does not depend on
+        num_samples.
+    output_fn: Optional callback `output_fn(chunk_idx, generated)` that
+        receives each chunk of generated samples instead of concatenating
+        them in memory.
+    compile_only: Only compile the sampler for these arguments (see
+        `warmup_sampler`) and return (None, None, None).
  
   Returns:
-    generated: An array of generated samples.
-    collection: An array with the samples at each step of sampling.
-    ld_metrics: Sampling statistics for each step.
+    generated: An array of generated samples (None if output_fn is given).
+    collection: An array with the samples at each step of sampling (None if
+        output_fn is given).
+    ld_metrics: Sampling statistics for each step, averaged over chunks.
   """
-  if sampling == 'ald':
-    sampling_algorithm = ebm_utils.annealed_langevin_dynamics
-  elif sampling == 'cas':
-    sampling_algorithm = ebm_utils.consistent_langevin_dynamics
-  elif sampling == 'ddpm':
-    sampling_algorithm = ebm_utils.diffusion_dynamics
+  sampling_algorithm = get_sampling_algorithm(sampling)
+
+  if batch_size is None or batch_size > num_samples:
+    batch_size = num_samples
+  num_batches = -(-num_samples // batch_size)
+  padded = num_samples % batch_size != 0
+
+  if (num_batches > 1 and output_fn is None and snapshot_fn is None and
+      collection_stride != 0):
+    # Buffering the collection of every chunk would grow with num_samples.
+    logging.info('Only keeping the initial and final samples of %i chunks.',
+                 num_batches)
+    collection_stride = 0
+
+  if snapshot_fn is not None:
+    snapshot_fn = _valid_rows_snapshots.setdefault(
+        snapshot_fn, _ValidRowsSnapshot(snapshot_fn))
+    snapshot_fn.reset()
+
+  # Targets with a leading sample axis are split along with the samples.
+  per_sample_targets = (target_latents is not None and
+                        np.ndim(target_latents) == len(sample_shape) + 1)
+
+  generated, collection, ld_metrics, chunk_sizes = [], [], [], []
+  for i in range(num_batches):
+    offset = i * batch_size
+    chunk_size = min(batch_size, num_samples - offset)
+    chunk_sizes.append(chunk_size)
+    if snapshot_fn is not None:
+      snapshot_fn.chunk_sizes.append(chunk_size)
+    chunk_rng = jax.random.fold_in(rng, i) if num_batches > 1 else rng
+    init_rng, ld_rng = jax.random.split(chunk_rng)
+
+    # Initial state has mean=0, var=1.
+    if sampling in ('ddpm', 'ddim'):
+      init = jax.random.normal(key=init_rng, shape=(batch_size, *sample_shape))
+    else:
+      rho = jnp.sqrt(12) / 2
+      init = jax.random.uniform(key=init_rng,
+                                shape=(batch_size, *sample_shape),
+                                minval=-rho,
+                                maxval=rho)
+
+    # Guidance is only supported by the diffusion samplers.
+    guidance_kwargs = {}
+    if target_latents is not None:
+      targets = target_latents
+      if per_sample_targets:
+        targets = _pad_batch(targets[offset:offset + chunk_size], batch_size)
+      guidance_kwargs = {
+          'target_latents': targets,
+          'guidance_scale': guidance_scale
+      }
+      if target_masks is not None:
+        # Padded samples are not guided.
+        guidance_kwargs['target_masks'] = _pad_batch(
+            target_masks[offset:offset + chunk_size], batch_size)
+    if padded:
+      # Padded samples do not count towards the sampling metrics.
+      guidance_kwargs['sample_weights'] = _pad_batch(
+          jnp.ones((chunk_size,), jnp.float32), batch_size)
+
+    fn, args, key = _sampler_call(sampling_algorithm, ld_rng, scorenet,
+                                  sigmas, init, epsilon, steps, denoise,
+                                  collection_stride, snapshot_fn,
+                                  guidance_kwargs)
+    if compile_only:
+      # Every chunk has the same shapes, so one compilation serves them all.
+      if key not in _compiled_samplers:
+        try:
+          _compiled_samplers[key] = jax.jit(fn).lower(*args).compile()
+        except AttributeError:
+          logging.warning('Ahead-of-time compilation is not supported by this '
+                          'version of JAX. Running the sampler once instead.')
+          jax.device_get(fn(*args))
+      return None, None, None
+
+    compiled = _compiled_samplers.get(key)
+    if compiled is not None:
+      chunk_generated, chunk_collection, chunk_metrics = compiled(*args)
+    else:
+      chunk_generated, chunk_collection, chunk_metrics = fn(*args)
+    ld_metrics.append(chunk_metrics)
+
+    if output_fn is not None:
+      output_fn(i, np.asarray(chunk_generated[:chunk_size]))
+    else:
+      generated.append(chunk_generated[:chunk_size])
+      collection.append(chunk_collection[:, :chunk_size])
+
+    if num_batches > 1:
+      logging.info('Generated chunk %i/%i', i + 1, num_batches)
+
+  if output_fn is not None:
+    generated, collection = None, None
+  elif num_batches == 1:
+    generated, collection = generated[0], collection[0]
   else:
-    raise ValueError(f'Unknown sampling algorithm: {sampling}')
+    generated = jnp.concatenate(generated)
+    collection = jnp.concatenate(collection, axis=1)
 
-  init_rng, ld_rng = jax.random.split(rng)
+  if snapshot_fn is not None:
+    # Make sure every snapshot was delivered before returning.
+    host_callback.barrier_wait()
 
-  # Initial state has mean=0, var=1.
-  if sampling == 'ddpm':
-    init = jax.random.normal(key=init_rng, shape=(num_samples, *sample_shape))
-  else:
-    rho = jnp.sqrt(12) / 2
-    init = jax.random.uniform(key=init_rng,
-                              shape=(num_samples, *sample_shape),
-                              minval=-rho,
-                              maxval=rho)
-
-  # generated, collection, ld_metrics = sampling_algorithm(
-  #     ld_rng, scorenet, sigmas, init, epsilon, steps, denoise, False)
-  generated, collection, ld_metrics = sampling_algorithm(
-    ld_rng, scorenet, sigmas, init, epsilon, steps, denoise, False,
-    # 追加：新しい引数を渡す
-    target_latents=target_latents,
-    guidance_scale=guidance_scale
-  )
+  ld_metrics = jnp.average(jnp.stack(ld_metrics),
+                           axis=0,
+                           weights=jnp.asarray(chunk_sizes, jnp.float32))
   ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
   return generated, collection, ld_metrics
 
 
+def streaming_outputs(log_dir, transform_fn):
+  """Creates the callbacks for --stream_collection and --stream_samples.
+
+  Args:
+    log_dir: Sampling directory.
+    transform_fn: Maps samples back to the original latent space.
+
+  Returns:
+    snapshot_fn: Writes collected samples to ncsn/collection/, or None.
+    output_fn: Writes each chunk of generated samples to ncsn/generated/, or
+        None.
+  """
+  snapshot_fn = None
+  if FLAGS.stream_collection:
+    snapshot_fn = ebm_utils.SnapshotWriter(
+        os.path.join(log_dir, 'ncsn/collection'), transform_fn=transform_fn)
+
+  output_fn = None
+  if FLAGS.stream_samples:
+    output_fn = lambda i, samples: data_utils.save(
+        transform_fn(samples),
+        os.path.join(log_dir, f'ncsn/generated/{i:05d}.pkl'))
+  return snapshot_fn, output_fn
+
+
+def sample_from_flags(scorenet, sigmas, rng, sample_shape, num_samples,
+                      **kwargs):
+  """Samples with the sampler, chunking and warm-up given by the flags.
+
+  Args:
+    scorenet: Score model to use for sampling.
+    sigmas: Noise schedule.
+    rng: Random number generator for sampling.
+    sample_shape: Shape of each individual sample.
+    num_samples: Number of samples to generate.
+    **kwargs: Other arguments of `sample` (guidance targets, `snapshot_fn`
+        and `output_fn`).
+
+  Returns:
+    The outputs of `sample`.
+  """
+  epsilon, steps = sampling_params(FLAGS.sampling, len(sigmas))
+  kwargs = dict(kwargs,
+                sampling=FLAGS.sampling,
+                epsilon=epsilon,
+                steps=steps,
+                denoise=FLAGS.denoise,
+                collection_stride=FLAGS.collection_stride)
+
+  if FLAGS.warmup:
+    batch_size = min(FLAGS.sample_batch_size or num_samples, num_samples)
+    batch_sizes = [batch_size] + [int(b) for b in FLAGS.warmup_batch_sizes]
+    warmup_sampler(scorenet,
+                   sigmas,
+                   sample_shape,
+                   batch_sizes,
+                   num_samples=num_samples,
+                   **kwargs)
+
+  t0 = time.time()
+  outputs = sample(scorenet,
+                   sigmas,
+                   rng,
+                   sample_shape,
+                   num_samples=num_samples,
+                   batch_size=FLAGS.sample_batch_size,
+                   **kwargs)
+  logging.info('Generated samples in %f seconds', time.time() - t0)
+  return outputs
+
+
+def decode_from_flags(scorenet, sigmas, rng, z_list):
+  """Runs the reverse process from each initialization in z_list.
+
+  With --batch_decode, all initializations are decoded in a single
+  vectorized reverse process.
+
+  Args:
+    scorenet: Score model to use for sampling.
+    sigmas: Noise schedule.
+    rng: Random number generator for sampling.
+    z_list: List of initial states with the same shape.
+
+  Returns:
+    generated: Generated samples for each initialization.
+    collection: Collected samples for each initialization.
+    sampling_metrics: Sampling statistics for each initialization.
+  """
+  sampling_algorithm = get_sampling_algorithm(FLAGS.sampling)
+  epsilon, steps = sampling_params(FLAGS.sampling, len(sigmas))
+
+  if FLAGS.batch_decode:
+    generated, collection, ld_metrics = ebm_utils.batched_sampling(
+        sampling_algorithm, rng, scorenet, sigmas, jnp.stack(z_list), epsilon,
+        steps, FLAGS.denoise, FLAGS.collection_stride)
+    sampling_metrics = [
+        ebm_utils.collate_sampling_metrics(metrics)
+        for metrics in np.asarray(ld_metrics)
+    ]
+    logging.info('Generated samples for %i latents', len(z_list))
+    return generated, collection, sampling_metrics
+
+  gen, collects, sampling_metrics = [], [], []
+  for i, z in enumerate(z_list):
+    generated, collection, ld_metrics = sampling_algorithm(
+        rng, scorenet, sigmas, z, epsilon, steps, FLAGS.denoise, False,
+        FLAGS.collection_stride)
+    ld_metrics = ebm_utils.collate_sampling_metrics(ld_metrics)
+    gen.append(generated)
+    collects.append(collection)
+    sampling_metrics.append(ld_metrics)
+    logging.info('Generated samples %i out of %i', i, len(z_list))
+
+  return gen, collects, sampling_metrics
+
+
 def main(argv):
   del argv  # unused
 
+  # Must happen before the JAX backend is initialized below.
+  if FLAGS.host_device_count:
+    train_utils.set_host_device_count(FLAGS.host_device_count)
+
   logging.info(FLAGS.flags_into_string())
   logging.info('Platform: %s', jax.lib.xla_bridge.get_backend().platform)
+  logging.info('Local devices: %i', jax.local_device_count())
 
   # Make sure TensorFlow does not allocate GPU memory.
   tf.config.experimental.set_visible_devices([], 'GPU')
@@ -14,8 +14,12 @@
 
 # Lint as: python3
 """Dataset utilities."""
+import hashlib
+import io
+import json
 import os
 import pickle
+import zlib
 
 import jax
 import numpy as np
@@ -41,6 +45,383 @@ def load(path):
     return pickle.load(f)
 
 
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+def serialize_array(array):
+  """Serializes a NumPy array to bytes in the .npy format."""
+  buffer = io.BytesIO()
+  np.save(buffer, np.asarray(array), allow_pickle=False)
+  return buffer.getvalue()
+
+
+def deserialize_array(data, allow_pickle=False):
+  """Deserializes a NumPy array from bytes written by serialize_array.
+
+  Args:
+    data: Serialized array bytes.
+    allow_pickle: Whether to fall back to unpickling records that are not in
+        the .npy format. Only enable this for trusted legacy datasets.
+
+  Returns:
+    The deserialized array.
+  """
+  if data[:len(_NPY_MAGIC)] == _NPY_MAGIC:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+  if not allow_pickle:
+    raise ValueError('Record is not a serialized .npy array. Legacy pickled '
+                     'records can only be read with allow_pickle=True.')
+  return np.asarray(pickle.loads(data))
+
+
+class LatentStoreWriter(object):
+  """Writes sequences of latent vectors to a columnar latent store.
+
+  A store at path consists of three files:
+    {path}.latents: The vectors of all sequences as one contiguous row-major
+        array without a header.
+    {path}.offsets.npy: Int64 array with the first row of every sequence
+        followed by the total number of rows.
+    {path}.meta.json: Data type and dimensionality of the vectors.
+
+  The metadata is written last, so a store is only readable once the writer
+  has been closed.
+  """
+
+  def __init__(self, path, dim, dtype=np.float32):
+    self.path = os.path.expanduser(path)
+    self.dim = int(dim)
+    self.dtype = np.dtype(dtype)
+    self.offsets = [0]
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    self._file = open(f'{self.path}.latents', 'wb')
+
+  def append(self, sequence):
+    """Appends a sequence with shape (length, dim)."""
+    sequence = np.ascontiguousarray(sequence, dtype=self.dtype)
+    assert sequence.ndim == 2 and sequence.shape[-1] == self.dim
+    if len(sequence) == 0:
+      return
+    self._file.write(sequence.tobytes())
+    self.offsets.append(self.offsets[-1] + len(sequence))
+
+  def close(self):
+    self._file.close()
+    np.save(f'{self.path}.offsets.npy', np.array(self.offsets, dtype=np.int64))
+    meta = {
+        'dtype': self.dtype.name,
+        'dim': self.dim,
+        'num_sequences': len(self.offsets) - 1,
+        'num_vectors': self.offsets[-1]
+    }
+    with open(f'{self.path}.meta.json', 'w') as f:
+      json.dump(meta, f)
+    logging.info('Saved %d sequences (%d vectors) to %s',
+                 meta['num_sequences'], meta['num_vectors'], self.path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class LatentStore(object):
+  """Memory-mapped reader for stores written by LatentStoreWriter.
+
+  Sequences and windows are returned as views into the memory map, so no data
+  is read from disk until it is accessed.
+  """
+
+  def __init__(self, path):
+    self.path = os.path.expanduser(path)
+    with open(f'{self.path}.meta.json', 'r') as f:
+      self.meta = json.load(f)
+    self.offsets = np.load(f'{self.path}.offsets.npy')
+    self.dim = self.meta['dim']
+    self.data = np.memmap(f'{self.path}.latents',
+                          dtype=np.dtype(self.meta['dtype']),
+                          mode='r',
+                          shape=(int(self.offsets[-1]), self.dim))
+
+  @staticmethod
+  def exists(path):
+    return os.path.exists(f'{os.path.expanduser(path)}.meta.json')
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, idx):
+    return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+  def window(self, start, length):
+    """Returns a view of length rows starting at a global row index."""
+    return self.data[start:start + length]
+
+  def window_starts(self, length, stride=1):
+    """Global row indices of all windows that lie within a single sequence."""
+    lengths = np.diff(self.offsets)
+    counts = np.maximum(lengths - length, -1) // stride + 1
+    seq_idx = np.repeat(np.arange(len(lengths)), counts)
+    first = np.cumsum(counts) - counts
+    rank = np.arange(counts.sum()) - np.repeat(first, counts)
+    return self.offsets[:-1][seq_idx] + rank * stride
+
+  def windows(self, starts, length):
+    """Gathers a batch of windows into an array of shape (B, length, dim)."""
+    idx = np.asarray(starts)[:, None] + np.arange(length)
+    return self.data[idx]
+
+
+def fingerprint_files(paths, config=None, block_size=2**20):
+  """Hashes a set of files together with a configuration.
+
+  Each file contributes its name, size, modification time and first and
+  last block_size bytes, so large datasets are fingerprinted without reading
+  them in full. The middle of a file is not hashed: an in-place edit there is
+  only detected through the modification time, so tools that preserve it
+  (e.g. cp -p or rsync -t) can leave a stale fingerprint.
+
+  Args:
+    paths: List of file paths.
+    config: Optional JSON-serializable configuration to include in the hash.
+    block_size: Number of bytes hashed at the start and end of each file.
+
+  Returns:
+    A hexadecimal digest.
+  """
+  digest = hashlib.sha256()
+  digest.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+  for path in sorted(os.path.expanduser(p) for p in paths):
+    stat = os.stat(path)
+    size = stat.st_size
+    digest.update(
+        f'{os.path.basename(path)}:{size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    with open(path, 'rb') as f:
+      digest.update(f.read(block_size))
+      if size > block_size:
+        f.seek(max(block_size, size - block_size))
+        digest.update(f.read(block_size))
+  return digest.hexdigest()[:16]
+
+
+def compute_dataset_moments(ds,
+                            ds_split='train',
+                            cache=False,
+                            cache_dir=None,
+                            config=''):
+  """Computes per-dimension statistics of a (batched) tf.data.Dataset.
+
+  The count, min, max, mean and standard deviation of every dimension along
+  the last axis are computed in a single pass. Means and variances are
+  merged across batches with the parallel algorithm of Chan et al., which is
+  numerically stable for large datasets.
+
+  Args:
+    ds: A dataset of float tensors.
+    ds_split: Name of the split, used in the cache file name.
+    cache: Whether to load and save the statistics from cache_dir.
+    cache_dir: Dataset directory. Statistics are saved to its cache/ folder.
+    config: A key that identifies the data and its transforms, e.g. a
+        fingerprint from fingerprint_files.
+
+  Returns:
+    A dictionary of per-dimension `min`, `max`, `mean` and `stddev` arrays
+    and the scalar `count` of vectors.
+  """
+  stats_cache_path = None
+  if cache:
+    assert cache_dir is not None
+    stats_cache_path = os.path.join(cache_dir,
+                                    f'cache/{ds_split}_{config}_stats.npz')
+    if os.path.exists(stats_cache_path):
+      logging.info('Using cached dataset statistics at %s', stats_cache_path)
+      with np.load(stats_cache_path) as cached:
+        return {key: cached[key] for key in cached.files}
+
+  dim = ds.element_spec.shape[-1] if ds.element_spec.shape.rank else None
+  if dim is None:
+    # Shapes are unknown after tf.py_function transforms.
+    dim = next(iter(ds)).shape[-1]
+
+  def update(state, batch):
+    count, ds_min, ds_max, mean, m2 = state
+    batch = tf.reshape(tf.cast(batch, tf.float64), (-1, dim))
+    batch_count = tf.cast(tf.shape(batch)[0], tf.float64)
+    batch_mean = tf.reduce_mean(batch, axis=0)
+    batch_m2 = tf.reduce_sum((batch - batch_mean)**2, axis=0)
+    total = count + batch_count
+    delta = batch_mean - mean
+    mean = mean + delta * batch_count / total
+    m2 = m2 + batch_m2 + delta**2 * count * batch_count / total
+    ds_min = tf.minimum(ds_min, tf.reduce_min(batch, axis=0))
+    ds_max = tf.maximum(ds_max, tf.reduce_max(batch, axis=0))
+    return total, ds_min, ds_max, mean, m2
+
+  initial_state = (tf.constant(0., tf.float64),
+                   tf.fill([dim], tf.constant(np.inf, tf.float64)),
+                   tf.fill([dim], tf.constant(-np.inf, tf.float64)),
+                   tf.zeros([dim], tf.float64), tf.zeros([dim], tf.float64))
+  count, ds_min, ds_max, mean, m2 = [
+      x.numpy() for x in ds.reduce(initial_state, update)
+  ]
+  stats = {
+      'count': count,
+      'min': ds_min.astype(np.float32),
+      'max': ds_max.astype(np.float32),
+      'mean': mean.astype(np.float32),
+      'stddev': np.sqrt(m2 / max(count, 1.)).astype(np.float32)
+  }
+
+  if stats_cache_path is not None:
+    os.makedirs(os.path.dirname(stats_cache_path), exist_ok=True)
+    np.savez(stats_cache_path, **stats)
+    logging.info('Saved dataset statistics to %s', stats_cache_path)
+
+  return stats
+
+
+def get_latent_dataset(path,
+                       shape=(512,),
+                       batch_size=512,
+                       shuffle=True,
+                       stride=1,
+                       seed=None):
+  """Generates a batched dataset of random windows from a latent store.
+
+  Args:
+    path: Path of the latent store (e.g. dataset/train).
+    shape: Example shape, either (dim,) for single vectors or (length, dim)
+      for windows.
+    batch_size: Number of examples per batch.
+    shuffle: Whether to shuffle the windows every epoch.
+    stride: Distance between the starts of consecutive windows.
+    seed: Random seed for shuffling.
+
+  Returns:
+    A tf.data.Dataset of {'inputs': batch} dictionaries. Batches are complete,
+    so the dataset does not need to be batched again.
+  """
+  store = LatentStore(path)
+  length = shape[0] if len(shape) > 1 else 1
+  assert shape[-1] == store.dim, (shape, store.dim)
+
+  starts = store.window_starts(length, stride)
+  num_batches = len(starts) // batch_size
+  rng = np.random.RandomState(seed)
+  logging.info('Loaded latent store %s with %d windows', path, len(starts))
+
+  def batch_starts():
+    order = rng.permutation(len(starts)) if shuffle else np.arange(len(starts))
+    for i in range(num_batches):
+      yield starts[order[i * batch_size:(i + 1) * batch_size]]
+
+  def gather(batch):
+    return store.windows(batch, length).astype(np.float32).reshape(
+        (-1, *shape))
+
+  dataset = tf.data.Dataset.from_generator(
+      batch_starts,
+      output_signature=tf.TensorSpec((batch_size,), tf.int64))
+  dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_batches))
+  dataset = dataset.map(
+      lambda x: {
+          'inputs': tf.ensure_shape(tf.numpy_function(gather, [x], tf.float32),
+                                    (batch_size, *shape))
+      },
+      num_parallel_calls=AUTOTUNE)
+  return dataset
+
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def file_checksum(path, block_size=2**24):
+  """CRC32 checksum of a file as a hexadecimal string."""
+  crc = 0
+  with open(os.path.expanduser(path), 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      crc = zlib.crc32(block, crc)
+  return f'{crc:08x}'
+
+
+def load_shard_manifest(dataset_dir):
+  """Loads the shard manifest of a dataset directory or returns None."""
+  manifest_path = os.path.join(os.path.expanduser(dataset_dir),
+                               MANIFEST_FILENAME)
+  if not os.path.exists(manifest_path):
+    return None
+  with open(manifest_path, 'r') as f:
+    return json.load(f)
+
+
+def write_shard_manifest(dataset_dir,
+                         split,
+                         shards,
+                         element_shape=None,
+                         dtype=None,
+                         data_format='tfrecord'):
+  """Records the shards of a dataset split in the dataset's manifest.
+
+  The manifest is a JSON file in dataset_dir with one entry per split, so
+  readers can get record counts without scanning the data. Existing entries
+  of other splits are kept.
+
+  Args:
+    dataset_dir: Directory of the dataset.
+    split: Name of the split (e.g. train).
+    shards: List of {'path', 'num_records'} dictionaries. Checksums are
+        computed for shards without a 'checksum' entry.
+    element_shape: Shape of each record, or None for variable shapes.
+    dtype: Name of the record data type.
+    data_format: Storage format of the shards.
+
+  Returns:
+    The manifest entry of the split.
+  """
+  dataset_dir = os.path.expanduser(dataset_dir)
+  entries = []
+  for shard in sorted(shards, key=lambda shard: shard['path']):
+    path = os.path.join(dataset_dir, shard['path'])
+    entries.append({
+        'path': os.path.relpath(path, dataset_dir),
+        'num_records': int(shard['num_records']),
+        'checksum': shard.get('checksum') or file_checksum(path)
+    })
+
+  entry = {
+      'format': data_format,
+      'num_records': sum(e['num_records'] for e in entries),
+      'element_shape': None if element_shape is None else list(
+          map(int, element_shape)),
+      'dtype': None if dtype is None else str(dtype),
+      'shards': entries
+  }
+  manifest = load_shard_manifest(dataset_dir) or {}
+  manifest[split] = entry
+
+  manifest_path = os.path.join(dataset_dir, MANIFEST_FILENAME)
+  with open(f'{manifest_path}.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(f'{manifest_path}.tmp', manifest_path)
+  logging.info('Saved manifest of %d %s records in %d shards to %s',
+               entry['num_records'], split, len(entries), manifest_path)
+  return entry
+
+
+def manifest_cardinality(dataset_dir, split, batch_size=None):
+  """Number of records (or full batches) of a split from its manifest.
+
+  Returns:
+    The cardinality or None if the split has no manifest entry.
+  """
+  manifest = load_shard_manifest(dataset_dir)
+  if manifest is None or split not in manifest:
+    return None
+  num_records = manifest[split]['num_records']
+  return num_records if batch_size is None else num_records // batch_size
+
+
 def _decode_record(record, flattened_shape, shape_len, tokens=False):
   if not tokens:
     input_parser = tf.io.FixedLenFeature([flattened_shape], tf.float32)
@@ -64,12 +445,18 @@ def compute_dataset_cardinality(ds,
                                 ds_split='train',
                                 cache=False,
                                 cache_dir=None,
-                                config=''):
-  """Computes and optionally caches cardinality of tf.data.Dataset."""
+                                config='',
+                                cardinality=None):
+  """Computes and optionally caches cardinality of tf.data.Dataset.
+
+  A known cardinality, e.g. from manifest_cardinality, is used as is.
+  """
   card_cache_path = os.path.join(cache_dir,
                                  f'cache/{ds_split}_{config}_cardinality.pkl')
 
-  if os.path.exists(card_cache_path):
+  if cardinality is not None:
+    logging.info('Using known cardinality %d for %s', cardinality, ds_split)
+  elif os.path.exists(card_cache_path):
     logging.info('Using cached dataset cardinality at %s', cache_dir)
     cardinality = load(card_cache_path)
   else:
@@ -125,37 +512,6 @@ def compute_dataset_statistics(ds,
   return ds_mean, ds_std
 
 
-def compute_dataset_min_max(ds,
-                            ds_split='train',
-                            cache=False,
-                            cache_dir=None,
-                            config=''):
-  """Computes the min and max of (batched) tf.data.Dataset."""
-  min_cache_path = os.path.join(cache_dir, f'cache/{ds_split}_{config}_min.pkl')
-  max_cache_path = os.path.join(cache_dir, f'cache/{ds_split}_{config}_max.pkl')
-
-  if os.path.exists(min_cache_path) and os.path.exists(max_cache_path):
-    logging.info('Using cached dataset min/max at %s', cache_dir)
-    ds_min = load(min_cache_path)
-    ds_max = load(max_cache_path)
-  else:
-    ds_maxes = ds.map(lambda x: tf.reduce_max(x), num_parallel_calls=AUTOTUNE)
-    ds_mins = ds.map(lambda x: tf.reduce_min(x), num_parallel_calls=AUTOTUNE)
-    ds_min = ds_mins.reduce(tf.float32.max, lambda x, y: tf.math.minimum(x, y))
-    ds_max = ds_maxes.reduce(tf.float32.min, lambda x, y: tf.math.maximum(x, y))
-    ds_min, ds_max = ds_min.numpy(), ds_max.numpy()
-
-  if cache:
-    assert cache_dir is not None
-    assert not hasattr(ds, 'min') and not hasattr(ds, 'max')
-    setattr(ds, 'min', ds_min)
-    setattr(ds, 'max', ds_max)
-    save(ds_min, min_cache_path)
-    save(ds_max, max_cache_path)
-
-  return ds_min, ds_max
-
-
 def get_tf_record_dataset(file_pattern=None,
                           shape=(512,),
                           batch_size=512,
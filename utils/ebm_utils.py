@@ -14,15 +14,20 @@
 
 # Lint as: python3
 """Utilities for training energy-based models."""
+import os
+
 import jax
 import jax.numpy as jnp
 import numpy as np
 
 from flax import struct
 from functools import partial
+from jax.experimental import host_callback
+
+import utils.data_utils as data_utils
 
 # losses.pyから新しい損失関数をインポート
-from utils.losses import target_similarity_loss
+from utils.losses import target_similarity_grad
 
 @struct.dataclass
 class ReplayBuffer(object):
@@ -88,11 +93,124 @@ def create_noise_schedule(sigma_begin=1,
   return sigmas
 
 
+def create_collection_idx(num_steps, collection_stride=None, default_steps=40):
+  """Selects the sampling steps at which the state is collected.
+
+  Args:
+    num_steps: Total number of sampling steps.
+    collection_stride: Collect the state every `collection_stride` steps.
+        Zero disables intermediate collection and None collects
+        `default_steps` evenly spaced states.
+    default_steps: Number of states collected when no stride is given.
+
+  Returns:
+    An increasing array of (1-indexed) sampling steps.
+  """
+  if collection_stride is None:
+    collection_idx = np.linspace(1, num_steps, min(default_steps, num_steps))
+  elif collection_stride > 0:
+    collection_idx = np.arange(collection_stride, num_steps + 1,
+                               collection_stride)
+  else:
+    collection_idx = []
+  return np.unique(np.asarray(collection_idx, dtype=np.int32))
+
+
+def _snapshot(snapshot_fn, idx, state, result):
+  """Sends a collected state to `snapshot_fn` on the host."""
+  tap_fn = lambda arg, transforms: snapshot_fn(*arg)
+  return host_callback.id_tap(tap_fn, (idx, state), result=result)
+
+
+def _init_collection(start, init, collection_idx, snapshot_fn=None, extra=0):
+  """Creates the buffer of collected states.
+
+  No buffer is allocated when states are streamed to `snapshot_fn` or when
+  intermediate collection is disabled. The initial state of sampling is
+  returned so that the first snapshot is ordered before sampling starts.
+  """
+  if snapshot_fn is not None:
+    return None, _snapshot(snapshot_fn, 0, start, init)
+  if len(collection_idx) == 0:
+    return None, init
+  collection = jnp.zeros((len(collection_idx) + 1 + extra, *start.shape),
+                         dtype=start.dtype)
+  collection = jax.ops.index_update(collection, jax.ops.index[0, :], start)
+  return collection, init
+
+
+def _collect(collection, collection_idx, image_idx, state, snapshot_fn=None):
+  """Stores (or streams) the state if `image_idx` is a collected step."""
+  if len(collection_idx) == 0:
+    return collection, state
+
+  idx_mask = jnp.in1d(collection_idx, image_idx)
+  idx = jnp.sum(jnp.arange(len(collection_idx)) * idx_mask) + 1
+  if snapshot_fn is not None:
+    state = jax.lax.cond(
+        idx_mask.any(),
+        lambda op: _snapshot(snapshot_fn, op[0], op[1], op[1]),
+        lambda op: op[1],
+        operand=(idx, state))
+  elif collection is not None:
+    collection = jax.lax.cond(idx_mask.any(),
+                              lambda op: jax.ops.index_update(
+                                  collection, jax.ops.index[op, :], state),
+                              lambda op: collection,
+                              operand=idx)
+  return collection, state
+
+
+def _final_collection(collection, start, state):
+  """Falls back to the initial and final states when nothing was buffered."""
+  if collection is None:
+    return jnp.stack([start, state])
+  return collection
+
+
+def _norm_mean(x, sample_weights=None):
+  """Mean norm of x over its second axis, optionally weighted per sample."""
+  norms = jnp.sqrt(jnp.sum(jnp.square(x), axis=1) + 1e-10)
+  if sample_weights is None:
+    return norms.mean()
+  weights = jnp.broadcast_to(
+      sample_weights.reshape(-1, *([1] * (norms.ndim - 1))), norms.shape)
+  return jnp.sum(norms * weights) / jnp.sum(weights)
+
+
+class SnapshotWriter(object):
+  """Writes the states streamed by a sampling procedure to disk.
+
+  Pass an instance as the `snapshot_fn` of a sampling algorithm. Each state
+  is saved to `{output_dir}/{idx:04d}-{part:05d}.pkl` as soon as it is
+  collected, where `part` counts the sampling calls (e.g. chunks of a large
+  batch) that have reached the same step.
+  """
+
+  def __init__(self, output_dir, transform_fn=None):
+    self.output_dir = output_dir
+    self.transform_fn = transform_fn
+    self.parts = {}
+
+  def __call__(self, idx, state):
+    idx = int(idx)
+    part = self.parts.get(idx, 0)
+    self.parts[idx] = part + 1
+
+    state = np.asarray(state)
+    if self.transform_fn is not None:
+      state = self.transform_fn(state)
+    data_utils.save(state,
+                    os.path.join(self.output_dir, f'{idx:04d}-{part:05d}.pkl'))
+
+
 @partial(jax.jit, static_argnums=(
     4,
     5,
     6,
     7,
+    8,
+    9,
 ))
 def annealed_langevin_dynamics(rng,
                                model,
@@ -102,8 +220,11 @@ def annealed_langevin_dynamics(rng,
                                T,
                                denoise,
                                infill=False,
+                               collection_stride=None,
+                               snapshot_fn=None,
                                infill_samples=None,
-                               infill_masks=None):
+                               infill_masks=None,
+                               sample_weights=None):
   """Annealed Langevin dynamics sampling from Song et al.
   
   Args:
@@ -115,27 +236,37 @@ def annealed_langevin_dynamics(rng,
     T: Number of steps per noise level.
     denoise: Apply an additional denoising step to final samples.
     infill: Infill partially complete samples.
+    collection_stride: Collect the state every `collection_stride` steps.
+        Zero only returns the initial and final states and None collects 100
+        evenly spaced states.
+    snapshot_fn: Optional callback `snapshot_fn(idx, state)` that receives
+        the collected states on the host instead of buffering them.
     infill_samples: Partially complete samples to infill.
     infill_masks: Binary mask for infilling partially complete samples.
         A zero indicates an element that must be infilled by Langevin dynamics.
+    sample_weights: Optional weights of the samples in the reported
+        metrics, e.g. zero for padding rows.
   
   Returns:
     state: Final state sampled from Langevin dynamics.
     collection: Array of state at each step of sampling with shape 
-        (num_sigmas * T + 1 + int(denoise), :).
+        (num_collected + 1 + int(denoise), :), or the initial and final
+        states if intermediate states are not buffered.
     ld_metrics: Metrics collected for each noise level with shape (num_sigmas, T).
   """
   if not infill:
     infill_samples = jnp.zeros(init.shape)
     infill_masks = jnp.zeros(init.shape)
 
-  collection_steps = 100
   start = init * (1 - infill_masks) + infill_samples * infill_masks
-  images = np.zeros((collection_steps + 1 + int(denoise), *init.shape))
-  images = jax.ops.index_update(images, jax.ops.index[0, :], start)
-  collection_idx = jnp.linspace(1,
-                                len(sigmas) * T,
-                                collection_steps).astype(jnp.int32)
+  collection_idx = create_collection_idx(len(sigmas) * T,
+                                         collection_stride,
+                                         default_steps=100)
+  images, init = _init_collection(start,
+                                  init,
+                                  collection_idx,
+                                  snapshot_fn,
+                                  extra=int(denoise))
 
   def langevin_step(params, i):
     state, rng, sigma_i, alpha, collection = params
@@ -155,19 +286,13 @@ def annealed_langevin_dynamics(rng,
 
     # Collect samples
     image_idx = sigma_i * T + i + 1
-    idx_mask = jnp.in1d(collection_idx, image_idx)
-    idx = jnp.sum(jnp.arange(len(collection_idx)) * idx_mask) + 1
-    collection = jax.lax.cond(idx_mask.any(),
-                              lambda op: jax.ops.index_update(
-                                  collection, jax.ops.index[op, :], next_state),
-                              lambda op: collection,
-                              operand=idx)
+    collection, next_state = _collect(collection, collection_idx, image_idx,
+                                      next_state, snapshot_fn)
 
     # Collect metrics
-    grad_norm = jnp.sqrt(jnp.sum(jnp.square(grad), axis=1) + 1e-10).mean()
-    noise_norm = jnp.sqrt(jnp.sum(jnp.square(noise), axis=1) + 1e-10).mean()
-    step_norm = jnp.sqrt(jnp.sum(jnp.square(alpha * grad), axis=1) +
-                         1e-10).mean()
+    grad_norm = _norm_mean(grad, sample_weights)
+    noise_norm = _norm_mean(noise, sample_weights)
+    step_norm = _norm_mean(alpha * grad, sample_weights)
     metrics = grad_norm, step_norm, alpha, noise_norm
 
     next_params = (next_state, rng, sigma_i, alpha, collection)
@@ -195,8 +320,11 @@ def annealed_langevin_dynamics(rng,
   # Additional denoising step.
   if denoise:
     state = state + sigmas[-1]**2 * model(state, sigmas[-1])
-    collection = jax.ops.index_update(collection, jax.ops.index[-1, :], state)
+    if collection is not None:
+      collection = jax.ops.index_update(collection, jax.ops.index[-1, :],
+                                        state)
 
+  collection = _final_collection(collection, start, state)
   return state, collection, jnp.stack(ld_metrics)
 
 
@@ -205,6 +333,8 @@ def annealed_langevin_dynamics(rng,
     5,
     6,
     7,
+    8,
+    9,
 ))
 def consistent_langevin_dynamics(rng,
                                  model,
@@ -214,8 +344,11 @@ def consistent_langevin_dynamics(rng,
                                  T,
                                  denoise=True,
                                  infill=False,
+                                 collection_stride=None,
+                                 snapshot_fn=None,
                                  infill_samples=None,
-                                 infill_masks=None):
+                                 infill_masks=None,
+                                 sample_weights=None):
   """Consistent annealed Langevin dynamics sampling from Jolicoeur-Martineau et al.
   
   Args:
@@ -225,9 +358,15 @@ def consistent_langevin_dynamics(rng,
     init: Initial state.
     epsilon: Step size coefficient.
     T: Number of steps per noise level.
+    collection_stride: Null parameter (only the initial and final states
+        are collected).
+    snapshot_fn: Null parameter.
+    sample_weights: Optional weights of the samples in the reported
+        metrics, e.g. zero for padding rows.
   
   Returns:
     state: Final state sampled from Langevin dynamics.
+    collection: Array with the initial and final states.
     ld_metrics: Metrics collected for each noise level with shape (num_sigmas, T).
   """
   if infill:
@@ -247,10 +386,9 @@ def consistent_langevin_dynamics(rng,
     next_state = state + alpha * grad + noise
 
     # Collect metrics
-    grad_norm = jnp.sqrt(jnp.sum(jnp.square(grad), axis=1) + 1e-10).mean()
-    noise_norm = jnp.sqrt(jnp.sum(jnp.square(noise), axis=1) + 1e-10).mean()
-    step_norm = jnp.sqrt(jnp.sum(jnp.square(alpha * grad), axis=1) +
-                         1e-10).mean()
+    grad_norm = _norm_mean(grad, sample_weights)
+    noise_norm = _norm_mean(noise, sample_weights)
+    step_norm = _norm_mean(alpha * grad, sample_weights)
     metrics = grad_norm, step_norm, alpha, noise_norm
 
     next_params = (next_state, rng)
@@ -270,7 +408,7 @@ def consistent_langevin_dynamics(rng,
 
   ld_metrics = jnp.stack(ld_metrics)
   ld_metrics = jnp.expand_dims(ld_metrics, axis=2)
-  return state, ld_metrics
+  return state, jnp.stack([init, state]), ld_metrics
 
 
 @partial(jax.jit, static_argnums=(
@@ -278,6 +416,8 @@ def consistent_langevin_dynamics(rng,
     5,
     6,
     7,
+    8,
+    9,
 ))
 def diffusion_dynamics(rng,
                        model,
@@ -287,12 +427,16 @@ def diffusion_dynamics(rng,
                        T,
                        denoise,
                        infill=False,
+                       collection_stride=None,
+                       snapshot_fn=None,
                        infill_samples=None,
                        # infill_masks=None):
                        infill_masks=None,
                        # 追加：新しい引数を受け取る
                        target_latents=None,
-                       guidance_scale=1.0):
+                       guidance_scale=1.0,
+                       target_masks=None,
+                       sample_weights=None):
   """Diffusion dynamics (reverse process decoder).
   
   Args:
@@ -304,14 +448,27 @@ def diffusion_dynamics(rng,
     T: Null parameter.
     denoise: Null parameter used in other methods to find EDS.
     infill: Infill partially complete samples.
+    collection_stride: Collect the state every `collection_stride` steps.
+        Zero only returns the initial and final states and None collects 40
+        evenly spaced states.
+    snapshot_fn: Optional callback `snapshot_fn(idx, state)` that receives
+        the collected states on the host instead of buffering them.
     infill_samples: Partially complete samples to infill.
     infill_masks: Binary mask for infilling partially complete samples.
         A zero indicates an element that must be infilled by Langevin dynamics.
+    target_latents: Optional targets to guide sampling towards, either
+        shared by all samples or one per sample.
+    guidance_scale: Strength of the guidance towards target_latents.
+    target_masks: Optional per-sample guidance weights with shape
+        (num_samples,). A zero disables guidance for a sample.
+    sample_weights: Optional weights of the samples in the reported
+        metrics, e.g. zero for padding rows.
   
   Returns:
     state: Final state sampled from Langevin dynamics.
     collection: Array of state at each step of sampling with shape 
-        (num_sigmas * T + 1 + int(denoise), :).
+        (num_collected + 1, :), or the initial and final states if
+        intermediate states are not buffered.
     ld_metrics: Metrics collected for each noise level with shape (num_sigmas, T).
   """
   if not infill:
@@ -323,12 +480,10 @@ def diffusion_dynamics(rng,
   alphas_prod_prev = jnp.concatenate([jnp.ones((1,)), alphas_prod[:-1]])
   assert alphas.shape == alphas_prod.shape == alphas_prod_prev.shape
 
-  collection_steps = 40
   start = init * (1 - infill_masks) + infill_samples * infill_masks
-  images = np.zeros((collection_steps + 1, *init.shape))
-  collection = jax.ops.index_update(images, jax.ops.index[0, :], start)
-  collection_idx = jnp.linspace(1, len(betas),
-                                collection_steps).astype(jnp.int32)
+  collection_idx = create_collection_idx(len(betas), collection_stride)
+  collection, init = _init_collection(start, init, collection_idx,
+                                      snapshot_fn)
 
   def sample_with_beta(params, t):
     state, rng, collection = params
@@ -382,7 +537,7 @@ def diffusion_dynamics(rng,
     # ★★★ ここからが誘導ロジックの本体 ★★★
     if target_latents is not None:
       # MSE損失に関する勾配を計算
-      grad = jax.grad(target_similarity_loss)(next_state, target_latents)
+      grad = target_similarity_grad(next_state, target_latents, target_masks)
       # 勾配を使って状態を更新（目標に近づける）
       next_state = next_state - (guidance_scale * grad)
 
@@ -391,20 +546,15 @@ def diffusion_dynamics(rng,
 
     # Collect metrics
     step = state - next_state
-    grad_norm = jnp.sqrt(jnp.sum(jnp.square(eps_recon), axis=1) + 1e-10).mean()
-    noise_norm = jnp.sqrt(jnp.sum(jnp.square(noise), axis=1) + 1e-10).mean()
-    step_norm = jnp.sqrt(jnp.sum(jnp.square(step), axis=1) + 1e-10).mean()
+    grad_norm = _norm_mean(eps_recon, sample_weights)
+    noise_norm = _norm_mean(noise, sample_weights)
+    step_norm = _norm_mean(step, sample_weights)
     metrics = (grad_norm, step_norm, alpha_prod, noise_norm)
 
     # Collect samples
-    image_idx = len(betas) - t + 1
-    idx_mask = jnp.in1d(collection_idx, image_idx)
-    idx = jnp.sum(jnp.arange(len(collection_idx)) * idx_mask) + 1
-    collection = jax.lax.cond(idx_mask.any(),
-                              lambda op: jax.ops.index_update(
-                                  collection, jax.ops.index[op, :], next_state),
-                              lambda op: collection,
-                              operand=idx)
+    image_idx = len(betas) - t
+    collection, next_state = _collect(collection, collection_idx, image_idx,
+                                      next_state, snapshot_fn)
 
     next_params = (next_state, rng, collection)
     return next_params, metrics
@@ -413,11 +563,210 @@ def diffusion_dynamics(rng,
   beta_steps = jnp.arange(len(betas) - 1, -1, -1)
   ld_state, ld_metrics = jax.lax.scan(sample_with_beta, init_params, beta_steps)
   state, rng, collection = ld_state
+  collection = _final_collection(collection, start, state)
+  ld_metrics = jnp.stack(ld_metrics)
+  ld_metrics = jnp.expand_dims(ld_metrics, 2)
+  return state, collection, ld_metrics
+
+
+def create_ddim_timesteps(num_timesteps, num_steps, spacing='uniform'):
+  """Creates a strided subset of diffusion timesteps for DDIM sampling.
+
+  Args:
+    num_timesteps: Number of values (betas) in the noise schedule.
+    num_steps: Number of timesteps to visit during sampling.
+    spacing: Spacing of the visited timesteps ('uniform' or 'quadratic').
+
+  Returns:
+    An increasing integer array of timesteps that always ends with the
+    final (noisiest) timestep.
+  """
+  num_steps = min(num_steps, num_timesteps)
+  if spacing == 'uniform':
+    timesteps = np.linspace(0, num_timesteps - 1, num_steps)
+  elif spacing == 'quadratic':
+    timesteps = np.linspace(0, np.sqrt(num_timesteps - 1), num_steps)**2
+  else:
+    raise ValueError(f'Unsupported spacing: {spacing}')
+  timesteps = np.unique(np.round(timesteps).astype(np.int32))
+  return jnp.array(timesteps)
+
+
+@partial(jax.jit, static_argnums=(
+    6,
+    7,
+    8,
+    9,
+))
+def ddim_dynamics(rng,
+                  model,
+                  betas,
+                  init,
+                  eta,
+                  timesteps,
+                  denoise,
+                  infill=False,
+                  collection_stride=None,
+                  snapshot_fn=None,
+                  infill_samples=None,
+                  infill_masks=None,
+                  target_latents=None,
+                  guidance_scale=1.0,
+                  target_masks=None,
+                  sample_weights=None):
+  """Strided DDIM reverse process (Song et al., 2020).
+
+  Visits only a subset of the timesteps of the noise schedule, reusing the
+  noise conditioning (sqrt(alpha_prod)) of models trained with
+  diffusion_loss.
+
+  Args:
+    rng: Random number generator key.
+    model: Diffusion probabilistic network.
+    betas: Noise schedule.
+    init: Initial state (usually Gaussian noise).
+    eta: Stochasticity of each step. Zero gives deterministic DDIM sampling
+        and one matches the posterior variance of DDPM.
+    timesteps: Increasing subset of timesteps to visit (see
+        create_ddim_timesteps).
+    denoise: Null parameter used in other methods to find EDS.
+    infill: Infill partially complete samples.
+    collection_stride: Collect the state every `collection_stride` steps.
+        Zero only returns the initial and final states and None collects up
+        to 40 evenly spaced states.
+    snapshot_fn: Optional callback `snapshot_fn(idx, state)` that receives
+        the collected states on the host instead of buffering them.
+    infill_samples: Partially complete samples to infill.
+    infill_masks: Binary mask for infilling partially complete samples.
+        A zero indicates an element that must be infilled.
+    target_latents: Optional targets to guide sampling towards, either
+        shared by all samples or one per sample.
+    guidance_scale: Strength of the guidance towards target_latents.
+    target_masks: Optional per-sample guidance weights with shape
+        (num_samples,). A zero disables guidance for a sample.
+    sample_weights: Optional weights of the samples in the reported
+        metrics, e.g. zero for padding rows.
+
+  Returns:
+    state: Final state sampled from the reverse process.
+    collection: Array of state at each step of sampling with shape
+        (num_collected + 1, :), or the initial and final states if
+        intermediate states are not buffered.
+    ld_metrics: Metrics collected for each step with shape
+        (len(timesteps), 1).
+  """
+  if not infill:
+    infill_samples = jnp.zeros(init.shape)
+    infill_masks = jnp.zeros(init.shape)
+
+  alphas_prod = jnp.cumprod(1 - betas)
+  prev_timesteps = jnp.concatenate([-jnp.ones((1,), jnp.int32), timesteps[:-1]])
+  num_steps = len(timesteps)
+
+  start = init * (1 - infill_masks) + infill_samples * infill_masks
+  collection_idx = create_collection_idx(num_steps, collection_stride)
+  collection, init = _init_collection(start, init, collection_idx,
+                                      snapshot_fn)
+
+  def sample_with_timestep(params, step):
+    state, rng, collection = params
+    i, t, t_prev = step
+
+    alpha_prod = alphas_prod[t]
+    alpha_prod_prev = jnp.where(t_prev >= 0, alphas_prod[t_prev], 1.)
+
+    # Predict x_0 and the noise it implies.
+    noise_condition_vec = jnp.sqrt(alpha_prod) * jnp.ones((init.shape[0], 1))
+    noise_condition_vec = noise_condition_vec.reshape(
+        init.shape[0], *([1] * len(init.shape[1:])))
+    eps_recon = model(state, noise_condition_vec)
+    state_recon = (state - jnp.sqrt(1 - alpha_prod) * eps_recon) / jnp.sqrt(
+        alpha_prod)
+    state_recon = jnp.clip(state_recon, -1., 1.)
+    eps_recon = (state - jnp.sqrt(alpha_prod) * state_recon) / jnp.sqrt(
+        1 - alpha_prod)
+
+    # Step to the previous visited timestep.
+    sigma = eta * jnp.sqrt((1 - alpha_prod_prev) / (1 - alpha_prod) *
+                           (1 - alpha_prod / alpha_prod_prev))
+    rng, noise_rng, infill_noise_rng = jax.random.split(rng, num=3)
+    noise = sigma * jax.random.normal(key=noise_rng, shape=state.shape)
+    direction = jnp.sqrt(jnp.maximum(1 - alpha_prod_prev - sigma**2, 0.))
+    next_state = jnp.sqrt(
+        alpha_prod_prev) * state_recon + direction * eps_recon + noise
+
+    if target_latents is not None:
+      grad = target_similarity_grad(next_state, target_latents, target_masks)
+      next_state = next_state - (guidance_scale * grad)
+
+    # Infill with known samples noised to the level of the next state.
+    infill_noise = jax.random.normal(key=infill_noise_rng,
+                                     shape=infill_samples.shape)
+    y = jnp.sqrt(alpha_prod_prev) * infill_samples + jnp.sqrt(
+        1 - alpha_prod_prev) * infill_noise
+    next_state = next_state * (1 - infill_masks) + y * infill_masks
+
+    # Collect metrics
+    step = state - next_state
+    grad_norm = _norm_mean(eps_recon, sample_weights)
+    noise_norm = _norm_mean(noise, sample_weights)
+    step_norm = _norm_mean(step, sample_weights)
+    metrics = (grad_norm, step_norm, alpha_prod, noise_norm)
+
+    # Collect samples
+    image_idx = num_steps - i
+    collection, next_state = _collect(collection, collection_idx, image_idx,
+                                      next_state, snapshot_fn)
+
+    next_params = (next_state, rng, collection)
+    return next_params, metrics
+
+  init_params = (init, rng, collection)
+  steps = (jnp.arange(num_steps)[::-1], timesteps[::-1], prev_timesteps[::-1])
+  ld_state, ld_metrics = jax.lax.scan(sample_with_timestep, init_params, steps)
+  state, rng, collection = ld_state
+  collection = _final_collection(collection, start, state)
   ld_metrics = jnp.stack(ld_metrics)
   ld_metrics = jnp.expand_dims(ld_metrics, 2)
   return state, collection, ld_metrics
 
 
+def batched_sampling(sampling_algorithm,
+                     rng,
+                     model,
+                     sigmas,
+                     inits,
+                     epsilon,
+                     T,
+                     denoise,
+                     collection_stride=None):
+  """Runs a sampling algorithm over a stack of initial states at once.
+
+  Every initial state shares the same random number generator, so the result
+  matches calling `sampling_algorithm` on each entry of `inits` in turn, but
+  the reverse process is compiled and dispatched only once.
+
+  Args:
+    sampling_algorithm: Sampling function (e.g. diffusion_dynamics).
+    rng: Random number generator key shared by all initial states.
+    model: Score or diffusion network.
+    sigmas: Noise schedule.
+    inits: Initial states with shape (num_inits, num_samples, *data_shape).
+    epsilon: Step size coefficient.
+    T: Number of steps per noise level.
+    denoise: Apply an additional denoising step to final samples.
+    collection_stride: Collect the state every `collection_stride` steps.
+
+  Returns:
+    The outputs of `sampling_algorithm`, each with an additional leading
+    axis of size num_inits.
+  """
+  sample_fn = lambda init: sampling_algorithm(rng, model, sigmas, init,
+                                              epsilon, T, denoise, False,
+                                              collection_stride)
+  return jax.vmap(sample_fn)(inits)
+
+
 def collate_sampling_metrics(ld_metrics):
   """Converts Langevin metrics into TensorBoard-readable format.
   
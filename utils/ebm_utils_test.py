@@ -0,0 +1,55 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for ebm_utils."""
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+
+from utils import ebm_utils
+
+
+class CreateDDIMTimestepsTest(parameterized.TestCase):
+
+  @parameterized.parameters('uniform', 'quadratic')
+  def test_strided_timesteps(self, spacing):
+    timesteps = np.asarray(
+        ebm_utils.create_ddim_timesteps(1000, 50, spacing=spacing))
+    # Rounding can merge the first few quadratic timesteps.
+    self.assertBetween(len(timesteps), 45, 50)
+    self.assertEqual(timesteps[0], 0)
+    self.assertEqual(timesteps[-1], 999)
+    self.assertTrue(np.all(np.diff(timesteps) > 0))
+
+  def test_uniform_spacing(self):
+    timesteps = ebm_utils.create_ddim_timesteps(101, 11)
+    np.testing.assert_array_equal(timesteps, np.arange(0, 101, 10))
+
+  def test_quadratic_spacing_is_denser_at_low_noise(self):
+    timesteps = np.asarray(
+        ebm_utils.create_ddim_timesteps(1000, 50, spacing='quadratic'))
+    self.assertLess(timesteps[1] - timesteps[0], timesteps[-1] - timesteps[-2])
+
+  def test_more_steps_than_timesteps(self):
+    timesteps = ebm_utils.create_ddim_timesteps(10, 50)
+    np.testing.assert_array_equal(timesteps, np.arange(10))
+
+  def test_unknown_spacing(self):
+    with self.assertRaises(ValueError):
+      ebm_utils.create_ddim_timesteps(1000, 50, spacing='cosine')
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,207 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Utilities for building guidance targets."""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from absl import logging
+
+
+def parse_indices(s):
+  """Parses a string of indices, e.g. "0-3,7,10-12", into a list of ints."""
+  indices = set()
+  for part in s.split(','):
+    part = part.strip()
+    if '-' in part:
+      start, end = map(int, part.split('-'))
+      indices.update(range(start, end + 1))
+    else:
+      indices.add(int(part))
+  return sorted(indices)
+
+
+def parse_blend(spec):
+  """Parses a blend of latent files, e.g. "a.npy*0.8+b.npy*0.2".
+
+  Besides .npy files, latents can name an attribute vector of an indexed
+  .npz archive written by npy_mean.py, e.g. "attrib/attributes.npz:happy".
+
+  Returns:
+    A list of (path, weight) pairs. Missing weights default to 1.
+  """
+  blend = []
+  for part in spec.split('+'):
+    part = part.strip()
+    if '*' in part:
+      path, weight = part.rsplit('*', 1)
+      blend.append((os.path.expanduser(path.strip()), float(weight)))
+    else:
+      blend.append((os.path.expanduser(part), 1.))
+  return blend
+
+
+def parse_guidance_spec(spec_str):
+  """Splits a "<indices>:<spec>" string into its indices and blend."""
+  try:
+    indices_str, blend_str = spec_str.split(':', 1)
+  except ValueError:
+    raise ValueError(f'Invalid guidance spec: "{spec_str}". '
+                     'Expected "<indices>:<spec>".')
+  return parse_indices(indices_str), parse_blend(blend_str)
+
+
+def load_guidance_manifest(path):
+  """Loads guidance specs from a manifest file.
+
+  The manifest is either a JSON list of {"indices": "0-15", "spec":
+  "a.npy*0.5+b.npy*0.5"} objects or a text file with one "<indices>:<spec>"
+  entry per line. Blank lines and lines starting with '#' are ignored.
+
+  Returns:
+    A list of (indices, blend) pairs.
+  """
+  with open(os.path.expanduser(path), 'r') as f:
+    content = f.read()
+
+  if path.endswith('.json'):
+    return [(parse_indices(str(entry['indices'])), parse_blend(entry['spec']))
+            for entry in json.loads(content)]
+
+  specs = []
+  for line in content.splitlines():
+    line = line.strip()
+    if line and not line.startswith('#'):
+      specs.append(parse_guidance_spec(line))
+  return specs
+
+
+def _split_archive_path(path):
+  """Splits "archive.npz:name" into its file and attribute name."""
+  if '.npz:' in path:
+    file_path, name = path.rsplit(':', 1)
+    return file_path, name
+  return path, None
+
+
+def load_latents(paths):
+  """Loads the latents at paths, opening every .npz archive only once.
+
+  Archives hold the attribute names in 'names' and the stacked attribute
+  vectors in 'means'.
+
+  Returns:
+    An array with shape (len(paths), *latent_shape).
+  """
+  archives = {}
+  latents = []
+  for path in paths:
+    file_path, name = _split_archive_path(path)
+    if name is None:
+      latents.append(np.load(file_path))
+      continue
+    if file_path not in archives:
+      with np.load(file_path) as archive:
+        archives[file_path] = (
+            {n: i for i, n in enumerate(archive['names'].tolist())},
+            archive['means'])
+    index, means = archives[file_path]
+    if name not in index:
+      raise ValueError(f'Attribute "{name}" not found in {file_path}. '
+                       f'Available attributes: {sorted(index)}')
+    latents.append(means[index[name]])
+  return np.stack(latents)
+
+
+def _cache_key(specs, num_samples):
+  """Hashes guidance specs together with the size and mtime of each file."""
+  paths = sorted({_split_archive_path(path)[0]
+                  for _, blend in specs for path, _ in blend})
+  stats = [(p, os.path.getsize(p), os.path.getmtime(p)) for p in paths]
+  config = json.dumps([specs, stats, num_samples], sort_keys=True)
+  return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+
+def blend_guidance_targets(specs, num_samples, cache_dir=None):
+  """Blends the latents of each spec and assigns them to samples.
+
+  Every latent file is loaded once and all blends are computed with a single
+  matrix product. Later specs take precedence for samples listed twice.
+
+  Args:
+    specs: A list of (indices, blend) pairs.
+    num_samples: Number of samples to assign targets to.
+    cache_dir: Optional directory where the result is cached.
+
+  Returns:
+    blends: Array of blended latents with shape (num_specs, *latent_shape).
+    assignment: Integer array with shape (num_samples,) holding the index of
+        the blend assigned to each sample, or -1 for unguided samples.
+  """
+  cache_path = None
+  if cache_dir is not None:
+    cache_path = os.path.join(os.path.expanduser(cache_dir),
+                              f'guidance_{_cache_key(specs, num_samples)}.npz')
+    if os.path.exists(cache_path):
+      logging.info('Using cached guidance targets at %s', cache_path)
+      cached = np.load(cache_path)
+      return cached['blends'], cached['assignment']
+
+  paths = sorted({path for _, blend in specs for path, _ in blend})
+  latents = load_latents(paths).astype(np.float32)
+  logging.info('Loaded %i guidance latents with shape %s', len(paths),
+               latents.shape[1:])
+
+  path_idx = {path: i for i, path in enumerate(paths)}
+  weights = np.zeros((len(specs), len(paths)), dtype=np.float32)
+  assignment = np.full((num_samples,), -1, dtype=np.int32)
+  for i, (indices, blend) in enumerate(specs):
+    for path, weight in blend:
+      weights[i, path_idx[path]] += weight
+
+    indices = np.asarray(indices, dtype=np.int64)
+    out_of_range = (indices < 0) | (indices >= num_samples)
+    if out_of_range.any():
+      logging.warning('Ignoring out of range guidance indices: %s',
+                      indices[out_of_range].tolist())
+    assignment[indices[~out_of_range]] = i
+
+  blends = weights @ latents.reshape(len(paths), -1)
+  blends = blends.reshape(len(specs), *latents.shape[1:])
+
+  if cache_path is not None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    np.savez(cache_path, blends=blends, assignment=assignment)
+    logging.info('Saved guidance targets to %s', cache_path)
+
+  return blends, assignment
+
+
+def assign_guidance_targets(blends, assignment):
+  """Gathers per-sample targets and masks from blends and their assignment.
+
+  Returns:
+    targets: Array with shape (num_samples, *blend_shape). Unguided samples
+        have a zero target.
+    masks: Float array with shape (num_samples,) that is zero for unguided
+        samples.
+  """
+  masks = (assignment >= 0).astype(np.float32)
+  targets = blends[np.maximum(assignment, 0)]
+  targets = targets * masks.reshape(-1, *([1] * (targets.ndim - 1)))
+  return targets, masks
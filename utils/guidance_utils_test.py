@@ -0,0 +1,65 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for guidance_utils."""
+import os
+
+from absl.testing import absltest
+import numpy as np
+
+from utils import guidance_utils
+
+
+class GuidanceUtilsTest(absltest.TestCase):
+
+  def test_parse_indices(self):
+    self.assertEqual(guidance_utils.parse_indices('0-3, 7,10-12,2'),
+                     [0, 1, 2, 3, 7, 10, 11, 12])
+
+  def test_parse_guidance_spec(self):
+    indices, blend = guidance_utils.parse_guidance_spec(
+        '0-1:a.npy*0.8+b.npy*0.2')
+    self.assertEqual(indices, [0, 1])
+    self.assertEqual(blend, [('a.npy', 0.8), ('b.npy', 0.2)])
+
+  def test_parse_guidance_spec_archive_with_default_weight(self):
+    indices, blend = guidance_utils.parse_guidance_spec(
+        '4:attrib/attributes.npz:happy')
+    self.assertEqual(indices, [4])
+    self.assertEqual(blend, [('attrib/attributes.npz:happy', 1.)])
+
+  def test_parse_guidance_spec_without_indices(self):
+    with self.assertRaises(ValueError):
+      guidance_utils.parse_guidance_spec('a.npy')
+
+  def test_load_latents(self):
+    tmp_dir = self.create_tempdir().full_path
+    latent = np.arange(4, dtype=np.float32)
+    means = np.stack([np.ones(4), 2 * np.ones(4)]).astype(np.float32)
+    npy_path = os.path.join(tmp_dir, 'a.npy')
+    npz_path = os.path.join(tmp_dir, 'attributes.npz')
+    np.save(npy_path, latent)
+    np.savez(npz_path, names=np.array(['happy', 'sad']), means=means)
+
+    latents = guidance_utils.load_latents(
+        [npy_path, f'{npz_path}:sad', f'{npz_path}:happy'])
+    np.testing.assert_array_equal(latents, [latent, means[1], means[0]])
+
+    with self.assertRaises(ValueError):
+      guidance_utils.load_latents([f'{npz_path}:angry'])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -319,3 +319,29 @@ def target_similarity_loss(current_latents, target_latents):
   
   loss = jnp.mean(jnp.square(current_latents - target_latents))
   return loss
+
+
+def target_similarity_grad(current_latents, target_latents, target_masks=None):
+  """Closed-form gradient of the per-sample target similarity loss.
+
+  This is the gradient of the mean squared error of each sample, summed over
+  samples, so that the guidance applied to a sample does not depend on how
+  many other samples share its batch (unlike the gradient of
+  target_similarity_loss, which averages over the whole batch).
+
+  Args:
+    current_latents: Current samples.
+    target_latents: Targets broadcastable to the shape of current_latents.
+    target_masks: Optional per-sample weights with shape (batch_size,).
+        Samples with a zero weight are not guided.
+
+  Returns:
+    Gradient with the same shape as current_latents.
+  """
+  sample_size = current_latents.size // current_latents.shape[0]
+  grad = 2. * (current_latents - target_latents) / sample_size
+  if target_masks is not None:
+    target_masks = target_masks.reshape(
+        target_masks.shape + (1,) * (grad.ndim - target_masks.ndim))
+    grad = grad * target_masks
+  return grad
@@ -0,0 +1,64 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for losses."""
+from absl.testing import absltest
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from utils import losses
+
+
+def _per_sample_loss(current_latents, target_latents):
+  """Sum over samples of the mean squared error of each sample."""
+  error = jnp.square(current_latents - target_latents)
+  return jnp.mean(error, axis=tuple(range(1, error.ndim))).sum()
+
+
+class TargetSimilarityGradTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.current = rng.randn(4, 3, 5).astype(np.float32)
+    self.target = rng.randn(4, 3, 5).astype(np.float32)
+
+  def test_matches_autodiff(self):
+    grad = losses.target_similarity_grad(self.current, self.target)
+    expected = jax.grad(_per_sample_loss)(self.current, self.target)
+    np.testing.assert_allclose(grad, expected, rtol=1e-5, atol=1e-7)
+
+  def test_independent_of_batch_size(self):
+    grad = losses.target_similarity_grad(self.current, self.target)
+    single = losses.target_similarity_grad(self.current[:1], self.target[:1])
+    np.testing.assert_allclose(grad[:1], single, rtol=1e-6)
+
+  def test_broadcast_target(self):
+    grad = losses.target_similarity_grad(self.current, self.target[0])
+    expected = losses.target_similarity_grad(
+        self.current, np.broadcast_to(self.target[0], self.current.shape))
+    np.testing.assert_allclose(grad, expected, rtol=1e-6)
+
+  def test_masks(self):
+    masks = np.array([1., 0., 1., 0.], np.float32)
+    grad = losses.target_similarity_grad(self.current, self.target, masks)
+    unmasked = losses.target_similarity_grad(self.current, self.target)
+    np.testing.assert_allclose(grad[::2], unmasked[::2], rtol=1e-6)
+    np.testing.assert_array_equal(grad[1::2], 0.)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,334 @@
+# Copyright 2021 The Magenta Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Utilities for running Beam DoFns locally with a process pool."""
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+
+from absl import flags
+from absl import logging
+
+_DONE = '__done__'
+
+
+class _Counter(object):
+  """Counter with the interface of a Beam metrics counter."""
+
+  def __init__(self, values, key):
+    self.values = values
+    self.key = key
+
+  def inc(self, n=1):
+    self.values[self.key] += n
+
+  def dec(self, n=1):
+    self.values[self.key] -= n
+
+
+class Counters(object):
+  """Collects Beam counters of a worker process by namespace and name."""
+
+  def __init__(self):
+    self.values = collections.Counter()
+
+  def counter(self, namespace, name):
+    return _Counter(self.values, f'{namespace}:{name}')
+
+
+def read_tfrecords(file_pattern):
+  """Yields the raw records of all TFRecord files matching a pattern."""
+  import tensorflow as tf  # pylint: disable=g-import-not-at-top
+  filenames = sorted(tf.io.gfile.glob(os.path.expanduser(file_pattern)))
+  logging.info('Reading %d TFRecord files from %s', len(filenames),
+               file_pattern)
+  for record in tf.data.TFRecordDataset(filenames).as_numpy_iterator():
+    yield record
+
+
+def manifest_split(output, split=None):
+  """Name of the manifest split of an output path prefix.
+
+  Args:
+    output: Output path prefix, e.g. ~/data/training_seqs.tfrecord.
+    split: Explicit split name, which takes precedence.
+
+  Returns:
+    split, or 'train' or 'eval' if the output name contains it.
+  """
+  if split:
+    return split
+  name = os.path.basename(os.path.expanduser(output))
+  for candidate in ('train', 'eval'):
+    if candidate in name:
+      return candidate
+  logging.warning('Could not infer the split of %s, recording it as %s. Set '
+                  '--split to name it.', output, name)
+  return name
+
+
+def write_manifest(shards, output, split):
+  """Records written shards in the manifest next to an output path prefix.
+
+  The output path and split are arguments (rather than flags) since absl
+  flags are not parsed on remote Beam workers.
+  """
+  from . import data_utils  # pylint: disable=g-import-not-at-top
+  output = os.path.abspath(os.path.expanduser(output))
+  data_utils.write_shard_manifest(os.path.dirname(output), split, shards)
+
+
+def _shard_key(record, num_shards):
+  return zlib.crc32(record) % num_shards, record
+
+
+def _write_tfrecord_shard(index, records, output, num_shards):
+  """Writes the records of one shard, counting them as they are written."""
+  import tensorflow as tf  # pylint: disable=g-import-not-at-top
+  from . import data_utils  # pylint: disable=g-import-not-at-top
+  path = f'{output}-{index:05d}-of-{num_shards:05d}'
+  num_records = 0
+  with tf.io.TFRecordWriter(path) as writer:
+    for record in records:
+      writer.write(record)
+      num_records += 1
+  # The checksum is computed by the worker that wrote the shard, while the
+  # file is still in the page cache.
+  return {
+      'path': path,
+      'num_records': num_records,
+      'checksum': data_utils.file_checksum(path)
+  }
+
+
+def write_tfrecords(records, output, split, num_shards=64):
+  """Writes a PCollection of records to TFRecord shards and a manifest.
+
+  Records are distributed over num_shards shards by a hash of their content
+  (which also shuffles them) and counted while they are written, so the
+  manifest does not need to parse the shards again. Shards are named like
+  those of beam.io.WriteToTFRecord.
+
+  Args:
+    records: A PCollection of serialized records.
+    output: Output path prefix of the shards, resolved by the caller.
+    split: Name of the split in the manifest.
+    num_shards: Number of output shards.
+
+  Returns:
+    A PCollection with the manifest entry of the split.
+  """
+  import apache_beam as beam  # pylint: disable=g-import-not-at-top
+  output = os.path.abspath(os.path.expanduser(output))
+  return (records
+          | 'key_by_shard' >> beam.Map(_shard_key, num_shards=num_shards)
+          | 'group_shards' >> beam.GroupByKey()
+          | 'write_shards' >> beam.MapTuple(_write_tfrecord_shard,
+                                            output=output,
+                                            num_shards=num_shards)
+          | 'collect_shards' >> beam.combiners.ToList()
+          | 'write_manifest' >> beam.Map(write_manifest,
+                                         output=output,
+                                         split=split))
+
+
+def _batch(elements, batch_size):
+  batch = []
+  for element in elements:
+    batch.append(element)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def _worker(dofn_cls, argv, input_queue, output_queue):
+  """Runs a DoFn over the elements of input_queue until it is exhausted."""
+  flags.FLAGS(argv, known_only=True)
+
+  # Route the DoFn's Beam counters to this process.
+  from apache_beam.metrics import Metrics  # pylint: disable=g-import-not-at-top
+  counters = Counters()
+  Metrics.counter = counters.counter
+
+  dofn = dofn_cls()
+  dofn.setup()
+  try:
+    while True:
+      element = input_queue.get()
+      if element is None:
+        break
+      try:
+        for output in dofn.process(element) or []:
+          output_queue.put(output)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error('Failed to process element: %s', e, exc_info=True)
+        counters.counter('LocalRunner', 'failed_element').inc()
+  finally:
+    dofn.teardown()
+    output_queue.put((_DONE, dict(counters.values)))
+
+
+def _write_shards(output_queue, output, num_shards, num_workers, state):
+  """Writes outputs round-robin to TFRecord shards until all workers finish.
+
+  An exception is stored in state['error'] for the main thread to re-raise.
+  """
+  try:
+    _write_shards_or_raise(output_queue, output, num_shards, num_workers,
+                           state)
+  except Exception as e:  # pylint: disable=broad-except
+    state['error'] = e
+
+
+def _write_shards_or_raise(output_queue, output, num_shards, num_workers,
+                           state):
+  import tensorflow as tf  # pylint: disable=g-import-not-at-top
+  output = os.path.abspath(os.path.expanduser(output))
+  os.makedirs(os.path.dirname(output), exist_ok=True)
+  paths = [f'{output}-{i:05d}-of-{num_shards:05d}' for i in range(num_shards)]
+  writers = [tf.io.TFRecordWriter(path) for path in paths]
+  finished = 0
+  while finished < num_workers:
+    item = output_queue.get()
+    if isinstance(item, tuple) and item[0] == _DONE:
+      state['counters'].update(item[1])
+      finished += 1
+      continue
+    writers[state['written'] % num_shards].write(item)
+    state['written'] += 1
+  for writer in writers:
+    writer.close()
+  state['shards'] = [{
+      'path': path,
+      'num_records': state['written'] // num_shards +
+                     (i < state['written'] % num_shards)
+  } for i, path in enumerate(paths)]
+
+
+def run_local(dofn_cls,
+              elements,
+              output,
+              num_workers=None,
+              num_shards=None,
+              queue_size=256,
+              batch_size=None,
+              log_every=30.,
+              manifest_fn=None):
+  """Runs a Beam DoFn over elements with a local pool of processes.
+
+  Each worker process constructs and sets up its own DoFn (e.g. loading one
+  TrainedModel per worker) and reads elements from a bounded input queue.
+  Outputs are sent through a bounded queue to a writer that distributes them
+  over TFRecord shards named like those of beam.io.WriteToTFRecord. Counters
+  incremented through Metrics.counter are collected from all workers.
+
+  Args:
+    dofn_cls: The DoFn class. It is instantiated without arguments in every
+        worker and reads its configuration from absl flags.
+    elements: An iterable of input elements.
+    output: Output path prefix of the TFRecord shards.
+    num_workers: Number of worker processes. Defaults to the CPU count.
+    num_shards: Number of output shards. Defaults to num_workers.
+    queue_size: Maximum number of pending elements in each queue.
+    batch_size: If set, elements are grouped into lists of this size, like
+        beam.BatchElements.
+    log_every: Interval in seconds between progress reports.
+    manifest_fn: Optional function called with the list of written shards as
+        {'path', 'num_records'} dictionaries, e.g. to write a manifest.
+
+  Returns:
+    A dictionary of counters keyed by "namespace:name".
+  """
+  num_workers = num_workers or os.cpu_count()
+  num_shards = num_shards or num_workers
+  if batch_size is not None:
+    elements = _batch(elements, batch_size)
+
+  # Spawn fresh interpreters, since TensorFlow is not fork-safe.
+  context = multiprocessing.get_context('spawn')
+  input_queue = context.Queue(queue_size)
+  output_queue = context.Queue(queue_size)
+  workers = [
+      context.Process(target=_worker,
+                      args=(dofn_cls, sys.argv, input_queue, output_queue),
+                      daemon=True) for _ in range(num_workers)
+  ]
+  for worker in workers:
+    worker.start()
+
+  state = {'written': 0, 'counters': collections.Counter()}
+  writer = threading.Thread(target=_write_shards,
+                            args=(output_queue, output, num_shards,
+                                  num_workers, state),
+                            daemon=True)
+  writer.start()
+
+  def check_writer():
+    if 'error' in state:
+      raise RuntimeError('Writing the output shards failed.') from state['error']
+
+  def put(element):
+    while True:
+      try:
+        input_queue.put(element, timeout=1.)
+        return
+      except queue.Full:
+        check_writer()
+        if not any(worker.is_alive() for worker in workers):
+          raise RuntimeError('All workers exited before the input was read.')
+
+  t0 = last_log = time.time()
+  read = 0
+  for element in elements:
+    put(element)
+    read += 1
+    if time.time() - last_log > log_every:
+      last_log = time.time()
+      logging.info('Read %d inputs, wrote %d outputs (%.1f inputs/s)', read,
+                   state['written'], read / (last_log - t0))
+  for _ in workers:
+    put(None)
+
+  while writer.is_alive():
+    writer.join(log_every)
+    if writer.is_alive():
+      logging.info('Wrote %d outputs', state['written'])
+      if any(worker.exitcode not in (None, 0) for worker in workers):
+        raise RuntimeError('A worker exited unexpectedly.')
+  check_writer()
+  for worker in workers:
+    worker.join()
+
+  counters = dict(state['counters'])
+  logging.info('Processed %d inputs into %d outputs in %.1f seconds', read,
+               state['written'], time.time() - t0)
+  for key in sorted(counters):
+    logging.info('%s: %d', key, counters[key])
+
+  if manifest_fn is not None:
+    manifest_fn(state['shards'])
+
+  counters_path = f'{os.path.expanduser(output)}-counters.json'
+  with open(counters_path, 'w') as f:
+    json.dump(counters, f, indent=2, sort_keys=True)
+  return counters
@@ -14,8 +14,14 @@
 
 # Lint as: python3
 """Utilities for manipulating multi-measure NoteSequences."""
+import copy
+import glob
+import hashlib
+import io
 import os
+import sqlite3
 import sys
+import time
 
 import note_seq
 import numpy as np
@@ -139,7 +145,7 @@ def fix_chunk_lengths_for_concatenation(note_sequences):
     chunk.total_time = max_chunk_time
 
 
-def chunks_to_embeddings(sequences, model, data_converter):
+def chunks_to_embeddings(sequences, model, data_converter, rest_mask=None):
   """Convert NoteSequence objects into latent space embeddings.
 
   Args:
@@ -148,6 +154,9 @@ def chunks_to_embeddings(sequences, model, data_converter):
     data_converter: A data converter (e.g. OneHotMelodyConverter, 
         TrioConverter) used to convert NoteSequence objects into
         tensor encodings for model inference.
+    rest_mask: An optional boolean array marking the sequences that are
+        rests, e.g. from Song.tokenize. Rests are detected with the data
+        converter if not provided.
 
   Returns:
     A numpy matrix of shape [len(sequences), latent_dims].
@@ -155,13 +164,20 @@ def chunks_to_embeddings(sequences, model, data_converter):
   assert model is not None, 'No model provided.'
 
   latent_dims = model._z_input.shape[1]
+  if rest_mask is None:
+    rest_mask = [
+        len(data_converter.to_tensors(chunk).inputs) == 0
+        for chunk in sequences
+    ]
+  assert len(rest_mask) == len(sequences)
+
   idx = []
   non_rest_chunks = []
   zs = np.zeros((len(sequences), latent_dims))
   mus = np.zeros((len(sequences), latent_dims))
   sigmas = np.zeros((len(sequences), latent_dims))
   for i, chunk in enumerate(sequences):
-    if len(data_converter.to_tensors(chunk).inputs) > 0:
+    if not rest_mask[i]:
       idx.append(i)
       non_rest_chunks.append(chunk)
   if non_rest_chunks:
@@ -228,7 +244,144 @@ def embeddings_to_song(embeddings,
   return Song(concat_chunks, data_converter, reconstructed=True)
 
 
-def encode_songs(model, songs, chunk_length=None, programs=None):
+def checkpoint_fingerprint(checkpoint):
+  """Fingerprints a TensorFlow checkpoint by hashing its index files.
+
+  Checkpoint index files hold a checksum of every saved tensor, so their
+  content identifies the weights without reading the data shards. Checkpoints
+  without an index file are fingerprinted by the size and modification time
+  of their files instead of their (possibly large) content.
+
+  Args:
+    checkpoint: A checkpoint path prefix (e.g. model.ckpt-1000) or directory.
+
+  Returns:
+    A hexadecimal digest.
+  """
+  checkpoint = os.path.expanduser(checkpoint)
+  if os.path.isdir(checkpoint):
+    paths = glob.glob(os.path.join(checkpoint, '*.index'))
+  else:
+    paths = glob.glob(f'{checkpoint}.index') or glob.glob(f'{checkpoint}*')
+  assert paths, f'No checkpoint found at {checkpoint}'
+
+  digest = hashlib.sha256()
+  for path in sorted(paths):
+    digest.update(os.path.basename(path).encode('utf-8'))
+    if path.endswith('.index'):
+      with open(path, 'rb') as f:
+        digest.update(f.read())
+    else:
+      stat = os.stat(path)
+      digest.update(f':{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+  return digest.hexdigest()[:16]
+
+
+class EmbeddingCache(object):
+  """Persistent cache of song embeddings backed by a sqlite file.
+
+  Entries are keyed by the content of the NoteSequence together with a
+  namespace that identifies the model (e.g. its configuration name and
+  checkpoint fingerprint) and the chunking parameters. Once the cache grows
+  beyond max_bytes, the least recently used entries are evicted.
+
+  Reads do not write to the database: access times of cache hits are
+  buffered and recorded with the next put, evict or close, so concurrent
+  readers do not contend for the sqlite write lock.
+
+  Attributes:
+    path: Path to the sqlite database.
+    namespace: A string identifying the model that produced the embeddings.
+    max_bytes: Maximum total size of the cached embeddings.
+  """
+
+  def __init__(self, path, namespace='', max_bytes=2**34, evict_every=100):
+    self.path = os.path.expanduser(path)
+    self.namespace = namespace
+    self.max_bytes = max_bytes
+    self.evict_every = evict_every
+    self._puts = 0
+    self._accessed = {}
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY '
+                     'KEY, value BLOB, size INTEGER, accessed REAL)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON '
+                     'embeddings (accessed)')
+    self._db.commit()
+
+  def key(self, song, chunk_length=None, programs=None):
+    """Content-addressed key of a song's embedding."""
+    chunk_length = song.chunk_length if chunk_length is None else chunk_length
+    programs = None if programs is None else sorted(programs)
+    digest = hashlib.sha256(
+        song.note_sequence.SerializeToString(deterministic=True))
+    digest.update(f'{self.namespace}:{chunk_length}:{programs}:'
+                  f'{song.multitrack}'.encode('utf-8'))
+    return digest.hexdigest()
+
+  def get(self, key):
+    """Returns the cached embedding for key or None."""
+    row = self._db.execute('SELECT value FROM embeddings WHERE key = ?',
+                           (key,)).fetchone()
+    if row is None:
+      return None
+    self._accessed[key] = time.time()
+    return np.load(io.BytesIO(row[0]), allow_pickle=False)
+
+  def put(self, key, encoding):
+    """Stores an embedding and evicts old entries if the cache is full."""
+    buffer = io.BytesIO()
+    np.save(buffer, encoding, allow_pickle=False)
+    value = buffer.getvalue()
+    self._accessed.pop(key, None)
+    self._write_accessed()
+    self._db.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)',
+                     (key, value, len(value), time.time()))
+    self._db.commit()
+
+    self._puts += 1
+    if self._puts % self.evict_every == 0:
+      self.evict()
+
+  def _write_accessed(self):
+    """Records the buffered access times (committed by the caller)."""
+    if not self._accessed:
+      return
+    self._db.executemany('UPDATE embeddings SET accessed = ? WHERE key = ?',
+                         [(t, key) for key, t in self._accessed.items()])
+    self._accessed = {}
+
+  def evict(self):
+    """Evicts least recently used entries until the cache fits max_bytes."""
+    self._write_accessed()
+    self._db.commit()
+    total = self._db.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM embeddings').fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    excess = total - self.max_bytes
+    evicted = 0
+    rows = self._db.execute(
+        'SELECT key, size FROM embeddings ORDER BY accessed').fetchall()
+    keys = []
+    for key, size in rows:
+      if evicted >= excess:
+        break
+      keys.append((key,))
+      evicted += size
+    self._db.executemany('DELETE FROM embeddings WHERE key = ?', keys)
+    self._db.commit()
+
+  def close(self):
+    self._write_accessed()
+    self._db.commit()
+    self._db.close()
+
+
+def encode_songs(model, songs, chunk_length=None, programs=None, cache=None):
   """Generate embeddings for a batch of songs.
 
   Args:
@@ -238,6 +391,8 @@ def encode_songs(model, songs, chunk_length=None, programs=None):
         each chunk of each song should contain.
     programs: A list of integers specifying which MIDI programs to use.
         Default is to keep all available programs.
+    cache: An optional EmbeddingCache. Only songs missing from the cache are
+        encoded, and their embeddings are added to it.
 
   Returns:
     A list of numpy matrices each with shape [3, len(song_chunks), latent_dims].
@@ -245,27 +400,43 @@ def encode_songs(model, songs, chunk_length=None, programs=None):
   assert model is not None, 'No model provided.'
   assert len(songs) > 0, 'No songs provided.'
 
-  chunks, splits = [], []
+  encoding = [None] * len(songs)
+  keys = [None] * len(songs)
+  if cache is not None:
+    for i, song in enumerate(songs):
+      keys[i] = cache.key(song, chunk_length=chunk_length, programs=programs)
+      encoding[i] = cache.get(keys[i])
+  missing = [i for i in range(len(songs)) if encoding[i] is None]
+  if not missing:
+    return encoding
+
+  chunks, rest_mask, splits = [], [], []
   data_converter = songs[0].data_converter
   i = 0
-  for song in songs:
+  for song in [songs[idx] for idx in missing]:
     chunk_tensors, chunk_sequences = song.chunks(chunk_length=chunk_length,
                                                  programs=programs)
     del chunk_tensors
     chunks.extend(chunk_sequences)
+    rest_mask.extend(
+        song.tokenize(chunk_length=chunk_length, programs=programs)[2])
     splits.append(i)
     i += len(chunk_sequences)
 
-  z, mu, sigma = chunks_to_embeddings(chunks, model, data_converter)
+  z, mu, sigma = chunks_to_embeddings(chunks,
+                                      model,
+                                      data_converter,
+                                      rest_mask=rest_mask)
 
-  encoding = []
-  for i in range(len(splits)):
+  for i, idx in enumerate(missing):
     j, k = splits[i], None if i + 1 == len(splits) else splits[i + 1]
     song_encoding = [z[j:k], mu[j:k], sigma[j:k]]
     song_encoding = np.stack(song_encoding)
-    encoding.append(song_encoding)
+    encoding[idx] = song_encoding
+    if cache is not None:
+      cache.put(keys[idx], song_encoding)
 
-  assert len(encoding) == len(splits) == len(songs)
+  assert len(splits) == len(missing) and len(encoding) == len(songs)
   return encoding
 
 
@@ -294,6 +465,11 @@ class Song(object):
     self.chunk_length = chunk_length
     self.reconstructed = reconstructed
     self.multitrack = multitrack
+    self._tokenizations = {}
+    self._melody_chunk_counts = {}
+    self._program_index = None
+    self._empty_sequence = None
+    self._num_measures = None
 
   def encode(self, model, chunk_length=None, programs=None):
     """Encode song chunks (and full-chunk rests).
@@ -303,53 +479,100 @@ class Song(object):
     """
     chunk_tensors, chunk_sequences = self.chunks(chunk_length=chunk_length,
                                                  programs=programs)
-    z, means, sigmas = chunks_to_embeddings(chunk_sequences, model,
-                                            self.data_converter)
+    rest_mask = self.tokenize(chunk_length=chunk_length, programs=programs)[2]
+    z, means, sigmas = chunks_to_embeddings(chunk_sequences,
+                                            model,
+                                            self.data_converter,
+                                            rest_mask=rest_mask)
     del chunk_tensors  # unused
     return z
 
-  def chunks(self, chunk_length=None, programs=None, fix_instruments=True):
-    """Split and featurize song into chunks of tensors and NoteSequences."""
+  def tokenize(self, chunk_length=None, programs=None):
+    """Tokenizes the song once per chunk length and program selection.
+
+    The result is cached on the Song, so repeated calls (e.g. from chunks,
+    truncate, download and encoding) share a single pass of the data
+    converter. The returned objects are shared and should not be modified.
+
+    Returns:
+      tensors: Input tensors of each chunk.
+      sequences: NoteSequence of each chunk.
+      rest_mask: Boolean array that is True for chunks without notes.
+    """
     assert not self.reconstructed, 'Not safe to tokenize reconstructed Songs.'
 
-    data = self.note_sequence
-    step_size = self.chunk_length
-    if chunk_length is not None:
-      step_size = chunk_length
-    if programs is not None:
-      data = self.select_programs(programs)
+    step_size = self.chunk_length if chunk_length is None else chunk_length
+    key = (step_size, None if programs is None else tuple(sorted(programs)))
+    if key not in self._tokenizations:
+      data = self.note_sequence
+      if programs is not None:
+        data = self.select_programs(programs)
+
+      # Use the data converter to preprocess sequences
+      tensors = self.data_converter.to_tensors(data).inputs[::step_size]
+      sequences = self.data_converter.from_tensors(tensors)
+      rest_mask = np.array([len(seq.notes) == 0 for seq in sequences],
+                           dtype=bool)
+      self._tokenizations[key] = (tensors, sequences, rest_mask)
+    return self._tokenizations[key]
 
-    # Use the data converter to preprocess sequences
-    tensors = self.data_converter.to_tensors(data).inputs[::step_size]
-    sequences = self.data_converter.from_tensors(tensors)
+  def chunks(self, chunk_length=None, programs=None, fix_instruments=True):
+    """Split and featurize song into chunks of tensors and NoteSequences."""
+    tensors, sequences, _ = self.tokenize(chunk_length=chunk_length,
+                                          programs=programs)
+    sequences = list(sequences)
 
     if fix_instruments and self.multitrack:
+      # Instrument assignment only depends on the chunks, so fixing the
+      # shared sequences in place is idempotent.
       fix_instruments_for_concatenation(sequences)
 
     return tensors, sequences
 
   def count_chunks(self, chunk_length=None):
     length = self.chunk_length if chunk_length is None else chunk_length
-    return count_measures(self.note_sequence) // length
+    if self._num_measures is None:
+      self._num_measures = count_measures(self.note_sequence)
+    return self._num_measures // length
+
+  @property
+  def program_index(self):
+    """Indices of the notes of each MIDI program, in their original order."""
+    if self._program_index is None:
+      note_programs = np.array(
+          [note.program for note in self.note_sequence.notes], dtype=np.int64)
+      order = np.argsort(note_programs, kind='stable')
+      programs, starts = np.unique(note_programs[order], return_index=True)
+      self._program_index = {
+          int(program): indices
+          for program, indices in zip(programs, np.split(order, starts[1:]))
+      }
+    return self._program_index
 
   @property
   def programs(self):
     """MIDI programs used in this song."""
-    return list(set([note.program for note in self.note_sequence.notes]))
+    return list(self.program_index.keys())
 
   def select_programs(self, programs):
     """Keeps selected programs of MIDI (e.g. melody program)."""
     assert len(programs) > 0
     assert all([program >= 0 for program in programs])
 
-    ns = note_seq.NoteSequence()
-    ns.CopyFrom(self.note_sequence)
-    del ns.notes[:]
+    if self._empty_sequence is None:
+      self._empty_sequence = note_seq.NoteSequence()
+      self._empty_sequence.CopyFrom(self.note_sequence)
+      del self._empty_sequence.notes[:]
 
-    for note in self.note_sequence.notes[:]:
-      if note.program in programs:
-        new_note = ns.notes.add()
-        new_note.CopyFrom(note)
+    ns = note_seq.NoteSequence()
+    ns.CopyFrom(self._empty_sequence)
+
+    index = self.program_index
+    selected = [index[p] for p in set(programs) if p in index]
+    if selected:
+      notes = self.note_sequence.notes
+      ns.notes.extend(
+          notes[i] for i in np.sort(np.concatenate(selected)).tolist())
     return ns
 
   def truncate(self, chunks=0, offset=0):
@@ -362,10 +585,8 @@ class Song(object):
       Returns:
         A truncated Song object.
     """
-    tensors = self.data_converter.to_tensors(
-        self.note_sequence).inputs[::self.chunk_length]
-    sequences = self.data_converter.from_tensors(tensors)[offset:offset +
-                                                          chunks]
+    _, sequences, _ = self.tokenize()
+    sequences = [copy.deepcopy(seq) for seq in sequences[offset:offset + chunks]]
     fix_instruments_for_concatenation(sequences)
     concat_chunks = note_seq.sequences_lib.concatenate_sequences(sequences)
     return Song(concat_chunks,
@@ -374,16 +595,19 @@ class Song(object):
 
   def _count_melody_chunks(self, program):
     """Determines the number of 2-measure chunks using the melody data pipeline."""
-    ns = self.select_programs([program])
-    tensors = melody_2bar_converter.to_tensors(ns).inputs[::2]
-    sequences = melody_2bar_converter.from_tensors(tensors)
-    return len(sequences)
+    if program not in self._melody_chunk_counts:
+      ns = self.select_programs([program])
+      # from_tensors returns one sequence per tensor, so only count tensors.
+      tensors = melody_2bar_converter.to_tensors(ns).inputs[::2]
+      self._melody_chunk_counts[program] = len(tensors)
+    return self._melody_chunk_counts[program]
 
   def find_programs(self):
     """Search for the most important MIDI programs in the song."""
 
+    expected = self.count_chunks(chunk_length=2)
+
     def heuristic(program):
-      expected = self.count_chunks(chunk_length=2)
       extracted = self._count_melody_chunks(program)
       if extracted > 0 and abs(extracted - expected) < 0.5 * expected:
         return True
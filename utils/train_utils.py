@@ -14,9 +14,12 @@
 
 # Lint as: python3
 """Training utilities."""
+import hashlib
+import json
 import jax
 import math
 import numpy as np
+import os
 
 from absl import logging
 from flax import struct
@@ -129,3 +132,101 @@ def report_model(model):
 
   logging.info('Number of trainable paramters: {:,}'.format(trainable_params))
   logging.info('Memory footprint: %dMB', footprint_bytes / 2**20)
+
+
+def enable_compilation_cache(cache_dir, config):
+  """Enables the persistent XLA compilation cache.
+
+  Compiled executables are written to a subdirectory of cache_dir keyed by a
+  hash of config, so caches for different models, shapes and samplers can be
+  inspected or removed independently.
+
+  Args:
+    cache_dir: Root directory of the compilation cache.
+    config: A JSON-serializable dictionary identifying the compiled programs.
+
+  Returns:
+    The cache directory, or None if the installed version of JAX or the
+    backend does not support a persistent compilation cache.
+  """
+  config_str = json.dumps(config, sort_keys=True, default=str)
+  key = hashlib.sha256(config_str.encode('utf-8')).hexdigest()[:16]
+  cache_path = os.path.join(os.path.expanduser(cache_dir), key)
+  os.makedirs(cache_path, exist_ok=True)
+
+  try:
+    from jax.experimental.compilation_cache import compilation_cache
+    compilation_cache.initialize_cache(cache_path)
+  except (ImportError, AttributeError):
+    try:
+      jax.config.update('jax_compilation_cache_dir', cache_path)
+    except AttributeError:
+      logging.warning('Persistent compilation cache is not supported.')
+      return None
+  except AssertionError:
+    logging.warning('Compilation cache was already initialized.')
+    return None
+
+  if not _compilation_cache_active(cache_path):
+    logging.warning(
+        'Persistent compilation cache at %s is ignored by this version of JAX '
+        'on the %s backend. Programs will be recompiled on every run.',
+        cache_path,
+        jax.lib.xla_bridge.get_backend().platform)
+    return None
+
+  logging.info('Using compilation cache at %s for %s', cache_path, config_str)
+  return cache_path
+
+
+def _compilation_cache_active(cache_path):
+  """Checks that compiling a program writes to the persistent cache.
+
+  Older versions of JAX accept a cache directory but only use it on some
+  backends (e.g. not on CPU), so this compiles a small probe program.
+  """
+  # Cache even the fast-compiling probe program.
+  thresholds = {
+      'jax_persistent_cache_min_compile_time_secs': 0,
+      'jax_persistent_cache_min_entry_size_bytes': 0,
+  }
+  previous = {}
+  for name, value in thresholds.items():
+    try:
+      previous[name] = getattr(jax.config, name)
+      jax.config.update(name, value)
+    except (AttributeError, KeyError):
+      continue
+
+  try:
+    probe = np.float32(np.random.uniform())
+    jax.jit(lambda x: x * probe)(np.zeros((), np.float32)).block_until_ready()
+  finally:
+    for name, value in previous.items():
+      jax.config.update(name, value)
+  return bool(os.listdir(cache_path))
+
+
+def set_host_device_count(count):
+  """Splits the host CPU into several XLA devices.
+
+  This lets pmap run data-parallel training on the cores of a single CPU.
+  It only has an effect if called before JAX initializes its backends.
+
+  Args:
+    count: Number of host devices.
+  """
+  xla_flags = [
+      flag for flag in os.environ.get('XLA_FLAGS', '').split()
+      if not flag.startswith('--xla_force_host_platform_device_count')
+  ]
+  xla_flags.append(f'--xla_force_host_platform_device_count={count}')
+  os.environ['XLA_FLAGS'] = ' '.join(xla_flags)
+
+
+def shard_batch(batch, num_devices):
+  """Splits the leading axis of a batch into (num_devices, per_device)."""
+  if batch.shape[0] % num_devices:
+    raise ValueError(f'Batch size {batch.shape[0]} is not divisible by the '
+                     f'number of devices ({num_devices}).')
+  return batch.reshape(num_devices, -1, *batch.shape[1:])